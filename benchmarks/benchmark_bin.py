@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Throughput and memory benchmarks for the pipeline's Python helper scripts
+#######################################################################
+#######################################################################
+
+import io
+import os
+import sys
+import json
+import time
+import errno
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import importlib.util
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bin")
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Generate synthetic peak files and samplesheets and benchmark the bin/ Python tools on them."
+    Epilog = """Example usage: python benchmark_bin.py --num_intervals 50000 --baseline baseline.json --regression_threshold 0.2
+Save a baseline on a reference machine with --save_baseline and compare later runs on the same machine against it."""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## SCALE PARAMETERS
+    argParser.add_argument(
+        "-ng",
+        "--num_groups",
+        type=int,
+        dest="NUM_GROUPS",
+        default=4,
+        help="Number of sample groups e.g. antibodies or conditions (default: 4).",
+    )
+    argParser.add_argument(
+        "-nr",
+        "--num_replicates",
+        type=int,
+        dest="NUM_REPLICATES",
+        default=3,
+        help="Number of replicates per sample group (default: 3).",
+    )
+    argParser.add_argument(
+        "-ni",
+        "--num_intervals",
+        type=int,
+        dest="NUM_INTERVALS",
+        default=20000,
+        help="Number of peak sites shared across samples, approximately the number of merged intervals (default: 20000).",
+    )
+    argParser.add_argument(
+        "-od",
+        "--overlap_density",
+        type=float,
+        dest="OVERLAP_DENSITY",
+        default=0.5,
+        help="Probability that a sample has a peak at a site i.e. the fraction of the boolean matrix that is TRUE (default: 0.5).",
+    )
+    argParser.add_argument(
+        "-nc",
+        "--num_chroms",
+        type=int,
+        dest="NUM_CHROMS",
+        default=5,
+        help="Number of chromosomes the sites are spread across (default: 5).",
+    )
+    argParser.add_argument(
+        "-sr",
+        "--samplesheet_rows",
+        type=int,
+        dest="SAMPLESHEET_ROWS",
+        default=20000,
+        help="Approximate number of rows in the synthetic samplesheet (default: 20000).",
+    )
+    argParser.add_argument("-sd", "--seed", type=int, dest="SEED", default=1, help="Random seed (default: 1).")
+
+    ## RUN PARAMETERS
+    argParser.add_argument(
+        "-c",
+        "--cases",
+        type=str,
+        dest="CASES",
+        default="",
+        help="Comma-separated list of benchmark cases to run. Available: {} (default: all but the legacy engine).".format(
+            ", ".join(CASES)
+        ),
+    )
+    argParser.add_argument(
+        "-rp",
+        "--repeats",
+        type=int,
+        dest="REPEATS",
+        default=3,
+        help="Number of timed runs per case. The fastest run is reported (default: 3).",
+    )
+    argParser.add_argument(
+        "-wd",
+        "--work_dir",
+        type=str,
+        dest="WORK_DIR",
+        default="",
+        help="Directory for the synthetic inputs and tool outputs. A temporary directory is used and removed if not provided (default: '').",
+    )
+    argParser.add_argument(
+        "-o",
+        "--outfile",
+        type=str,
+        dest="OUTFILE",
+        default="",
+        help="Write the benchmark results to this JSON file (default: '').",
+    )
+    argParser.add_argument(
+        "-b",
+        "--baseline",
+        type=str,
+        dest="BASELINE",
+        default="",
+        help="Compare against the results in this baseline JSON file and exit with status 1 on a regression (default: '').",
+    )
+    argParser.add_argument(
+        "-sb",
+        "--save_baseline",
+        type=str,
+        dest="SAVE_BASELINE",
+        default="",
+        help="Write the benchmark results to this file as the new baseline (default: '').",
+    )
+    argParser.add_argument(
+        "-rt",
+        "--regression_threshold",
+        type=float,
+        dest="REGRESSION_THRESHOLD",
+        default=0.2,
+        help="Fractional drop in rows/sec or increase in peak memory relative to the baseline reported as a regression (default: 0.2).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+RESULTS_VERSION = 1
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def load_tool(name):
+    """Import a bin/ script as a module so it can be run in-process under tracemalloc."""
+    if BIN_DIR not in sys.path:
+        sys.path.insert(0, BIN_DIR)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(BIN_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+############################################
+############################################
+## SYNTHETIC DATA
+############################################
+############################################
+
+
+def sample_names(numGroups, numReplicates):
+    return ["GROUP{}_REP{}".format(x + 1, y + 1) for x in range(numGroups) for y in range(numReplicates)]
+
+
+def generate_peaks(SampleNameList, numIntervals, overlapDensity, numChroms, isNarrow, seed=1):
+    """
+    Return {sample: [fields, ...]} of MACS2 narrowPeak/broadPeak records sorted as by 'sort -k1,1 -k2,2n'. Sites are
+    laid out along each chromosome with gaps wider than any peak and every sample calls a peak at a site with
+    probability overlapDensity, jittered around the site so peaks from different samples overlap without being
+    identical. At least one sample has a peak at every site.
+    """
+    rand = random.Random(seed)
+    chroms = ["chr{}".format(x + 1) for x in range(numChroms)]
+    peakDict = dict([(x, []) for x in SampleNameList])
+    peakCounts = dict([(x, 0) for x in SampleNameList])
+    for siteIdx in range(numIntervals):
+        chrom = chroms[siteIdx % numChroms]
+        siteStart = 1000 + (siteIdx // numChroms) * 5000
+        callers = [x for x in SampleNameList if rand.random() < overlapDensity]
+        if not callers:
+            callers = [rand.choice(SampleNameList)]
+        for sample in callers:
+            start = siteStart + rand.randint(0, 200)
+            width = rand.randint(150, 2000)
+            peakCounts[sample] += 1
+            pval = round(rand.uniform(2, 60), 5)
+            fields = [
+                chrom,
+                str(start),
+                str(start + width),
+                "{}_peak_{}".format(sample, peakCounts[sample]),
+                str(rand.randint(10, 1000)),
+                ".",
+                str(round(rand.uniform(1.5, 40), 5)),
+                str(pval),
+                str(round(pval * 0.8, 5)),
+            ]
+            if isNarrow:
+                fields.append(str(rand.randint(0, width - 1)))
+            peakDict[sample].append(fields)
+    for sample in SampleNameList:
+        peakDict[sample].sort(key=lambda x: (x[0], int(x[1]), "\t".join(x)))
+    return peakDict
+
+
+def write_peak_files(peakDict, OutDir, isNarrow):
+    """Write one <sample>_peaks.<narrowPeak|broadPeak> file per sample and return the sorted list of paths."""
+    makedir(OutDir)
+    PeakFiles = []
+    for sample in sorted(peakDict):
+        PeakFile = os.path.join(OutDir, "{}_peaks.{}".format(sample, "narrowPeak" if isNarrow else "broadPeak"))
+        with open(PeakFile, "w") as fout:
+            for fields in peakDict[sample]:
+                fout.write("\t".join(fields) + "\n")
+        PeakFiles.append(PeakFile)
+    return PeakFiles
+
+
+def write_merged_file(peakDict, MergedFile, isNarrow):
+    """
+    Write the output of 'sort -k1,1 -k2,2n <PEAK_FILES> | mergeBed -c 2,3,...,9(,10) -o collapse,...' for the peaks
+    in peakDict and return the number of merged intervals.
+    """
+    numCols = 10 if isNarrow else 9
+    peaks = sorted([x for y in peakDict.values() for x in y], key=lambda x: (x[0], int(x[1]), "\t".join(x)))
+    numIntervals = 0
+    fout = open(MergedFile, "w")
+    interval = None
+    for fields in peaks + [None]:
+        if fields is not None and interval is not None:
+            if fields[0] == interval[0] and int(fields[1]) <= interval[2]:
+                interval[2] = max(interval[2], int(fields[2]))
+                interval[3].append(fields)
+                continue
+        if interval is not None:
+            collapsed = [",".join([x[idx] for x in interval[3]]) for idx in range(1, numCols)]
+            fout.write("\t".join([interval[0], str(interval[1]), str(interval[2])] + collapsed) + "\n")
+            numIntervals += 1
+        if fields is not None:
+            interval = [fields[0], int(fields[1]), int(fields[2]), [fields]]
+    fout.close()
+    return numIntervals
+
+
+def write_samplesheet(SampleSheet, numRows, numReplicates, seed=1):
+    """
+    Write a valid paired-end samplesheet with about numRows rows: antibody samples with numReplicates replicates,
+    a matching input control per antibody and occasional technical re-runs. Returns the number of rows.
+    """
+    rand = random.Random(seed)
+    rows = []
+    idx = 0
+    while len(rows) < numRows:
+        idx += 1
+        control = "INPUT{}".format(idx)
+        for rep in range(1, numReplicates + 1):
+            for sample, antibody, controlName in [("AB{}".format(idx), "AB{}".format(idx), control), (control, "", "")]:
+                numRuns = 2 if rand.random() < 0.1 else 1
+                for run in range(numRuns):
+                    prefix = "{}_R{}_T{}".format(sample, rep, run + 1)
+                    rows.append(
+                        [
+                            sample,
+                            prefix + "_1.fastq.gz",
+                            prefix + "_2.fastq.gz",
+                            str(rep),
+                            antibody,
+                            controlName,
+                            str(rep) if controlName else "",
+                        ]
+                    )
+    with open(SampleSheet, "w") as fout:
+        fout.write("sample,fastq_1,fastq_2,replicate,antibody,control,control_replicate\n")
+        for row in rows:
+            fout.write(",".join(row) + "\n")
+    return len(rows)
+
+
+############################################
+############################################
+## BENCHMARK CASES
+############################################
+############################################
+
+## Each case maps to (tool, input builder). Builders take the prepared inputs and an output directory and return
+## the command-line arguments passed to the tool's main() and the number of rows processed.
+
+
+def merged_args(inputs, OutDir, isNarrow, extra=()):
+    key = "narrow" if isNarrow else "broad"
+    args = [inputs[key]["merged"], ",".join(inputs["samples"]), os.path.join(OutDir, "consensus.boolean.txt")]
+    args += ["--bed_file", os.path.join(OutDir, "consensus.bed"), "--saf_file", os.path.join(OutDir, "consensus.saf")]
+    return args + (["--is_narrow_peak"] if isNarrow else []) + list(extra), inputs[key]["intervals"]
+
+
+def peak_files_args(inputs, OutDir, isNarrow):
+    key = "narrow" if isNarrow else "broad"
+    args, rows = merged_args(inputs, OutDir, isNarrow, extra=["--peak_files", "--streaming"])
+    args[0] = ",".join(inputs[key]["peak_files"])
+    return args, rows
+
+
+CASES = {
+    "merged_expand_narrow": ("macs2_merged_expand", lambda x, y: merged_args(x, y, True)),
+    "merged_expand_broad": ("macs2_merged_expand", lambda x, y: merged_args(x, y, False)),
+    "merged_expand_legacy": ("macs2_merged_expand", lambda x, y: merged_args(x, y, True, extra=["--legacy"])),
+    "peak_files_narrow": ("macs2_merged_expand", lambda x, y: peak_files_args(x, y, True)),
+    "peak_files_broad": ("macs2_merged_expand", lambda x, y: peak_files_args(x, y, False)),
+    "check_samplesheet": (
+        "check_samplesheet",
+        lambda x, y: ([x["samplesheet"], os.path.join(y, "samplesheet.valid.csv")], x["samplesheet_rows"]),
+    ),
+}
+DEFAULT_CASES = [x for x in CASES if x != "merged_expand_legacy"]
+
+
+def prepare_inputs(args, WorkDir, cases):
+    """Generate only the synthetic inputs needed by the selected cases."""
+    inputs = {"samples": sample_names(args.NUM_GROUPS, args.NUM_REPLICATES)}
+    for isNarrow, key in [(True, "narrow"), (False, "broad")]:
+        if not [x for x in cases if x.endswith(key) or (isNarrow and x == "merged_expand_legacy")]:
+            continue
+        peakDict = generate_peaks(
+            inputs["samples"],
+            args.NUM_INTERVALS,
+            args.OVERLAP_DENSITY,
+            args.NUM_CHROMS,
+            isNarrow,
+            seed=args.SEED,
+        )
+        MergedFile = os.path.join(WorkDir, "merged_{}.txt".format(key))
+        inputs[key] = {
+            "peak_files": write_peak_files(peakDict, os.path.join(WorkDir, key), isNarrow),
+            "merged": MergedFile,
+            "intervals": write_merged_file(peakDict, MergedFile, isNarrow),
+        }
+    if "check_samplesheet" in cases:
+        inputs["samplesheet"] = os.path.join(WorkDir, "samplesheet.csv")
+        inputs["samplesheet_rows"] = write_samplesheet(
+            inputs["samplesheet"], args.SAMPLESHEET_ROWS, args.NUM_REPLICATES, seed=args.SEED
+        )
+    return inputs
+
+
+def run_case(module, toolArgs, repeats):
+    """
+    Run module.main(toolArgs) repeats times with stdout silenced and return the fastest wall time, then once more
+    under tracemalloc for the peak traced memory. Memory is measured separately as tracing slows the tool down.
+    """
+    timings = []
+    for idx in range(max(1, repeats)):
+        startTime = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            module.main(toolArgs)
+        timings.append(time.perf_counter() - startTime)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.main(toolArgs)
+    currentSize, peakSize = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peakSize / 1024.0 / 1024.0
+
+
+def compare_results(results, baseline, threshold):
+    """Return a list of (case, metric, baseline, current) regressions beyond threshold."""
+    regressions = []
+    for case, current in sorted(results["results"].items()):
+        previous = baseline.get("results", {}).get(case)
+        if previous is None:
+            continue
+        if current["rows_per_sec"] < previous["rows_per_sec"] * (1.0 - threshold):
+            regressions.append((case, "rows_per_sec", previous["rows_per_sec"], current["rows_per_sec"]))
+        if current["peak_memory_mb"] > previous["peak_memory_mb"] * (1.0 + threshold):
+            regressions.append((case, "peak_memory_mb", previous["peak_memory_mb"], current["peak_memory_mb"]))
+    return regressions
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    cases = args.CASES.split(",") if args.CASES else DEFAULT_CASES
+    for case in cases:
+        if case not in CASES:
+            print("ERROR: Unknown benchmark case '{}'. Available: {}".format(case, ", ".join(CASES)))
+            sys.exit(1)
+
+    WorkDir = args.WORK_DIR or tempfile.mkdtemp(prefix="benchmark_bin_")
+    makedir(WorkDir)
+    startTime = time.time()
+    inputs = prepare_inputs(args, WorkDir, cases)
+    print("Generated synthetic inputs in {} in {:.1f}s".format(WorkDir, time.time() - startTime))
+
+    results = {
+        "version": RESULTS_VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scale": {
+            "num_groups": args.NUM_GROUPS,
+            "num_replicates": args.NUM_REPLICATES,
+            "num_intervals": args.NUM_INTERVALS,
+            "overlap_density": args.OVERLAP_DENSITY,
+            "num_chroms": args.NUM_CHROMS,
+            "samplesheet_rows": args.SAMPLESHEET_ROWS,
+            "seed": args.SEED,
+        },
+        "results": {},
+    }
+    print("\t".join(["case", "rows", "seconds", "rows_per_sec", "peak_memory_mb"]))
+    modules = {}
+    for case in cases:
+        tool, builder = CASES[case]
+        if tool not in modules:
+            modules[tool] = load_tool(tool)
+        OutDir = os.path.join(WorkDir, case)
+        makedir(OutDir)
+        toolArgs, rows = builder(inputs, OutDir)
+        seconds, peakMemory = run_case(modules[tool], toolArgs, args.REPEATS)
+        results["results"][case] = {
+            "rows": rows,
+            "seconds": round(seconds, 4),
+            "rows_per_sec": round(rows / max(seconds, 1e-9), 1),
+            "peak_memory_mb": round(peakMemory, 2),
+        }
+        print(
+            "{}\t{}\t{:.3f}\t{:.0f}\t{:.1f}".format(
+                case, rows, seconds, results["results"][case]["rows_per_sec"], peakMemory
+            )
+        )
+
+    for OutFile in [args.OUTFILE, args.SAVE_BASELINE]:
+        if OutFile:
+            makedir(os.path.dirname(OutFile))
+            with open(OutFile, "w") as fout:
+                json.dump(results, fout, indent=4, sort_keys=True)
+                fout.write("\n")
+    if not args.WORK_DIR:
+        shutil.rmtree(WorkDir)
+
+    if args.BASELINE:
+        with open(args.BASELINE, "r") as fin:
+            baseline = json.load(fin)
+        if baseline.get("scale") != results["scale"]:
+            print(
+                "WARNING: Baseline {} was run at a different scale, rows/sec may not be comparable.".format(
+                    args.BASELINE
+                )
+            )
+        regressions = compare_results(results, baseline, args.REGRESSION_THRESHOLD)
+        for case, metric, previous, current in regressions:
+            print(
+                "REGRESSION: {} {} {} -> {} (threshold {:.0%})".format(
+                    case, metric, previous, current, args.REGRESSION_THRESHOLD
+                )
+            )
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline {}".format(args.BASELINE))
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Join HOMER annotatePeaks output onto a consensus peak boolean file
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import heapq
+import operator
+import errno
+import argparse
+import resource
+import tempfile
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Append the HOMER annotatePeaks columns to the matching intervals of a *.boolean.txt file written by "
+        "macs2_merged_expand.py. Both files are joined on a key in a single streaming pass and inputs that are "
+        "not already ordered by the key are sorted externally in bounded memory."
+    )
+    Epilog = """Example usage: python annotate_boolean_peaks.py <BOOLEAN_FILE> <ANNOTATION_FILE> <OUTFILE> --key interval_id"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("BOOLEAN_FILE", help="Consensus peak *.boolean.txt file with a header line.")
+    argParser.add_argument("ANNOTATION_FILE", help="HOMER annotatePeaks output for the consensus peak BED file.")
+    argParser.add_argument("OUTFILE", help="Boolean file with the HOMER annotation columns appended.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-k",
+        "--key",
+        type=str,
+        dest="KEY",
+        default="interval_id",
+        choices=["interval_id", "coordinates"],
+        help="Join on the interval ID (HOMER 'PeakID' column) or on chromosome, start and end (default: 'interval_id').",
+    )
+    argParser.add_argument(
+        "-so",
+        "--start_offset",
+        type=int,
+        dest="START_OFFSET",
+        default=1,
+        help="Value subtracted from the annotation start coordinate to match the BED start of the boolean file when joining on coordinates. HOMER reports 1-based starts (default: 1).",
+    )
+    argParser.add_argument(
+        "-sr",
+        "--sort_rows",
+        type=int,
+        dest="SORT_ROWS",
+        default=500000,
+        help="Maximum number of rows held in memory per chunk when an input has to be sorted externally (default: 500000).",
+    )
+    argParser.add_argument(
+        "-td",
+        "--tmp_dir",
+        type=str,
+        dest="TMP_DIR",
+        default=".",
+        help="Directory for the temporary chunk files of the external sort (default: '.').",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def interval_id_key(intervalId):
+    """Sort key so that 'Interval_9' sorts before 'Interval_10', as written by macs2_merged_expand.py."""
+    return (len(intervalId), intervalId)
+
+
+def boolean_key_func(header, key):
+    """Return a function extracting the join key from a line of the boolean file."""
+    if key == "interval_id":
+        if "interval_id" not in header:
+            print("ERROR: Boolean file has no 'interval_id' column!")
+            sys.exit(1)
+        idCol = header.index("interval_id")
+        return lambda line: interval_id_key(line.split("\t", idCol + 1)[idCol])
+
+    def coordinate_key(line):
+        lspl = line.split("\t", 3)
+        return (lspl[0], int(lspl[1]), int(lspl[2]))
+
+    return coordinate_key
+
+
+def annotation_key_func(key, startOffset):
+    """Return a function extracting the join key from a line of HOMER annotatePeaks output."""
+    if key == "interval_id":
+        return lambda line: interval_id_key(line.split("\t", 1)[0])
+
+    def coordinate_key(line):
+        lspl = line.split("\t", 4)
+        return (lspl[1], int(lspl[2]) - startOffset, int(lspl[3]))
+
+    return coordinate_key
+
+
+def format_key(keyValue, key):
+    if key == "interval_id":
+        return keyValue[1]
+    return "{}:{}-{}".format(*keyValue)
+
+
+def is_sorted(FileName, keyFunc):
+    """Single pass over the rows of FileName (after its header) checking that keys are in ascending order."""
+    fin = open(FileName, "r")
+    fin.readline()
+    previous = None
+    for line in fin:
+        if line == "\n":
+            continue
+        current = keyFunc(line)
+        if previous is not None and current < previous:
+            fin.close()
+            return False
+        previous = current
+    fin.close()
+    return True
+
+
+def iter_rows(fin, keyFunc):
+    """Yield (key, line) for the remaining non-empty lines of fin with trailing newlines removed."""
+    for line in fin:
+        line = line.rstrip("\n")
+        if line:
+            yield keyFunc(line), line
+
+
+def iter_sorted_rows(FileName, keyFunc, sortRows=500000, TmpDir="."):
+    """
+    Yield (key, line) for the data lines of FileName in key order. Lines are sorted in chunks of at most sortRows
+    which are spilled to temporary files and then merged lazily, so memory use is bounded by the chunk size.
+    """
+    ChunkFiles = []
+    chunk = []
+    byKey = operator.itemgetter(0)
+
+    def spill():
+        chunk.sort(key=byKey)
+        fout = tempfile.NamedTemporaryFile("w", dir=TmpDir, prefix="annotate_boolean_peaks.", delete=False)
+        for keyValue, line in chunk:
+            fout.write(line + "\n")
+        fout.close()
+        ChunkFiles.append(fout.name)
+        del chunk[:]
+
+    handles = []
+    try:
+        fin = open(FileName, "r")
+        fin.readline()
+        for row in iter_rows(fin, keyFunc):
+            chunk.append(row)
+            if len(chunk) >= sortRows:
+                spill()
+        fin.close()
+        if not ChunkFiles:
+            chunk.sort(key=byKey)
+            for row in chunk:
+                yield row
+            return
+        if chunk:
+            spill()
+        handles = [open(x, "r") for x in ChunkFiles]
+        for row in heapq.merge(*[iter_rows(x, keyFunc) for x in handles], key=byKey):
+            yield row
+    finally:
+        for fin in handles:
+            fin.close()
+        for ChunkFile in ChunkFiles:
+            if os.path.exists(ChunkFile):
+                os.remove(ChunkFile)
+
+
+def iter_keyed_rows(FileName, keyFunc, sortRows, TmpDir, label):
+    """Yield (key, line) for the rows of FileName in key order, sorting externally only if it is not already ordered."""
+    if is_sorted(FileName, keyFunc):
+        fin = open(FileName, "r")
+        fin.readline()
+        for row in iter_rows(fin, keyFunc):
+            yield row
+        fin.close()
+    else:
+        print("WARNING: {} is not ordered by the join key and will be sorted.".format(label))
+        for row in iter_sorted_rows(FileName, keyFunc, sortRows=sortRows, TmpDir=TmpDir):
+            yield row
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def annotate_boolean_peaks(
+    BooleanFile, AnnotationFile, OutFile, key="interval_id", startOffset=1, sortRows=500000, TmpDir="."
+):
+    """
+    Merge-join the rows of the HOMER annotation onto the rows of the boolean file and write the boolean columns
+    followed by the annotation columns from 'Focus Ratio/Region Size' onwards, as the previous 'sort | paste' did.
+    Rows are written in boolean file order when it is already ordered by the key, otherwise in key order.
+    Every key must be present exactly once in both files. Returns the number of rows written.
+    """
+    fin = open(BooleanFile, "r")
+    booleanHeader = fin.readline().rstrip("\n")
+    fin.close()
+    fin = open(AnnotationFile, "r")
+    annotationHeader = fin.readline().rstrip("\n")
+    fin.close()
+
+    booleanKey = boolean_key_func(booleanHeader.split("\t"), key)
+    annotationKey = annotation_key_func(key, startOffset)
+    booleanRows = iter_keyed_rows(BooleanFile, booleanKey, sortRows, TmpDir, BooleanFile)
+    annotationRows = iter_keyed_rows(AnnotationFile, annotationKey, sortRows, TmpDir, AnnotationFile)
+
+    ## Keep a few examples of each kind of mismatch to report
+    unmatched = {"boolean": [], "annotation": [], "duplicate": []}
+    numUnmatched = {"boolean": 0, "annotation": 0, "duplicate": 0}
+
+    def record(kind, keyValue):
+        numUnmatched[kind] += 1
+        if len(unmatched[kind]) < 10:
+            unmatched[kind].append(format_key(keyValue, key))
+
+    makedir(os.path.dirname(OutFile))
+    TmpOutFile = OutFile + ".tmp"
+    fout = open(TmpOutFile, "w")
+    fout.write("{}\t{}\n".format(booleanHeader, annotationHeader.split("\t", 6)[6]))
+
+    numRows = 0
+    previousKey = None
+    annotation = next(annotationRows, None)
+    for boolKey, boolLine in booleanRows:
+        if boolKey == previousKey:
+            record("duplicate", boolKey)
+            continue
+        previousKey = boolKey
+        while annotation is not None and annotation[0] < boolKey:
+            record("annotation", annotation[0])
+            annotation = next(annotationRows, None)
+        if annotation is None or annotation[0] != boolKey:
+            record("boolean", boolKey)
+            continue
+        fout.write("{}\t{}\n".format(boolLine, annotation[1].split("\t", 6)[6]))
+        numRows += 1
+        annotation = next(annotationRows, None)
+        while annotation is not None and annotation[0] == boolKey:
+            record("duplicate", annotation[0])
+            annotation = next(annotationRows, None)
+    while annotation is not None:
+        record("annotation", annotation[0])
+        annotation = next(annotationRows, None)
+    fout.close()
+
+    if sum(numUnmatched.values()):
+        os.remove(TmpOutFile)
+        messages = {
+            "boolean": "intervals in {} not found in {}".format(BooleanFile, AnnotationFile),
+            "annotation": "peaks in {} not found in {}".format(AnnotationFile, BooleanFile),
+            "duplicate": "duplicated keys",
+        }
+        for kind in ["boolean", "annotation", "duplicate"]:
+            if numUnmatched[kind]:
+                print(
+                    "ERROR: {} {} joining on {}, e.g. {}".format(
+                        numUnmatched[kind], messages[kind], key, ", ".join(unmatched[kind])
+                    )
+                )
+        sys.exit(1)
+    os.replace(TmpOutFile, OutFile)
+    return numRows
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    startTime = time.time()
+    numRows = annotate_boolean_peaks(
+        BooleanFile=args.BOOLEAN_FILE,
+        AnnotationFile=args.ANNOTATION_FILE,
+        OutFile=args.OUTFILE,
+        key=args.KEY,
+        startOffset=args.START_OFFSET,
+        sortRows=args.SORT_ROWS,
+        TmpDir=args.TMP_DIR,
+    )
+    print(
+        "Annotated {} intervals in {:.1f}s, peak memory {:.1f} MB".format(
+            numRows, time.time() - startTime, peak_memory_mb()
+        )
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Single-pass extended and read-centred bigWig coverage tracks
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import array
+import errno
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pysam
+import pyBigWig
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Build extended and read-centred coverage from a BAM file in one pass and write CPM and scaled bigWig files."
+    )
+    Epilog = """Example usage: python bam_coverage.py <BAM_FILE> <OUTPUT_PREFIX> --max_fragment_length 10000 --scale_factors invariant_genes/SAMPLE:1.2 --threads 4"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("BAM_FILE", help="Coordinate-sorted and indexed BAM file.")
+    argParser.add_argument(
+        "OUTPUT_PREFIX",
+        help="Prefix for the CPM normalised '<OUTPUT_PREFIX>.extend.bw' and '<OUTPUT_PREFIX>.extend.center.bw' files.",
+    )
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-el",
+        "--extend_length",
+        type=int,
+        dest="EXTEND_LENGTH",
+        default=0,
+        help="Fragment length used to extend single-end reads and reads without a proper mate. 0 uses the median fragment length of proper pairs, as for 'bamCoverage --extendReads' (default: 0).",
+    )
+    argParser.add_argument(
+        "-mf",
+        "--max_fragment_length",
+        type=int,
+        dest="MAX_FRAGMENT_LENGTH",
+        default=0,
+        help="Ignore reads with a fragment length above this value, as for 'bamCoverage --maxFragmentLength'. 0 disables the filter (default: 0).",
+    )
+    argParser.add_argument(
+        "-sf",
+        "--scale_factors",
+        dest="SCALE_FACTORS",
+        default="",
+        help="Comma-separated list of <OUTPUT_PREFIX>:<FACTOR> entries. Raw coverage multiplied by FACTOR is written to '<OUTPUT_PREFIX>.extend.bw' and '<OUTPUT_PREFIX>.extend.center.bw' for each entry, as for 'bamCoverage --scaleFactor' (default: '').",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of chromosomes processed in parallel (default: 1).",
+    )
+    argParser.add_argument(
+        "-td",
+        "--tmp_dir",
+        dest="TMP_DIR",
+        default=".",
+        help="Directory used to hold per-chromosome coverage runs until all chromosomes have been counted (default: '.').",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## Coverage tracks built from each read and the file suffix they are written to
+TRACKS = [("extend", ".extend.bw"), ("center", ".extend.center.bw")]
+
+## Number of proper pairs sampled to estimate the default fragment length
+FRAGMENT_SAMPLE_SIZE = 10000
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def is_proper_pair(read, maxPairedFragmentLength):
+    """Mates on the same chromosome facing each other within maxPairedFragmentLength, as in deepTools."""
+    if not read.is_proper_pair:
+        return False
+    if read.reference_id != read.next_reference_id:
+        return False
+    if abs(read.template_length) > maxPairedFragmentLength:
+        return False
+    if read.is_reverse is read.mate_is_reverse:
+        return False
+    if read.is_reverse:
+        return read.reference_start >= read.next_reference_start
+    return read.reference_start <= read.next_reference_start
+
+
+def template_length(read):
+    """|TLEN| for paired reads, otherwise the aligned reference length (M, D, = and X operations)."""
+    if read.template_length:
+        return abs(read.template_length)
+    tlen = 0
+    for op, opLen in read.cigartuples or []:
+        if op in (0, 2, 7, 8):
+            tlen += opLen
+    return tlen
+
+
+def estimate_fragment_length(BAMFile):
+    """
+    Return (median fragment length of proper pairs, median read length) from the first alignments in BAMFile.
+    The fragment length is 0 for single-end data.
+    """
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    fragLengths = []
+    readLengths = []
+    for read in bam.fetch(until_eof=True):
+        if read.is_unmapped:
+            continue
+        if len(readLengths) < FRAGMENT_SAMPLE_SIZE:
+            readLengths.append(read.query_length)
+        if read.is_proper_pair and read.template_length > 0:
+            fragLengths.append(read.template_length)
+        if len(fragLengths) >= FRAGMENT_SAMPLE_SIZE or (not fragLengths and len(readLengths) >= FRAGMENT_SAMPLE_SIZE):
+            break
+    bam.close()
+    fragLength = int(np.median(fragLengths)) if fragLengths else 0
+    readLength = int(np.median(readLengths)) if readLengths else 0
+    return fragLength, readLength
+
+
+def parse_scale_factors(ScaleFactors):
+    """Parse '<OUTPUT_PREFIX>:<FACTOR>,...' into a list of (prefix, factor) tuples."""
+    scaleList = []
+    for entry in [x for x in ScaleFactors.split(",") if x]:
+        prefix, _, factor = entry.rpartition(":")
+        if not prefix:
+            print("ERROR: Scale factor entry '{}' is not in '<OUTPUT_PREFIX>:<FACTOR>' format!".format(entry))
+            sys.exit(1)
+        scaleList.append((prefix, float(factor)))
+    return scaleList
+
+
+############################################
+############################################
+## COVERAGE
+############################################
+############################################
+
+
+def coverage_runs(starts, ends, chromLength):
+    """
+    Turn fragment (start, end) events into run-length coverage over [0, chromLength).
+    Returns (runStarts, runCounts); each run ends where the next one starts and the last at chromLength.
+    Memory is proportional to the number of fragments rather than the chromosome length.
+    """
+    starts = np.clip(np.frombuffer(starts, dtype=np.int64), 0, chromLength)
+    ends = np.clip(np.frombuffer(ends, dtype=np.int64), 0, chromLength)
+    keep = ends > starts
+    starts = np.sort(starts[keep])
+    ends = np.sort(ends[keep])
+    bounds = np.unique(np.concatenate((np.array([0, chromLength], dtype=np.int64), starts, ends)))[:-1]
+    counts = np.searchsorted(starts, bounds, side="right") - np.searchsorted(ends, bounds, side="right")
+    change = np.ones(len(counts), dtype=bool)
+    change[1:] = counts[1:] != counts[:-1]
+    return bounds[change], counts[change].astype(np.int32)
+
+
+def chromosome_coverage(task):
+    """
+    Pool worker: fetch one chromosome and accumulate extended and read-centred fragments.
+    Fragments follow 'bamCoverage --extendReads [--centerReads]': proper pairs span the mates, other reads
+    are extended to the default fragment length in their direction, or kept as aligned blocks when there is none.
+    Writes the coverage runs of both tracks to an .npz file and returns (chrom, reads counted, npz path).
+    """
+    BAMFile, chrom, chromLength, fragLength, maxFragment, TmpDir = task
+    maxPairedFragment = maxFragment if maxFragment > 0 else (4 * fragLength if fragLength else 1000)
+
+    extStarts, extEnds = array.array("q"), array.array("q")
+    cenStarts, cenEnds = array.array("q"), array.array("q")
+    numReads = 0
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    for read in bam.fetch(chrom):
+        if read.is_unmapped:
+            continue
+        if maxFragment > 0 and template_length(read) > maxFragment:
+            continue
+        numReads += 1
+        if not fragLength:
+            for blockStart, blockEnd in read.get_blocks():
+                extStarts.append(blockStart)
+                extEnds.append(blockEnd)
+                cenStarts.append(blockStart)
+                cenEnds.append(blockEnd)
+            continue
+        if is_proper_pair(read, maxPairedFragment):
+            if read.is_reverse:
+                fragStart = read.next_reference_start
+                fragEnd = read.reference_end
+            else:
+                fragStart = read.reference_start
+                fragEnd = read.reference_start + abs(read.template_length)
+        elif read.is_reverse:
+            fragStart = read.reference_end - fragLength
+            fragEnd = read.reference_end
+        else:
+            fragStart = read.reference_start
+            fragEnd = read.reference_start + fragLength
+        extStarts.append(fragStart)
+        extEnds.append(fragEnd)
+
+        queryLength = read.infer_query_length(always=False)
+        centerStart = int(fragEnd - (fragEnd - fragStart) / 2 - queryLength / 2)
+        cenStarts.append(centerStart)
+        cenEnds.append(centerStart + queryLength)
+    bam.close()
+
+    extRunStarts, extRunCounts = coverage_runs(extStarts, extEnds, chromLength)
+    del extStarts, extEnds
+    cenRunStarts, cenRunCounts = coverage_runs(cenStarts, cenEnds, chromLength)
+    RunFile = os.path.join(TmpDir, "{}.npz".format(chrom.replace(os.sep, "_")))
+    np.savez(
+        RunFile,
+        extend_starts=extRunStarts,
+        extend_counts=extRunCounts,
+        center_starts=cenRunStarts,
+        center_counts=cenRunCounts,
+    )
+    return chrom, numReads, RunFile
+
+
+def scaled_values(counts, factor):
+    """
+    Coverage counts times factor, rounded to 6 significant digits as in the bedGraph files written by bamCoverage.
+    Runs only take a handful of distinct counts so each one is formatted once.
+    """
+    uniqCounts, inverse = np.unique(counts, return_inverse=True)
+    values = np.array([float("{:g}".format(x * factor)) for x in uniqCounts], dtype=np.float64)
+    return values[inverse]
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def bam_coverage(BAMFile, OutputPrefix, extendLength=0, maxFragment=0, scaleFactors=[], threads=1, TmpDir="."):
+    """
+    Count every chromosome of BAMFile once and write one '.extend.bw' and one '.extend.center.bw' file for
+    CPM normalisation at OutputPrefix and for each (prefix, factor) in scaleFactors. Returns the number of reads counted.
+    """
+    pairedFragLength, readLength = estimate_fragment_length(BAMFile)
+    if extendLength:
+        ## bamCoverage does not extend reads shorter than the requested extension
+        fragLength = extendLength if extendLength >= readLength else 0
+    elif pairedFragLength:
+        fragLength = pairedFragLength
+    else:
+        print("ERROR: Library is not paired-end. Please provide an extension length with --extend_length!")
+        sys.exit(1)
+
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    if not bam.has_index():
+        print("ERROR: No index found for {}!".format(BAMFile))
+        sys.exit(1)
+    chromSizes = list(zip(bam.references, bam.lengths))
+    bam.close()
+
+    makedir(TmpDir)
+    RunDir = tempfile.mkdtemp(prefix="bam_coverage.", dir=TmpDir)
+    tasks = [(BAMFile, chrom, length, fragLength, maxFragment, RunDir) for chrom, length in chromSizes]
+    if threads > 1:
+        pool = multiprocessing.Pool(processes=threads)
+        results = pool.map(chromosome_coverage, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = [chromosome_coverage(x) for x in tasks]
+    numReads = sum([x[1] for x in results])
+
+    ## CPM scaling needs the total read count so bigWig files are written once every chromosome has been counted
+    outputs = [(OutputPrefix, 1e6 / numReads if numReads else 0.0)] + list(scaleFactors)
+    bigWigs = []
+    for prefix, factor in outputs:
+        makedir(os.path.dirname(prefix))
+        for track, suffix in TRACKS:
+            bw = pyBigWig.open(prefix + suffix, "w")
+            bw.addHeader(chromSizes, maxZooms=10)
+            bigWigs.append((bw, track, factor))
+
+    for chrom, chromReads, RunFile in results:
+        runs = np.load(RunFile)
+        chromLength = dict(chromSizes)[chrom]
+        for bw, track, factor in bigWigs:
+            starts = runs[track + "_starts"]
+            ends = np.append(starts[1:], chromLength)
+            bw.addEntries(
+                [chrom] * len(starts), starts, ends=ends, values=scaled_values(runs[track + "_counts"], factor)
+            )
+        runs.close()
+        os.remove(RunFile)
+
+    for bw, track, factor in bigWigs:
+        bw.close()
+    shutil.rmtree(RunDir)
+    return numReads
+
+
+def main(args=None):
+    args = parse_args(args)
+    startTime = time.time()
+    numReads = bam_coverage(
+        BAMFile=args.BAM_FILE,
+        OutputPrefix=args.OUTPUT_PREFIX,
+        extendLength=args.EXTEND_LENGTH,
+        maxFragment=args.MAX_FRAGMENT_LENGTH,
+        scaleFactors=parse_scale_factors(args.SCALE_FACTORS),
+        threads=args.THREADS,
+        TmpDir=args.TMP_DIR,
+    )
+    print(
+        "Wrote coverage for {} reads in {:.1f}s, peak memory {:.1f} MB".format(
+            numReads, time.time() - startTime, peak_memory_mb()
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Single-pass ChIP-seq BAM filtering with per-filter drop counts
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import bisect
+import argparse
+import resource
+
+import pysam
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Filter a BAM file by flags, duplicates, MAPQ, include regions and fragment length in a single BGZF pass."
+    )
+    Epilog = """Example usage: python bam_filter.py <BAM_INPUT_FILE> <BAM_OUTPUT_FILE> --exclude_flags 0x90C --require_flags 0x3 --remove_duplicates --min_mapq 1 --regions include.bed --max_fragment 500"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("BAM_INPUT_FILE", help="Input BAM file.")
+    argParser.add_argument("BAM_OUTPUT_FILE", help="Output BAM file.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-F",
+        "--exclude_flags",
+        type=lambda x: int(x, 0),
+        dest="EXCLUDE_FLAGS",
+        default=0,
+        help="Drop alignments with any of these FLAG bits set, as for 'samtools view -F' (default: 0).",
+    )
+    argParser.add_argument(
+        "-f",
+        "--require_flags",
+        type=lambda x: int(x, 0),
+        dest="REQUIRE_FLAGS",
+        default=0,
+        help="Drop alignments without all of these FLAG bits set, as for 'samtools view -f' (default: 0).",
+    )
+    argParser.add_argument(
+        "-rd",
+        "--remove_duplicates",
+        dest="REMOVE_DUPLICATES",
+        help="Drop alignments marked as duplicates (FLAG 0x400) (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-q",
+        "--min_mapq",
+        type=int,
+        dest="MIN_MAPQ",
+        default=0,
+        help="Drop alignments with MAPQ below this value, as for 'samtools view -q' (default: 0).",
+    )
+    argParser.add_argument(
+        "-L",
+        "--regions",
+        dest="REGIONS",
+        default="",
+        help="BED file of regions to keep. Alignments not overlapping a region are dropped, as for 'samtools view -L' (default: '').",
+    )
+    argParser.add_argument(
+        "-mf",
+        "--max_fragment",
+        type=int,
+        dest="MAX_FRAGMENT",
+        default=0,
+        help="Drop alignments with |TLEN| greater than this value. 0 disables the filter (default: 0).",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of BGZF compression/decompression threads (default: 1).",
+    )
+    argParser.add_argument(
+        "-sf",
+        "--stats_file",
+        dest="STATS_FILE",
+        default="",
+        help="Write per-filter drop counts to this tab-delimited file for MultiQC (default: '').",
+    )
+    argParser.add_argument(
+        "-sn",
+        "--sample_name",
+        dest="SAMPLE_NAME",
+        default="",
+        help="Sample name written to --stats_file (default: input file name).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## Filters in the order they are tested. Each dropped alignment is counted against the first filter it fails.
+FILTER_COLUMNS = ["passed", "flag", "duplicate", "mapq", "region", "fragment_length"]
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def load_regions(BedFile, bamHeader):
+    """
+    Read a BED file into per-reference sorted, merged (starts, ends) lists indexed by BAM reference id.
+    References without regions map to None so every alignment on them is dropped, as with 'samtools view -L'.
+    """
+    intervalDict = {}
+    fin = open(BedFile, "r")
+    for line in fin:
+        if not line.strip() or line.startswith(("#", "track", "browser")):
+            continue
+        lspl = line.strip().split("\t")
+        intervalDict.setdefault(lspl[0], []).append((int(lspl[1]), int(lspl[2])))
+    fin.close()
+
+    regions = [None] * bamHeader.nreferences
+    for tid, chrom in enumerate(bamHeader.references):
+        if chrom not in intervalDict:
+            continue
+        starts = []
+        ends = []
+        for start, end in sorted(intervalDict[chrom]):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        regions[tid] = (starts, ends)
+    return regions
+
+
+def add_program_record(bamHeader, commandLine):
+    """Return a header dict with a @PG line for this tool chained onto the last existing program record."""
+    headerDict = bamHeader.to_dict()
+    pgList = headerDict.get("PG", [])
+    pgIds = set([pg.get("ID") for pg in pgList])
+    pgId = "bam_filter.py"
+    idx = 1
+    while pgId in pgIds:
+        pgId = "bam_filter.py.{}".format(idx)
+        idx += 1
+    pgRecord = {"ID": pgId, "PN": "bam_filter.py", "CL": commandLine}
+    if pgList:
+        pgRecord["PP"] = pgList[-1]["ID"]
+    headerDict["PG"] = pgList + [pgRecord]
+    return headerDict
+
+
+def write_stats_file(counts, SampleName, StatsFile):
+    makedir(os.path.dirname(StatsFile))
+    fout = open(StatsFile, "w")
+    fout.write("\t".join(["Sample"] + FILTER_COLUMNS) + "\n")
+    fout.write("\t".join([SampleName] + [str(counts[x]) for x in FILTER_COLUMNS]) + "\n")
+    fout.close()
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def bam_filter(
+    BAMIn,
+    BAMOut,
+    excludeFlags=0,
+    requireFlags=0,
+    removeDuplicates=False,
+    minMapq=0,
+    RegionFile="",
+    maxFragment=0,
+    threads=1,
+    commandLine="",
+):
+    """
+    Stream BAMIn to BAMOut keeping alignments that pass every filter and return a dict of per-filter counts.
+    Equivalent to 'samtools view -F -f [-F 0x400] [-L]' followed by 'samtools view -q' and an |TLEN| cut,
+    without the intermediate BAM or the SAM text round-trip.
+    """
+    counts = dict([(x, 0) for x in FILTER_COLUMNS])
+    flagMask = excludeFlags & ~0x400
+    dupMask = 0x400 if removeDuplicates or excludeFlags & 0x400 else 0
+
+    inBam = pysam.AlignmentFile(BAMIn, "rb", threads=threads)
+    regions = load_regions(RegionFile, inBam.header) if RegionFile else None
+    makedir(os.path.dirname(BAMOut))
+    outBam = pysam.AlignmentFile(BAMOut, "wb", header=add_program_record(inBam.header, commandLine), threads=threads)
+
+    ## Per-reference interval lists are looked up once per reference change since input is usually coordinate-sorted
+    lastTid = -2
+    starts = ends = None
+    for read in inBam.fetch(until_eof=True):
+        flag = read.flag
+        if flag & flagMask or (flag & requireFlags) != requireFlags:
+            counts["flag"] += 1
+            continue
+        if flag & dupMask:
+            counts["duplicate"] += 1
+            continue
+        if read.mapping_quality < minMapq:
+            counts["mapq"] += 1
+            continue
+        if regions is not None:
+            tid = read.reference_id
+            if tid != lastTid:
+                lastTid = tid
+                starts, ends = regions[tid] if tid >= 0 and regions[tid] else (None, None)
+            if starts is None:
+                counts["region"] += 1
+                continue
+            readStart = read.reference_start
+            readEnd = read.reference_end or readStart + 1
+            idx = bisect.bisect_left(starts, readEnd) - 1
+            if idx < 0 or ends[idx] <= readStart:
+                counts["region"] += 1
+                continue
+        if maxFragment and abs(read.template_length) > maxFragment:
+            counts["fragment_length"] += 1
+            continue
+        counts["passed"] += 1
+        outBam.write(read)
+
+    outBam.close()
+    inBam.close()
+    return counts
+
+
+def main(args=None):
+    commandLine = " ".join(["bam_filter.py"] + (sys.argv[1:] if args is None else list(args)))
+    args = parse_args(args)
+    startTime = time.time()
+    counts = bam_filter(
+        BAMIn=args.BAM_INPUT_FILE,
+        BAMOut=args.BAM_OUTPUT_FILE,
+        excludeFlags=args.EXCLUDE_FLAGS,
+        requireFlags=args.REQUIRE_FLAGS,
+        removeDuplicates=args.REMOVE_DUPLICATES,
+        minMapq=args.MIN_MAPQ,
+        RegionFile=args.REGIONS,
+        maxFragment=args.MAX_FRAGMENT,
+        threads=args.THREADS,
+        commandLine=commandLine,
+    )
+    if args.STATS_FILE:
+        sampleName = args.SAMPLE_NAME or os.path.basename(args.BAM_INPUT_FILE)
+        write_stats_file(counts, sampleName, args.STATS_FILE)
+
+    total = sum(counts.values())
+    elapsed = max(time.time() - startTime, 1e-6)
+    print(
+        "Kept {} of {} alignments ({}) in {:.1f}s ({:.0f} reads/sec), peak memory {:.1f} MB".format(
+            counts["passed"],
+            total,
+            ", ".join(["{} {}".format(x, counts[x]) for x in FILTER_COLUMNS[1:]]),
+            elapsed,
+            total / elapsed,
+            peak_memory_mb(),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Single-pass BAM QC metrics for MultiQC
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import argparse
+import itertools
+import resource
+import multiprocessing
+
+import numpy as np
+import pysam
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Collect flag counts, per-chromosome counts, MAPQ and insert size distributions and a fingerprint curve from "
+        "a BAM file in a single pass and write them as MultiQC custom content tables."
+    )
+    Epilog = """Example usage: python bam_qc.py <BAM_FILE> <OUTPUT_PREFIX> --sample_name SAMPLE_R1 --skip_zeros --threads 4"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument(
+        "BAM_FILE", help="Coordinate-sorted BAM file. A .bai/.csi index enables parallel per-chromosome collection."
+    )
+    argParser.add_argument(
+        "OUTPUT_PREFIX",
+        help="Prefix for the '<OUTPUT_PREFIX>.bam_qc_<table>.tsv' files, one per table in {}.".format(
+            ", ".join(["'{}'".format(x) for x in TABLES])
+        ),
+    )
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-sn",
+        "--sample_name",
+        type=str,
+        dest="SAMPLE_NAME",
+        default="",
+        help="Sample name written to the tables (default: BAM file name without extension).",
+    )
+    argParser.add_argument(
+        "-bs",
+        "--bin_size",
+        type=int,
+        dest="BIN_SIZE",
+        default=500,
+        help="Size of the genomic bins in bp used for the fingerprint curve, as for 'plotFingerprint --binSize' (default: 500).",
+    )
+    argParser.add_argument(
+        "-sz",
+        "--skip_zeros",
+        dest="SKIP_ZEROS",
+        action="store_true",
+        help="Ignore bins without reads in the fingerprint curve, as for 'plotFingerprint --skipZeros'.",
+    )
+    argParser.add_argument(
+        "-mi",
+        "--max_insert_size",
+        type=int,
+        dest="MAX_INSERT_SIZE",
+        default=1000,
+        help="Largest insert size in bp in the insert size histogram. Larger inserts are counted in the summary table only (default: 1000).",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of chromosomes processed in parallel (default: 1).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## Tables written for each BAM file, in the order the MultiQC header files are named
+TABLES = ["stats", "chroms", "mapq", "insert_size", "fingerprint"]
+
+## Flag counts as reported by 'samtools flagstat'; paired-end counts only consider primary alignments
+## Duplicates are not counted as the filtered BAM has them removed; MarkDuplicates reports the duplication rate
+FLAG_COUNTS = [
+    "total",
+    "primary",
+    "secondary",
+    "supplementary",
+    "mapped",
+    "primary_mapped",
+    "paired",
+    "read1",
+    "read2",
+    "properly_paired",
+    "both_mapped",
+    "singletons",
+    "mate_diff_chr",
+    "mate_diff_chr_mapq5",
+]
+(
+    TOTAL,
+    PRIMARY,
+    SECONDARY,
+    SUPPLEMENTARY,
+    MAPPED,
+    PRIMARY_MAPPED,
+    PAIRED,
+    READ1,
+    READ2,
+    PROPERLY_PAIRED,
+    BOTH_MAPPED,
+    SINGLETONS,
+    MATE_DIFF_CHR,
+    MATE_DIFF_CHR_MAPQ5,
+) = range(len(FLAG_COUNTS))
+
+## Number of points along the fingerprint curve
+FINGERPRINT_POINTS = 100
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class QCAccumulator:
+    """
+    Fixed-size accumulators for the alignments of one or more chromosomes. Accumulators of different chromosomes
+    are combined with merge(), so the fingerprint is kept as a histogram of reads per bin rather than the bins.
+    """
+
+    def __init__(self, numChroms, maxInsertSize):
+        ## Flag counts for QC-passed (row 0) and QC-failed (row 1) alignments
+        self.flags = np.zeros((2, len(FLAG_COUNTS)), dtype=np.int64)
+        self.chroms = np.zeros(numChroms, dtype=np.int64)
+        self.mapq = np.zeros(256, dtype=np.int64)
+        self.insertSizes = np.zeros(maxInsertSize + 1, dtype=np.int64)
+        self.longInserts = 0
+        self.binReads = np.zeros(1, dtype=np.int64)
+
+    def merge(self, other):
+        self.flags += other.flags
+        self.chroms += other.chroms
+        self.mapq += other.mapq
+        self.insertSizes += other.insertSizes
+        self.longInserts += other.longInserts
+        self.merge_bins(other.binReads)
+        return self
+
+    def add_reads(self, reads, chromLength, binSize):
+        """Accumulate an iterator of alignments from one chromosome (chromLength 0 for unplaced reads)."""
+        flags = [[0] * len(FLAG_COUNTS), [0] * len(FLAG_COUNTS)]
+        mapq = [0] * 256
+        insertSizes = []
+        starts = []
+        chromCounts = {}
+        for read in reads:
+            flag = read.flag
+            counts = flags[1 if flag & 0x200 else 0]
+            counts[TOTAL] += 1
+            mapped = not flag & 0x4
+            if mapped:
+                counts[MAPPED] += 1
+                chromCounts[read.reference_id] = chromCounts.get(read.reference_id, 0) + 1
+            if flag & 0x100:
+                counts[SECONDARY] += 1
+                continue
+            if flag & 0x800:
+                counts[SUPPLEMENTARY] += 1
+                continue
+            counts[PRIMARY] += 1
+            if mapped:
+                counts[PRIMARY_MAPPED] += 1
+                mapq[read.mapping_quality] += 1
+                starts.append(read.reference_start)
+            if flag & 0x1:
+                counts[PAIRED] += 1
+                if flag & 0x40:
+                    counts[READ1] += 1
+                if flag & 0x80:
+                    counts[READ2] += 1
+                if not mapped:
+                    continue
+                if flag & 0x2:
+                    counts[PROPERLY_PAIRED] += 1
+                    ## Count each pair once, from the leftmost mate
+                    if read.template_length > 0:
+                        insertSizes.append(read.template_length)
+                if flag & 0x8:
+                    counts[SINGLETONS] += 1
+                    continue
+                counts[BOTH_MAPPED] += 1
+                if read.next_reference_id != read.reference_id:
+                    counts[MATE_DIFF_CHR] += 1
+                    if read.mapping_quality >= 5:
+                        counts[MATE_DIFF_CHR_MAPQ5] += 1
+
+        self.flags += np.array(flags, dtype=np.int64)
+        self.mapq += np.array(mapq, dtype=np.int64)
+        for tid, count in chromCounts.items():
+            if tid >= 0:
+                self.chroms[tid] += count
+        if insertSizes:
+            insertSizes = np.array(insertSizes, dtype=np.int64)
+            self.longInserts += int(np.count_nonzero(insertSizes >= len(self.insertSizes)))
+            insertSizes = insertSizes[insertSizes < len(self.insertSizes)]
+            self.insertSizes += np.bincount(insertSizes, minlength=len(self.insertSizes))
+        if chromLength:
+            ## Reads per bin along the chromosome, then the number of bins holding each read count
+            binCounts = np.bincount(np.array(starts, dtype=np.int64) // binSize, minlength=chromLength // binSize + 1)
+            self.merge_bins(np.bincount(binCounts))
+        return self
+
+    def merge_bins(self, binReads):
+        if len(binReads) > len(self.binReads):
+            binReads = binReads.copy()
+            binReads[: len(self.binReads)] += self.binReads
+            self.binReads = binReads
+        else:
+            self.binReads[: len(binReads)] += binReads
+
+
+def collect_chromosome(task):
+    """Pool worker: accumulate one chromosome of an indexed BAM file, or its unplaced reads for chrom '*'."""
+    BAMFile, chrom, chromLength, binSize, maxInsertSize = task
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    accumulator = QCAccumulator(bam.nreferences, maxInsertSize)
+    accumulator.add_reads(bam.fetch(chrom), chromLength, binSize)
+    bam.close()
+    return accumulator
+
+
+def fingerprint_curve(binReads, skipZeros=False, numPoints=FINGERPRINT_POINTS):
+    """
+    Cumulative fraction of reads in the lowest ranked fraction of bins at numPoints + 1 evenly spaced ranks, as plotted
+    by 'plotFingerprint', from a histogram of the number of bins holding each read count.
+    """
+    binReads = np.array(binReads, dtype=np.float64)
+    if skipZeros:
+        binReads[0] = 0
+    readCounts = np.arange(len(binReads), dtype=np.float64)
+    cumBins = np.concatenate([[0.0], np.cumsum(binReads)])
+    cumReads = np.concatenate([[0.0], np.cumsum(binReads * readCounts)])
+    ranks = np.linspace(0, 1, numPoints + 1)
+    if not cumBins[-1] or not cumReads[-1]:
+        return ranks, np.zeros(len(ranks))
+    ## Bins are ordered by read count, so the curve is linear within the bins sharing a read count
+    rankBins = ranks * cumBins[-1]
+    idx = np.clip(np.searchsorted(cumBins, rankBins, side="right") - 1, 0, len(readCounts) - 1)
+    reads = cumReads[idx] + (rankBins - cumBins[idx]) * readCounts[idx]
+    return ranks, np.minimum(reads / cumReads[-1], 1.0)
+
+
+def weighted_median(values, weights):
+    if not weights.sum():
+        return 0
+    return int(values[np.searchsorted(np.cumsum(weights), weights.sum() / 2.0)])
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def bam_qc(BAMFile, binSize=500, maxInsertSize=1000, threads=1):
+    """
+    Return (chromosome names, QCAccumulator) for every alignment in BAMFile.
+
+    With a BAM index every chromosome, and the unplaced reads, is accumulated independently in a process pool and
+    the fixed-size accumulators are merged. Without an index the BAM is streamed once in a single process.
+    """
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    chromSizes = list(zip(bam.references, bam.lengths))
+    accumulator = QCAccumulator(len(chromSizes), maxInsertSize)
+    if bam.has_index():
+        tasks = [(BAMFile, chrom, length, binSize, maxInsertSize) for chrom, length in chromSizes]
+        if bam.nocoordinate:
+            tasks.append((BAMFile, "*", 0, binSize, maxInsertSize))
+        bam.close()
+        ## Largest chromosomes first so the pool is not left waiting on a big one at the end
+        tasks.sort(key=lambda x: -x[2])
+        if threads > 1:
+            pool = multiprocessing.Pool(processes=threads)
+            results = pool.imap_unordered(collect_chromosome, tasks)
+        else:
+            pool = None
+            results = map(collect_chromosome, tasks)
+        for chromAccumulator in results:
+            accumulator.merge(chromAccumulator)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    else:
+        print("WARNING: No index found for {}, collecting in a single pass without parallelism.".format(BAMFile))
+        for tid, reads in itertools.groupby(bam.fetch(until_eof=True), key=lambda x: x.reference_id):
+            chromLength = chromSizes[tid][1] if tid >= 0 else 0
+            accumulator.add_reads(reads, chromLength, binSize)
+        bam.close()
+    return [x[0] for x in chromSizes], accumulator
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def qc_tables(sampleName, chroms, accumulator, skipZeros=False):
+    """Return {table: (header, [row])} for the MultiQC tables. Distribution tables have one column per x value."""
+    flags = dict(zip(FLAG_COUNTS, accumulator.flags[0].tolist()))
+    primaryMapped = flags["primary_mapped"]
+    ranks, fingerprint = fingerprint_curve(accumulator.binReads, skipZeros=skipZeros)
+    mapqValues = np.arange(len(accumulator.mapq))
+    stats = [
+        ("Total", flags["total"]),
+        ("Mapped", flags["mapped"]),
+        ("Primary mapped", primaryMapped),
+        ("Secondary", flags["secondary"]),
+        ("Supplementary", flags["supplementary"]),
+        ("Properly paired", flags["properly_paired"]),
+        ("Singletons", flags["singletons"]),
+        ("Mate on different chromosome", flags["mate_diff_chr"]),
+        ("QC failed", int(accumulator.flags[1][TOTAL])),
+        ("Median MAPQ", weighted_median(mapqValues, accumulator.mapq)),
+        ("Median insert size", weighted_median(np.arange(len(accumulator.insertSizes)), accumulator.insertSizes)),
+        ("Inserts above histogram", accumulator.longInserts),
+        ## Equivalent to 1 minus the fingerprint curve at 99% of the bins
+        ("Reads in top 1% bins", "%.4f" % (1.0 - fingerprint[-2])),
+    ]
+
+    tables = {}
+    tables["stats"] = (["Sample"] + [x[0] for x in stats], [sampleName] + [str(x[1]) for x in stats])
+    chromIdx = np.nonzero(accumulator.chroms)[0]
+    tables["chroms"] = (
+        ["Sample"] + [chroms[x] for x in chromIdx],
+        [sampleName] + [str(accumulator.chroms[x]) for x in chromIdx],
+    )
+    mapqIdx = np.arange(np.max(np.nonzero(accumulator.mapq)[0], initial=0) + 1)
+    tables["mapq"] = (
+        ["Sample"] + [str(x) for x in mapqIdx],
+        [sampleName] + [str(accumulator.mapq[x]) for x in mapqIdx],
+    )
+    insertIdx = np.nonzero(accumulator.insertSizes)[0]
+    tables["insert_size"] = (
+        ["Sample"] + [str(x) for x in insertIdx],
+        [sampleName] + [str(accumulator.insertSizes[x]) for x in insertIdx],
+    )
+    tables["fingerprint"] = (
+        ["Sample"] + ["%.2f" % x for x in ranks],
+        [sampleName] + ["%.6f" % x for x in fingerprint],
+    )
+    return tables
+
+
+def main(args=None):
+    args = parse_args(args)
+    startTime = time.time()
+    if args.BIN_SIZE <= 0:
+        print("ERROR: --bin_size must be a positive integer!")
+        sys.exit(1)
+    chroms, accumulator = bam_qc(
+        args.BAM_FILE, binSize=args.BIN_SIZE, maxInsertSize=max(args.MAX_INSERT_SIZE, 0), threads=args.THREADS
+    )
+
+    sampleName = args.SAMPLE_NAME or os.path.splitext(os.path.basename(args.BAM_FILE))[0]
+    tables = qc_tables(sampleName, chroms, accumulator, skipZeros=args.SKIP_ZEROS)
+    makedir(os.path.dirname(args.OUTPUT_PREFIX))
+    for table in TABLES:
+        header, row = tables[table]
+        fout = open("{}.bam_qc_{}.tsv".format(args.OUTPUT_PREFIX, table), "w")
+        fout.write("\t".join(header) + "\n")
+        fout.write("\t".join(row) + "\n")
+        fout.close()
+
+    print(
+        "Collected QC metrics for {} alignments in {:.1f}s, peak memory {:.1f} MB".format(
+            int(accumulator.flags.sum(axis=0)[TOTAL]), time.time() - startTime, peak_memory_mb()
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -5,6 +5,23 @@ import sys
 import errno
 import argparse
 import re
+import gzip
+import zlib
+import json
+import time
+import hashlib
+import contextlib
+import concurrent.futures
+
+try:
+    from result_cache import cached_run
+except ImportError:
+    cached_run = None
+
+try:
+    from perf_stats import PerfRecorder
+except ImportError:
+    PerfRecorder = None
 
 
 def parse_args(args=None):
@@ -14,6 +31,53 @@ def parse_args(args=None):
     parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
     parser.add_argument("FILE_IN", help="Input samplesheet file.")
     parser.add_argument("FILE_OUT", help="Output file.")
+    parser.add_argument(
+        "--cache_dir",
+        default="",
+        help="Restore the output from, or add it to, the result cache in this directory keyed on the samplesheet contents.",
+    )
+    parser.add_argument(
+        "--cache_max_size", type=int, default=10240, help="Maximum size of --cache_dir in MB (default: 10240)."
+    )
+    parser.add_argument(
+        "--validate_fastq",
+        action="store_true",
+        help="Check that every local FastQ file is a readable gzip file in FastQ format and that paired files have matching read names.",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=4, help="Number of FastQ files validated concurrently (default: 4)."
+    )
+    parser.add_argument(
+        "--head_reads",
+        type=int,
+        default=1000,
+        help="Number of reads checked at the start of each FastQ file (default: 1000).",
+    )
+    parser.add_argument(
+        "--full_check",
+        action="store_true",
+        help="Decompress each FastQ file completely to verify every read and the gzip CRC32 and length trailer.",
+    )
+    parser.add_argument(
+        "--validation_cache",
+        default="",
+        help="JSON file of FastQ files that passed validation keyed by path, size and modification time (default: '').",
+    )
+    parser.add_argument(
+        "--timings_file",
+        default="",
+        help="Write the validation time of each FastQ file to this TSV file (default: '').",
+    )
+    parser.add_argument(
+        "--perf_file",
+        default="",
+        help="Write the time, rows processed and peak memory of each phase of the check to this *.perf.json file (default: '').",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Also profile the check with cProfile and trace allocations with tracemalloc for --perf_file.",
+    )
     return parser.parse_args(args)
 
 
@@ -36,223 +100,502 @@ def print_error(error, context="Line", context_str=""):
     sys.exit(1)
 
 
-def check_samplesheet(file_in, file_out):
+def perf_phase(perf, name):
+    """Time the body of a with statement as phase name of the PerfRecorder perf, if any."""
+    return perf.phase(name) if perf is not None else contextlib.nullcontext()
+
+
+## Sample names may only contain alphanumeric characters, underscores, dots and dashes
+SAMPLE_NAME_REGEX = re.compile(r"^[a-zA-Z0-9_.-]+$")
+
+## Empty BGZF block written at the end of every complete bgzip/htslib compressed file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def fastq_read_name(header):
+    """Normalise a FastQ header to the read name shared by both mates e.g. '@SRR1/1 1:N:0' -> 'SRR1'."""
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else ""
+    if name.endswith(("/1", "/2")):
+        name = name[:-2]
+    return name
+
+
+def check_fastq_file(fastq, head_reads=1000, full_check=False):
     """
-    This function checks that the samplesheet follows the following structure:
-    sample,fastq_1,fastq_2,replicate,antibody,control,control_replicate
-    SPT5_T0,SRR1822153_1.fastq.gz,SRR1822153_2.fastq.gz,SPT5,1,SPT5_INPUT,1
-    SPT5_T0,SRR1822154_1.fastq.gz,SRR1822154_2.fastq.gz,SPT5,2,SPT5_INPUT,2
-    SPT5_INPUT,SRR5204809_Spt5-ChIP_Input1_SacCer_ChIP-Seq_ss100k_R1.fastq.gz,SRR5204809_Spt5-ChIP_Input1_SacCer_ChIP-Seq_ss100k_R2.fastq.gz,1,,,
-    SPT5_INPUT,SRR5204810_Spt5-ChIP_Input2_SacCer_ChIP-Seq_ss100k_R1.fastq.gz,SRR5204810_Spt5-ChIP_Input2_SacCer_ChIP-Seq_ss100k_R2.fastq.gz,2,,,
-    For an example see:
-    https://raw.githubusercontent.com/nf-core/test-datasets/chipseq/samplesheet/v2.1/samplesheet_test.csv
+    Check that a gzipped FastQ file is readable without decompressing all of it.
+    The first head_reads records are decompressed and checked for the 4-line FastQ structure and a
+    digest of their read names is recorded so that fastq_1 and fastq_2 can be compared. For BGZF
+    files the end-of-file block is checked by seeking to the end of the file. Plain gzip files only
+    carry a CRC32 and length trailer that cannot be verified without decompressing the whole stream,
+    which is what full_check does for all files.
+    Returns a dict with the error (None if valid), number of reads checked and whether the whole file was read.
     """
+    result = {"error": None, "reads": 0, "names": "", "complete": False}
+    if not os.path.isfile(fastq):
+        result["error"] = "FastQ file does not exist!"
+        return result
+    if os.path.getsize(fastq) == 0:
+        result["error"] = "FastQ file is empty!"
+        return result
 
-    sample_mapping_dict = {}
-    with open(file_in, "r", encoding="utf-8-sig") as fin:
-        ## Check header
-        MIN_COLS = 3
-        HEADER = ["sample", "fastq_1", "fastq_2", "replicate", "antibody", "control", "control_replicate"]
-        header = [x.strip('"') for x in fin.readline().strip().split(",")]
-        if header[: len(HEADER)] != HEADER:
-            print(f"ERROR: Please check samplesheet header -> {','.join(header)} != {','.join(HEADER)}")
-            sys.exit(1)
-
-        ## Check sample entries
-        for line_number, line in enumerate(fin, start=1):
-            if line.strip():
-                lspl = [x.strip().strip('"') for x in line.strip().split(",")]
-
-                # Check valid number of columns per row
-                if len(lspl) < len(HEADER):
-                    print_error(
-                        "Invalid number of columns (found = {}, minimum = {})!".format(len(lspl),len(HEADER)),
-                        "Line {}".format(line_number),
-                        line,
+    with open(fastq, "rb") as fin:
+        magic = fin.read(18)
+        if magic[:2] != b"\x1f\x8b":
+            result["error"] = "FastQ file is not gzip compressed!"
+            return result
+        ## FEXTRA flag with a 'BC' subfield identifies a BGZF file
+        if magic[3] & 4 and magic[12:14] == b"BC":
+            fin.seek(-len(BGZF_EOF), os.SEEK_END)
+            if fin.read() != BGZF_EOF:
+                result["error"] = "FastQ file is truncated (missing BGZF end-of-file block)!"
+                return result
+
+    names = hashlib.sha1()
+    try:
+        with gzip.open(fastq, "rb") as fin:
+            while full_check or result["reads"] < head_reads:
+                record = [fin.readline() for x in range(4)]
+                if not record[0]:
+                    result["complete"] = True
+                    break
+                if not record[3]:
+                    result["error"] = "FastQ file ends with an incomplete record after {} reads!".format(
+                        result["reads"]
                     )
-                num_cols = len([x for x in lspl[: len(HEADER)] if x])
-                if num_cols < MIN_COLS:
-                    print_error(
-                        "Invalid number of populated columns (found = {}, minimum = {})!".format(num_cols,MIN_COLS),
-                        "Line {}".format(line_number),
-                        line,
+                    return result
+                header, seq, plus, qual = [x.rstrip(b"\r\n") for x in record]
+                if not header.startswith(b"@") or not plus.startswith(b"+"):
+                    result["error"] = "FastQ record {} does not start with '@' and '+' lines!".format(
+                        result["reads"] + 1
+                    )
+                    return result
+                if len(seq) != len(qual):
+                    result["error"] = "FastQ record {} has sequence and quality strings of different lengths!".format(
+                        result["reads"] + 1
+                    )
+                    return result
+                names.update(fastq_read_name(header.decode("utf-8", "replace")).encode() + b"\n")
+                result["reads"] += 1
+    except (OSError, EOFError, zlib.error) as exception:
+        result["error"] = "FastQ file is not a valid gzip file or is truncated ({})!".format(exception)
+        return result
+    result["names"] = names.hexdigest()
+    return result
+
+
+def load_validation_cache(cache_file):
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "r") as fin:
+                return json.load(fin)
+        except ValueError:
+            print("WARNING: Ignoring unreadable FastQ validation cache: {}".format(cache_file))
+    return {}
+
+
+def save_validation_cache(cache_file, cache):
+    """Write the cache to a temporary file first so concurrent runs never read a partial file."""
+    make_dir(os.path.dirname(cache_file))
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp_file, "w") as fout:
+        json.dump(cache, fout, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+
+
+def validate_fastq_files(rows, threads=4, head_reads=1000, full_check=False, cache_file="", timings_file=""):
+    """
+    Check every FastQ file in rows = [(line_number, line, fastq_1, fastq_2), ...] concurrently in a thread pool
+    and check that the read names of paired files match. Results are cached by path, size and modification
+    time so unchanged files are not read again on a rerun. All errors are reported before exiting.
+    """
+    start_time = time.time()
+    fastq_files = []
+    for line_number, line, fastq_1, fastq_2 in rows:
+        for fastq in [fastq_1, fastq_2]:
+            if fastq and fastq not in fastq_files:
+                fastq_files.append(fastq)
+    remote_files = [x for x in fastq_files if "://" in x]
+    if remote_files:
+        print("WARNING: Skipping validation of {} remote FastQ files.".format(len(remote_files)))
+    local_files = [x for x in fastq_files if "://" not in x]
+
+    cache = load_validation_cache(cache_file)
+    results = {}
+    to_check = []
+    for fastq in local_files:
+        key = os.path.abspath(fastq)
+        entry = cache.get(key)
+        if entry is not None and os.path.isfile(fastq):
+            stat = os.stat(fastq)
+            if [entry["size"], entry["mtime_ns"], entry["head_reads"], entry["full_check"]] == [
+                stat.st_size,
+                stat.st_mtime_ns,
+                head_reads,
+                full_check,
+            ]:
+                results[fastq] = dict(entry["result"], seconds=0.0, cached=True)
+                continue
+        to_check.append(fastq)
+
+    def run_check(fastq):
+        check_start = time.time()
+        result = check_fastq_file(fastq, head_reads=head_reads, full_check=full_check)
+        result["seconds"] = time.time() - check_start
+        result["cached"] = False
+        return result
+
+    ## zlib releases the GIL while decompressing so threads are enough to read files in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        for fastq, result in zip(to_check, executor.map(run_check, to_check)):
+            results[fastq] = result
+            if result["error"] is None:
+                stat = os.stat(fastq)
+                cache[os.path.abspath(fastq)] = {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "head_reads": head_reads,
+                    "full_check": full_check,
+                    "result": {x: result[x] for x in ["error", "reads", "names", "complete"]},
+                }
+    if cache_file and to_check:
+        save_validation_cache(cache_file, cache)
+
+    if timings_file:
+        make_dir(os.path.dirname(timings_file))
+        with open(timings_file, "w") as fout:
+            fout.write("fastq\tsize_bytes\treads_checked\tseconds\tcached\tstatus\n")
+            for fastq in local_files:
+                result = results[fastq]
+                size = os.path.getsize(fastq) if os.path.isfile(fastq) else 0
+                status = "PASS" if result["error"] is None else "FAIL"
+                fout.write(
+                    "{}\t{}\t{}\t{:.3f}\t{}\t{}\n".format(
+                        fastq, size, result["reads"], result["seconds"], str(result["cached"]).lower(), status
                     )
+                )
+
+    ## Collect all errors so that a broken samplesheet can be fixed in one go
+    errors = []
+    for line_number, line, fastq_1, fastq_2 in rows:
+        row_errors = []
+        for fastq in [fastq_1, fastq_2]:
+            if fastq in results and results[fastq]["error"] is not None:
+                row_errors.append("{} {}".format(fastq, results[fastq]["error"]))
+        if not row_errors and fastq_2 and fastq_1 in results and fastq_2 in results:
+            result_1 = results[fastq_1]
+            result_2 = results[fastq_2]
+            if result_1["reads"] != result_2["reads"] and (result_1["complete"] or result_2["complete"]):
+                row_errors.append(
+                    "fastq_1 and fastq_2 have different numbers of reads ({} != {})!".format(
+                        result_1["reads"], result_2["reads"]
+                    )
+                )
+            elif result_1["names"] != result_2["names"]:
+                row_errors.append(
+                    "Read names of fastq_1 and fastq_2 do not match in the first {} reads!".format(result_1["reads"])
+                )
+        for error in row_errors:
+            errors.append(
+                "ERROR: Please check samplesheet -> {}\nLine {}: '{}'".format(error, line_number, line.strip())
+            )
+
+    print(
+        "Validated {} FastQ files in {:.1f}s ({} from cache)".format(
+            len(local_files), time.time() - start_time, len(local_files) - len(to_check)
+        )
+    )
+    if errors:
+        print("\n".join(errors))
+        sys.exit(1)
+
+
+## Samplesheet columns and minimum number of populated columns per row
+HEADER = ["sample", "fastq_1", "fastq_2", "replicate", "antibody", "control", "control_replicate"]
+MIN_COLS = 3
+
+
+def iter_samplesheet_rows(fin):
+    """
+    Check the header and each row of an open samplesheet as it is read.
+    Yields (line_number, line, sample, replicate, sample_info, fastq_1, fastq_2) for every row, where
+    sample_info = [single_end, fastq_1, fastq_2, replicate, antibody, control] followed by any extra columns.
+    """
+    header = [x.strip('"') for x in fin.readline().strip().split(",")]
+    if header[: len(HEADER)] != HEADER:
+        print(f"ERROR: Please check samplesheet header -> {','.join(header)} != {','.join(HEADER)}")
+        sys.exit(1)
+
+    ## Check sample entries
+    for line_number, line in enumerate(fin, start=1):
+        if not line.strip():
+            continue
+        lspl = [x.strip().strip('"') for x in line.strip().split(",")]
 
-                ## Check sample name entries
-                sample, fastq_1, fastq_2, replicate, antibody, control, control_replicate = lspl[: len(HEADER)]
-                if sample.find(" ") != -1:
-                    print(f"WARNING: Spaces have been replaced by underscores for sample: {sample}")
-                    sample = sample.replace(" ", "_")
-                if not sample:
-                    print_error("Sample entry has not been specified!", "Line {}".format(line_number), line)
-                if not re.match(r"^[a-zA-Z0-9_.-]+$", sample):
+        # Check valid number of columns per row
+        if len(lspl) < len(HEADER):
+            print_error(
+                "Invalid number of columns (found = {}, minimum = {})!".format(len(lspl), len(HEADER)),
+                "Line {}".format(line_number),
+                line,
+            )
+        num_cols = len([x for x in lspl[: len(HEADER)] if x])
+        if num_cols < MIN_COLS:
+            print_error(
+                "Invalid number of populated columns (found = {}, minimum = {})!".format(num_cols, MIN_COLS),
+                "Line {}".format(line_number),
+                line,
+            )
+
+        ## Check sample name entries
+        sample, fastq_1, fastq_2, replicate, antibody, control, control_replicate = lspl[: len(HEADER)]
+        if sample.find(" ") != -1:
+            print(f"WARNING: Spaces have been replaced by underscores for sample: {sample}")
+            sample = sample.replace(" ", "_")
+        if not sample:
+            print_error("Sample entry has not been specified!", "Line {}".format(line_number), line)
+        if not SAMPLE_NAME_REGEX.match(sample):
+            print_error(
+                "Sample name contains invalid characters! Only alphanumeric characters, underscores, dots and dashes are allowed.",
+                "Line {}".format(line_number),
+                line,
+            )
+
+        ## Check FastQ file extension
+        for fastq in [fastq_1, fastq_2]:
+            if fastq:
+                if fastq.find(" ") != -1:
+                    print_error("FastQ file contains spaces!", "Line {}".format(line_number), line)
+                if not fastq.endswith(".fastq.gz") and not fastq.endswith(".fq.gz"):
                     print_error(
-                        "Sample name contains invalid characters! Only alphanumeric characters, underscores, dots and dashes are allowed.",
+                        "FastQ file does not have extension '.fastq.gz' or '.fq.gz'!",
                         "Line {}".format(line_number),
                         line,
                     )
 
-                ## Check FastQ file extension
-                for fastq in [fastq_1, fastq_2]:
-                    if fastq:
-                        if fastq.find(" ") != -1:
-                            print_error("FastQ file contains spaces!", "Line {}".format(line_number), line)
-                        if not fastq.endswith(".fastq.gz") and not fastq.endswith(".fq.gz"):
-                            print_error(
-                                "FastQ file does not have extension '.fastq.gz' or '.fq.gz'!",
-                                "Line {}".format(line_number),
-                                line,
-                            )
-
-                ## Check replicate column is integer
-                if not replicate.isdecimal():
-                    print_error("Replicate id not an integer!", "Line {}".format(line_number), line)
-                    sys.exit(1)
-
-                ## Check antibody and control columns have valid values
-                if antibody:
-                    if antibody.find(" ") != -1:
-                        print(f"WARNING: Spaces have been replaced by underscores for antibody: {antibody}")
-                        antibody = antibody.replace(" ", "_")
-                    if not control:
-                        print_error(
-                            "Both antibody and control columns must be specified!",
-                            "Line {}".format(line_number),
-                            line,
-                        )
-
-                if control:
-                    if control.find(" ") != -1:
-                        print(f"WARNING: Spaces have been replaced by underscores for control: {control}")
-                        control = control.replace(" ", "_")
-                    if not control_replicate.isdecimal():
-                        print_error("Control replicate id not an integer!", "Line {}".format(line_number), line)
-                        sys.exit(1)
-                    control = "{}_REP{}".format(control, control_replicate)
-                    if not antibody:
-                        print_error(
-                            "Both antibody and control columns must be specified!",
-                            "Line {}".format(line_number),
-                            line,
-                        )
-
-                ## Auto-detect paired-end/single-end
-                sample_info = []  ## [single_end, fastq_1, fastq_2, replicate, antibody, control]
-                ## Paired-end short reads
-                if sample and fastq_1 and fastq_2:
-                    sample_info = ["0", fastq_1, fastq_2, replicate, antibody, control]
-                ## Single-end short reads
-                elif sample and fastq_1 and not fastq_2:
-                    sample_info = ["1", fastq_1, fastq_2, replicate, antibody, control]
-                else:
-                    print_error("Invalid combination of columns provided!", "Line {}".format(line_number), line)
-
-                ## Create sample mapping dictionary = {sample: [[ single_end, fastq_1, fastq_2, replicate, antibody, control ]]}
-                replicate = int(replicate)
-                sample_info = sample_info + lspl[len(HEADER) :]
-                if sample not in sample_mapping_dict:
-                    sample_mapping_dict[sample] = {}
-                if replicate not in sample_mapping_dict[sample]:
-                    sample_mapping_dict[sample][replicate] = [sample_info]
-                else:
-                    if sample_info in sample_mapping_dict[sample][replicate]:
-                        print_error("Samplesheet contains duplicate rows!", "Line {}".format(line_number), line)
-                    else:
-                        sample_mapping_dict[sample][replicate].append(sample_info)
+        ## Check replicate column is integer
+        if not replicate.isdecimal():
+            print_error("Replicate id not an integer!", "Line {}".format(line_number), line)
 
-    ## Write validated samplesheet with appropriate columns
-    if len(sample_mapping_dict) > 0:
-        out_dir = os.path.dirname(file_out)
-        make_dir(out_dir)
-        with open(file_out, "w") as fout:
-            fout.write(
-                ",".join(
-                    [
-                        "sample",
-                        "single_end",
-                        "fastq_1",
-                        "fastq_2",
-                        "replicate",
-                        "antibody",
-                        "is_input",
-                        "which_input",
-                    ]
+        ## Check antibody and control columns have valid values
+        if antibody:
+            if antibody.find(" ") != -1:
+                print(f"WARNING: Spaces have been replaced by underscores for antibody: {antibody}")
+                antibody = antibody.replace(" ", "_")
+            if not control:
+                print_error(
+                    "Both antibody and control columns must be specified!",
+                    "Line {}".format(line_number),
+                    line,
+                )
+
+        if control:
+            if control.find(" ") != -1:
+                print(f"WARNING: Spaces have been replaced by underscores for control: {control}")
+                control = control.replace(" ", "_")
+            if not control_replicate.isdecimal():
+                print_error("Control replicate id not an integer!", "Line {}".format(line_number), line)
+            control = "{}_REP{}".format(control, control_replicate)
+            if not antibody:
+                print_error(
+                    "Both antibody and control columns must be specified!",
+                    "Line {}".format(line_number),
+                    line,
                 )
-                + "\n"
+
+        ## Auto-detect paired-end/single-end
+        ## Paired-end short reads
+        if sample and fastq_1 and fastq_2:
+            single_end = "0"
+        ## Single-end short reads
+        elif sample and fastq_1 and not fastq_2:
+            single_end = "1"
+        else:
+            print_error("Invalid combination of columns provided!", "Line {}".format(line_number), line)
+
+        sample_info = [single_end, fastq_1, fastq_2, replicate, antibody, control] + lspl[len(HEADER) :]
+        yield line_number, line, sample, int(replicate), sample_info, fastq_1, fastq_2
+
+
+def index_samplesheet(rows):
+    """
+    Build the sample index = {sample: {replicate: [sample_info, ...]}} with the runs of each replicate in file order
+    from the rows yielded by iter_samplesheet_rows(). Duplicate rows are found by looking up a fingerprint of each
+    row in a set rather than by comparing it to every run of its replicate, and replicates whose runs are not all of
+    the same datatype as their first run are recorded as they are added.
+    Returns (sample_index, mixed_replicates, fastq_rows) where mixed_replicates is a set of (sample, replicate) and
+    fastq_rows = [(line_number, line, fastq_1, fastq_2), ...] as checked by validate_fastq_files().
+    """
+    sample_index = {}
+    fingerprints = set()
+    mixed_replicates = set()
+    fastq_rows = []
+    for line_number, line, sample, replicate, sample_info, fastq_1, fastq_2 in rows:
+        fingerprint = (sample, replicate) + tuple(sample_info)
+        if fingerprint in fingerprints:
+            print_error("Samplesheet contains duplicate rows!", "Line {}".format(line_number), line)
+        fingerprints.add(fingerprint)
+
+        runs = sample_index.setdefault(sample, {}).setdefault(replicate, [])
+        if runs and runs[0][0] != sample_info[0]:
+            mixed_replicates.add((sample, replicate))
+        runs.append(sample_info)
+        fastq_rows.append((line_number, line, fastq_1, fastq_2))
+    return sample_index, mixed_replicates, fastq_rows
+
+
+def check_sample_index(sample_index, mixed_replicates):
+    """
+    Check the replicates of every sample and that every control resolves to a sample and replicate in the index,
+    visiting samples and replicates in the order they are written so the first error reported is unchanged.
+    """
+    for sample in sorted(sample_index):
+        replicates = sample_index[sample]
+
+        ## Check that replicate ids are in format 1..<num_replicates>
+        uniq_rep_ids = sorted(replicates)
+        if len(uniq_rep_ids) != max(uniq_rep_ids) or 1 != min(uniq_rep_ids):
+            print_error(
+                "Replicate ids must start with 1..<num_replicates>!",
+                "Sample",
+                "{}, replicate ids: {}".format(sample, ",".join([str(x) for x in uniq_rep_ids])),
+            )
+
+        ## Check that multiple replicates are of the same datatype i.e. single-end / paired-end
+        if not all(x[0][0] == replicates[1][0][0] for x in replicates.values()):
+            print_error(
+                f"Multiple replicates of a sample must be of the same datatype i.e. single-end or paired-end!",
+                "Sample",
+                sample,
             )
-            for sample in sorted(sample_mapping_dict.keys()):
-                ## Check that replicate ids are in format 1..<num_replicates>
-                uniq_rep_ids = sorted(list(set(sample_mapping_dict[sample].keys())))
-                if len(uniq_rep_ids) != max(uniq_rep_ids) or 1 != min(uniq_rep_ids):
-                    print_error(
-                        "Replicate ids must start with 1..<num_replicates>!",
-                        "Sample",
-                        "{}, replicate ids: {}".format(sample, ",".join([str(x) for x in uniq_rep_ids])),
-                    )
-                    sys.exit(1)
 
-                ## Check that multiple replicates are of the same datatype i.e. single-end / paired-end
-                if not all(
-                    x[0][0] == sample_mapping_dict[sample][1][0][0] for x in sample_mapping_dict[sample].values()
-                ):
+        for replicate in uniq_rep_ids:
+            ## Check that multiple runs of the same sample are of the same datatype i.e. single-end / paired-end
+            if (sample, replicate) in mixed_replicates:
+                print_error(
+                    f"Multiple runs of a sample must be of the same datatype i.e. single-end or paired-end!",
+                    "Sample",
+                    sample,
+                )
+
+            for val in replicates[replicate]:
+                control = "_REP".join(val[-1].split("_REP")[:-1])
+                control_replicate = val[-1].split("_REP")[-1]
+                if control and (control not in sample_index or int(control_replicate) not in sample_index[control]):
                     print_error(
-                        f"Multiple replicates of a sample must be of the same datatype i.e. single-end or paired-end!",
-                        "Sample",
-                        sample,
+                        f"Control identifier and replicate has to match a provided sample identifier and replicate!",
+                        "Control",
+                        val[-1],
                     )
 
-                for replicate in sorted(sample_mapping_dict[sample].keys()):
-                    ## Check that multiple runs of the same sample are of the same datatype i.e. single-end / paired-end
-                    if not all(
-                        x[0] == sample_mapping_dict[sample][replicate][0][0]
-                        for x in sample_mapping_dict[sample][replicate]
-                    ):
-                        print_error(
-                            f"Multiple runs of a sample must be of the same datatype i.e. single-end or paired-end!",
-                            "Sample",
-                            sample,
-                        )
-
-                    for idx, val in enumerate(sample_mapping_dict[sample][replicate]):
-                        control = "_REP".join(val[-1].split("_REP")[:-1])
-                        control_replicate = val[-1].split("_REP")[-1]
-                        if control and (
-                            control not in sample_mapping_dict.keys()
-                            or int(control_replicate) not in sample_mapping_dict[control].keys()
-                        ):
-                            print_error(
-                                f"Control identifier and replicate has to match a provided sample identifier and replicate!",
-                                "Control",
-                                val[-1],
-                            )
-
-                    ## Write to file
-                    for idx in range(len(sample_mapping_dict[sample][replicate])):
-                        fastq_files = sample_mapping_dict[sample][replicate][idx]
-                        sample_id = "{}_REP{}_T{}".format(sample, replicate, idx + 1)
-                        
-                        # Convert control field to is_input and which_input
-                        # fastq_files = [single_end, fastq_1, fastq_2, replicate, antibody, control]
-                        control_id = fastq_files[5] if len(fastq_files) > 5 else ""
-                        is_input = "true" if not fastq_files[4] else "false"  # true if antibody is empty
-                        # which_input must match the actual sample ID format: CONTROL_REP{N}_T1
-                        which_input = "" if is_input == "true" else "{}_T1".format(control_id)
-                        
-                        # Rebuild output: [sample, single_end, fastq_1, fastq_2, replicate, antibody, is_input, which_input]
-                        output_fields = [sample_id] + fastq_files[0:5] + [is_input, which_input]
-                        
-                        if len(sample_mapping_dict[sample][replicate]) == 1:
-                            fout.write(",".join(output_fields) + "\n")
-                        else:
-                            fout.write(",".join(output_fields) + "\n")
 
-    else:
+def write_samplesheet(sample_index, file_out):
+    """
+    Write the validated samplesheet sorted by sample and replicate with one row per run, where the runs of a
+    replicate get the _T<run> suffix in the order they appear in the input. Returns the number of rows written.
+    """
+    make_dir(os.path.dirname(file_out))
+    num_rows = 0
+    with open(file_out, "w") as fout:
+        fout.write(
+            ",".join(["sample", "single_end", "fastq_1", "fastq_2", "replicate", "antibody", "is_input", "which_input"])
+            + "\n"
+        )
+        for sample in sorted(sample_index):
+            for replicate in sorted(sample_index[sample]):
+                for idx, fastq_files in enumerate(sample_index[sample][replicate]):
+                    sample_id = "{}_REP{}_T{}".format(sample, replicate, idx + 1)
+
+                    # Convert control field to is_input and which_input
+                    # fastq_files = [single_end, fastq_1, fastq_2, replicate, antibody, control]
+                    control_id = fastq_files[5] if len(fastq_files) > 5 else ""
+                    is_input = "true" if not fastq_files[4] else "false"  # true if antibody is empty
+                    # which_input must match the actual sample ID format: CONTROL_REP{N}_T1
+                    which_input = "" if is_input == "true" else "{}_T1".format(control_id)
+
+                    # Rebuild output: [sample, single_end, fastq_1, fastq_2, replicate, antibody, is_input, which_input]
+                    output_fields = [sample_id] + fastq_files[0:5] + [is_input, which_input]
+                    fout.write(",".join(output_fields) + "\n")
+                    num_rows += 1
+    return num_rows
+
+
+def check_samplesheet(file_in, file_out, validate_fastq=False, validate_options=None, perf=None):
+    """
+    This function checks that the samplesheet follows the following structure:
+    sample,fastq_1,fastq_2,replicate,antibody,control,control_replicate
+    SPT5_T0,SRR1822153_1.fastq.gz,SRR1822153_2.fastq.gz,SPT5,1,SPT5_INPUT,1
+    SPT5_T0,SRR1822154_1.fastq.gz,SRR1822154_2.fastq.gz,SPT5,2,SPT5_INPUT,2
+    SPT5_INPUT,SRR5204809_Spt5-ChIP_Input1_SacCer_ChIP-Seq_ss100k_R1.fastq.gz,SRR5204809_Spt5-ChIP_Input1_SacCer_ChIP-Seq_ss100k_R2.fastq.gz,1,,,
+    SPT5_INPUT,SRR5204810_Spt5-ChIP_Input2_SacCer_ChIP-Seq_ss100k_R1.fastq.gz,SRR5204810_Spt5-ChIP_Input2_SacCer_ChIP-Seq_ss100k_R2.fastq.gz,2,,,
+    For an example see:
+    https://raw.githubusercontent.com/nf-core/test-datasets/chipseq/samplesheet/v2.1/samplesheet_test.csv
+    Rows are checked and added to a sample -> replicate -> run index as they are read, then the replicates and
+    controls of each sample are checked and the output is written in a single sorted pass over the index.
+    With validate_fastq the FastQ files themselves are checked with validate_fastq_files(**validate_options).
+    Reading, validating the FastQ files, checking the sample groups and writing are timed as phases of perf if provided.
+    """
+
+    with perf_phase(perf, "parse"), open(file_in, "r", encoding="utf-8-sig") as fin:
+        sample_index, mixed_replicates, fastq_rows = index_samplesheet(iter_samplesheet_rows(fin))
+        if perf is not None:
+            perf.add_rows("parse", len(fastq_rows))
+
+    if validate_fastq and fastq_rows:
+        with perf_phase(perf, "validate"):
+            validate_fastq_files(fastq_rows, **(validate_options or {}))
+
+    if not sample_index:
         print_error(f"No entries to process!", "Samplesheet: {file_in}")
 
+    with perf_phase(perf, "group"):
+        check_sample_index(sample_index, mixed_replicates)
+
+    ## Write validated samplesheet with appropriate columns
+    with perf_phase(perf, "write"):
+        num_rows = write_samplesheet(sample_index, file_out)
+        if perf is not None:
+            perf.add_rows("write", num_rows)
+
 
 def main(args=None):
     args = parse_args(args)
-    check_samplesheet(args.FILE_IN, args.FILE_OUT)
+    perf = None
+    if args.perf_file:
+        if PerfRecorder is None:
+            print("WARNING: perf_stats.py not found next to this script, --perf_file is ignored.")
+        else:
+            perf = PerfRecorder(os.path.basename(__file__), profile=args.profile, traceMemory=args.profile)
+    restored = False
+    if args.validate_fastq:
+        ## The result cache is keyed on the samplesheet alone so it cannot tell that a FastQ file has changed
+        check_samplesheet(
+            args.FILE_IN,
+            args.FILE_OUT,
+            validate_fastq=True,
+            validate_options={
+                "threads": args.threads,
+                "head_reads": args.head_reads,
+                "full_check": args.full_check,
+                "cache_file": args.validation_cache,
+                "timings_file": args.timings_file,
+            },
+            perf=perf,
+        )
+    elif args.cache_dir and cached_run is not None:
+        restored = cached_run(
+            args.cache_dir,
+            os.path.abspath(__file__),
+            [args.FILE_IN],
+            {},
+            {"csv": args.FILE_OUT},
+            lambda: check_samplesheet(args.FILE_IN, args.FILE_OUT, perf=perf),
+            maxSizeMb=args.cache_max_size,
+        )
+    else:
+        check_samplesheet(args.FILE_IN, args.FILE_OUT, perf=perf)
+    if perf is not None:
+        perf.update({"cache_hit": restored, "validate_fastq": args.validate_fastq})
+        perf.write(args.perf_file)
 
 
 if __name__ == "__main__":
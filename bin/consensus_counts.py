@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Count fragments per consensus interval for all samples in one job
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import argparse
+import resource
+import itertools
+import multiprocessing
+
+import numpy as np
+import pysam
+
+try:
+    from consensus_matrix import ConsensusMatrix
+except ImportError:
+    ConsensusMatrix = None
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Count reads or fragments overlapping consensus peak intervals in one or more BAM files and write a featureCounts-compatible count matrix."
+    Epilog = """Example usage: python consensus_counts.py <CONSENSUS_FILE> <BAM_FILES> <OUTFILE> --paired_end --frac_overlap 0.1 --threads 4"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument(
+        "CONSENSUS_FILE",
+        help="Consensus intervals as a .npz matrix written by macs2_merged_expand.py --matrix_file, a *.boolean.txt file or a BED file with interval IDs in the name column.",
+    )
+    argParser.add_argument("BAM_FILES", help="Comma-separated list of coordinate-sorted BAM files.")
+    argParser.add_argument(
+        "OUTFILE",
+        help="Count matrix in featureCounts format. The assignment summary is written to '<OUTFILE>.summary'.",
+    )
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-pe",
+        "--paired_end",
+        dest="PAIRED_END",
+        help="Count fragments instead of reads, as for 'featureCounts -p' (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-fo",
+        "--frac_overlap",
+        type=float,
+        dest="FRAC_OVERLAP",
+        default=0.1,
+        help="Minimum fraction of the aligned bases of a read or fragment that must overlap an interval, as for 'featureCounts --fracOverlap' (default: 0.1).",
+    )
+    argParser.add_argument(
+        "-so",
+        "--start_offset",
+        type=int,
+        dest="START_OFFSET",
+        default=1,
+        help="Bases added upstream of every interval. The default of 1 gives the same counts as featureCounts on the SAF file previously written by macs2_merged_expand.py, which used 0-based BED starts as 1-based SAF starts (default: 1).",
+    )
+    argParser.add_argument(
+        "-nf",
+        "--npz_file",
+        type=str,
+        dest="NPZ_FILE",
+        default="",
+        help="Also write the interval x sample count matrix and the summary to this .npz file (default: '').",
+    )
+    argParser.add_argument(
+        "-bs",
+        "--batch_size",
+        type=int,
+        dest="BATCH_SIZE",
+        default=500000,
+        help="Number of read alignment blocks assigned to intervals per NumPy batch (default: 500000).",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of BAM file chromosomes counted in parallel (default: 1).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+## ROWS OF THE featureCounts SUMMARY FILE IN THE ORDER WRITTEN BY featureCounts v2.0.1
+SUMMARY_STATUS = [
+    "Assigned",
+    "Unassigned_Unmapped",
+    "Unassigned_Read_Type",
+    "Unassigned_Singleton",
+    "Unassigned_MappingQuality",
+    "Unassigned_Chimera",
+    "Unassigned_FragmentLength",
+    "Unassigned_Duplicate",
+    "Unassigned_MultiMapping",
+    "Unassigned_Secondary",
+    "Unassigned_NonSplit",
+    "Unassigned_NoFeatures",
+    "Unassigned_Overlapping_Length",
+    "Unassigned_Ambiguity",
+]
+
+
+def load_intervals(ConsensusFile):
+    """
+    Return (intervalIds, chroms, starts, ends) of the consensus intervals in file order, with 0-based half-open
+    coordinates. Intervals are read from a consensus .npz matrix, a *.boolean.txt file or a BED file.
+    """
+    if ConsensusFile.endswith(".npz"):
+        if ConsensusMatrix is None:
+            print("ERROR: consensus_matrix.py not found next to this script, cannot read {}!".format(ConsensusFile))
+            sys.exit(1)
+        matrix = ConsensusMatrix.load(ConsensusFile)
+        intervalIds = ["Interval_" + str(x) for x in matrix.interval_ids.tolist()]
+        return intervalIds, matrix.chrom_array().tolist(), np.array(matrix.starts), np.array(matrix.ends)
+
+    intervalIds, chroms, starts, ends = [], [], [], []
+    fin = open(ConsensusFile, "r")
+    for line in fin:
+        if not line.strip() or line.startswith(("#", "track", "browser", "chr\tstart\tend\t")):
+            continue
+        lspl = line.split("\t", 4)
+        chroms.append(lspl[0])
+        starts.append(int(lspl[1]))
+        ends.append(int(lspl[2]))
+        intervalIds.append(lspl[3].strip())
+    fin.close()
+    return intervalIds, chroms, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def group_intervals(chroms, starts, ends):
+    """
+    Return {chrom: (rowIdx, starts, ends)} with the intervals of every chromosome sorted by start. Intervals must not
+    overlap, as is the case for merged consensus intervals, so that their ends are sorted too.
+    """
+    chromIntervals = {}
+    chromNames, chromCodes = np.unique(np.array(chroms, dtype=str), return_inverse=True)
+    order = np.lexsort((starts, chromCodes))
+    bounds = np.searchsorted(chromCodes[order], np.arange(len(chromNames) + 1))
+    for idx, chromID in enumerate(chromNames.tolist()):
+        rowIdx = order[bounds[idx] : bounds[idx + 1]]
+        chromIntervals[chromID] = (rowIdx, starts[rowIdx], ends[rowIdx])
+    return chromIntervals
+
+
+############################################
+############################################
+## COUNTING
+############################################
+############################################
+
+## Each read or fragment is reduced to its aligned blocks (CIGAR M/=/X operations) tagged with a fragment number.
+## Blocks are collected into batches and assigned to intervals with NumPy: the candidate intervals of every block are
+## found with two binary searches, overlapping bases are summed per (fragment, interval) and a fragment is counted
+## once for every interval it overlaps by at least fracOverlap of its aligned bases, as with 'featureCounts -O'.
+## Mates on the same chromosome are combined into one fragment, so a fragment is counted once even if both of its
+## reads overlap the interval.
+
+
+class FragmentAssigner:
+    """Accumulate fragment blocks for the intervals of one chromosome and assign them in NumPy batches."""
+
+    def __init__(self, starts, ends, fracOverlap=0.1, batchSize=500000):
+        self.starts = starts
+        self.ends = ends
+        self.fracOverlap = fracOverlap
+        self.batchSize = batchSize
+        self.counts = np.zeros(len(starts), dtype=np.int64)
+        self.summary = dict.fromkeys(SUMMARY_STATUS, 0)
+        self.blockStarts = []
+        self.blockEnds = []
+        self.blockFragments = []
+        self.numFragments = 0
+
+    def add(self, blocks):
+        for blockStart, blockEnd in blocks:
+            self.blockStarts.append(blockStart)
+            self.blockEnds.append(blockEnd)
+            self.blockFragments.append(self.numFragments)
+        self.numFragments += 1
+        if len(self.blockStarts) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.numFragments:
+            return
+        blockStarts = np.array(self.blockStarts, dtype=np.int64)
+        blockEnds = np.array(self.blockEnds, dtype=np.int64)
+        blockFragments = np.array(self.blockFragments, dtype=np.int64)
+        numFragments = self.numFragments
+        self.blockStarts, self.blockEnds, self.blockFragments = [], [], []
+        self.numFragments = 0
+        if len(self.starts) == 0:
+            self.summary["Unassigned_NoFeatures"] += numFragments
+            return
+
+        ## INTERVALS DO NOT OVERLAP EXCEPT FOR --start_offset BASES SO ENDS ARE SORTED AS WELL AS STARTS
+        first = np.searchsorted(self.ends, blockStarts, side="right")
+        last = np.searchsorted(self.starts, blockEnds, side="left")
+        numCandidates = np.maximum(last - first, 0)
+        pairBlock = np.repeat(np.arange(len(blockStarts)), numCandidates)
+        pairOffsets = np.cumsum(numCandidates) - numCandidates
+        pairInterval = first[pairBlock] + np.arange(len(pairBlock)) - pairOffsets[pairBlock]
+        overlap = np.minimum(blockEnds[pairBlock], self.ends[pairInterval]) - np.maximum(
+            blockStarts[pairBlock], self.starts[pairInterval]
+        )
+        hit = overlap > 0
+        pairFragment = blockFragments[pairBlock[hit]]
+        pairInterval = pairInterval[hit]
+        overlap = overlap[hit]
+
+        ## OVERLAPPING BASES PER (FRAGMENT, INTERVAL) AGAINST THE ALIGNED BASES OF THE FRAGMENT
+        fragmentLength = np.bincount(blockFragments, weights=blockEnds - blockStarts, minlength=numFragments)
+        key = pairFragment * len(self.starts) + pairInterval
+        uniqKey, inverse = np.unique(key, return_inverse=True)
+        keyOverlap = np.bincount(inverse, weights=overlap, minlength=len(uniqKey))
+        keyFragment = uniqKey // len(self.starts)
+        keyInterval = uniqKey % len(self.starts)
+        passed = keyOverlap >= self.fracOverlap * fragmentLength[keyFragment] - 1e-9
+        self.counts += np.bincount(keyInterval[passed], minlength=len(self.starts))
+
+        assigned = np.zeros(numFragments, dtype=bool)
+        assigned[keyFragment[passed]] = True
+        overlapping = np.zeros(numFragments, dtype=bool)
+        overlapping[keyFragment] = True
+        self.summary["Assigned"] += int(assigned.sum())
+        self.summary["Unassigned_Overlapping_Length"] += int((overlapping & ~assigned).sum())
+        self.summary["Unassigned_NoFeatures"] += int((~overlapping).sum())
+
+
+def read_blocks(read):
+    """Aligned reference blocks of a read, skipping the CIGAR parsing for the common single-block case."""
+    cigar = read.cigartuples
+    if cigar is not None and len(cigar) == 1:
+        return [(read.reference_start, read.reference_end)]
+    return read.get_blocks()
+
+
+def count_reads(reads, starts, ends, pairedEnd=False, fracOverlap=0.1, batchSize=500000):
+    """
+    Count the fragments of an iterator of alignments from one chromosome against the intervals starts/ends.
+    Returns (counts per interval, summary dict). Secondary and supplementary alignments are skipped. In paired-end
+    mode mates on the same chromosome are combined, a fragment with mates on different chromosomes is counted from
+    its first read only and a read whose mate is unmapped or missing is counted on its own.
+    """
+    assigner = FragmentAssigner(starts, ends, fracOverlap=fracOverlap, batchSize=batchSize)
+    pending = {}
+    for read in reads:
+        flag = read.flag
+        if flag & 0x900:
+            continue
+        if flag & 0x4:
+            ## COUNT UNMAPPED FRAGMENTS ONCE, WHEN BOTH MATES ARE UNMAPPED FROM THE FIRST READ
+            if not pairedEnd or not flag & 0x1 or (flag & 0x8 and not flag & 0x80):
+                assigner.summary["Unassigned_Unmapped"] += 1
+            continue
+        blocks = read_blocks(read)
+        if pairedEnd and flag & 0x1 and not flag & 0x8:
+            if read.next_reference_id == read.reference_id:
+                mateBlocks = pending.pop(read.query_name, None)
+                if mateBlocks is None:
+                    pending[read.query_name] = blocks
+                    continue
+                blocks = mateBlocks + blocks
+            elif flag & 0x80:
+                continue
+        assigner.add(blocks)
+
+    ## READS WHOSE MATE WAS NOT FOUND E.G. IT WAS FILTERED OUT
+    for blocks in pending.values():
+        assigner.add(blocks)
+    assigner.flush()
+    return assigner.counts, assigner.summary
+
+
+def count_task(task):
+    """Pool worker: count one chromosome of an indexed BAM file, or a whole BAM file without an index."""
+    BamFile, chromID, chromIntervals, options = task
+    bam = pysam.AlignmentFile(BamFile, "rb")
+    empty = np.zeros(0, dtype=np.int64)
+    results = []
+    if chromID is not None:
+        rowIdx, starts, ends = chromIntervals.get(chromID, (empty, empty, empty))
+        counts, summary = count_reads(bam.fetch(chromID), starts, ends, **options)
+        results.append((rowIdx, counts, summary))
+    else:
+        for tid, reads in itertools.groupby(bam.fetch(until_eof=True), key=lambda x: x.reference_id):
+            chromID = bam.get_reference_name(tid) if tid >= 0 else None
+            rowIdx, starts, ends = chromIntervals.get(chromID, (empty, empty, empty))
+            counts, summary = count_reads(reads, starts, ends, **options)
+            results.append((rowIdx, counts, summary))
+    bam.close()
+    return BamFile, results
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def consensus_counts(
+    ConsensusFile, BamFiles, pairedEnd=False, fracOverlap=0.1, startOffset=1, batchSize=500000, threads=1
+):
+    """
+    Count fragments per consensus interval for every BAM file. Returns (intervalIds, chroms, starts, ends, counts,
+    summary) where starts are 0-based after applying startOffset, counts is an interval x BAM matrix and summary a
+    dict of {status: [count per BAM]}.
+
+    Every chromosome of every indexed BAM file is an independent task so all samples are counted in the same process
+    pool, largest chromosomes first. BAM files without an index are streamed once by a single worker.
+    """
+    intervalIds, chroms, starts, ends = load_intervals(ConsensusFile)
+    starts = np.maximum(starts - startOffset, 0)
+    chromIntervals = group_intervals(chroms, starts, ends)
+    options = {"pairedEnd": pairedEnd, "fracOverlap": fracOverlap, "batchSize": batchSize}
+
+    tasks = []
+    summary = {x: [0] * len(BamFiles) for x in SUMMARY_STATUS}
+    for bamIdx, BamFile in enumerate(BamFiles):
+        bam = pysam.AlignmentFile(BamFile, "rb")
+        if bam.has_index():
+            ## UNMAPPED READS WITHOUT COORDINATES ARE NOT RETURNED BY fetch(chrom)
+            summary["Unassigned_Unmapped"][bamIdx] += bam.nocoordinate // 2 if pairedEnd else bam.nocoordinate
+            for chromID, length in sorted(zip(bam.references, bam.lengths), key=lambda x: -x[1]):
+                intervals = {chromID: chromIntervals[chromID]} if chromID in chromIntervals else {}
+                tasks.append((length, (BamFile, chromID, intervals, options)))
+        else:
+            print("WARNING: No index found for {}, counting in a single pass without parallelism.".format(BamFile))
+            tasks.append((sum(bam.lengths), (BamFile, None, chromIntervals, options)))
+        bam.close()
+    tasks = [x[1] for x in sorted(tasks, key=lambda x: -x[0])]
+
+    if threads > 1:
+        pool = multiprocessing.Pool(processes=threads)
+        results = pool.imap_unordered(count_task, tasks)
+    else:
+        pool = None
+        results = map(count_task, tasks)
+
+    bamIndex = {x: idx for idx, x in enumerate(BamFiles)}
+    counts = np.zeros((len(intervalIds), len(BamFiles)), dtype=np.int64)
+    for BamFile, chromResults in results:
+        bamIdx = bamIndex[BamFile]
+        for rowIdx, chromCounts, chromSummary in chromResults:
+            counts[rowIdx, bamIdx] += chromCounts
+            for status, value in chromSummary.items():
+                summary[status][bamIdx] += value
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return intervalIds, chroms, starts, ends, counts, summary
+
+
+def write_featurecounts(OutFile, BamFiles, intervalIds, chroms, starts, ends, counts, summary, command=""):
+    """Write the count matrix and summary files in the layout of featureCounts with SAF annotation."""
+    makedir(os.path.dirname(OutFile))
+    fout = open(OutFile, "w")
+    fout.write('# Program:consensus_counts.py; Command:"{}"\n'.format(command))
+    fout.write("\t".join(["Geneid", "Chr", "Start", "End", "Strand", "Length"] + BamFiles) + "\n")
+    rows = zip(intervalIds, chroms, (starts + 1).tolist(), ends.tolist(), (ends - starts).tolist(), counts.tolist())
+    for intervalId, chromID, start, end, length, row in rows:
+        fout.write("%s\t%s\t%d\t%d\t+\t%d\t%s\n" % (intervalId, chromID, start, end, length, "\t".join(map(str, row))))
+    fout.close()
+
+    fout = open(OutFile + ".summary", "w")
+    fout.write("\t".join(["Status"] + BamFiles) + "\n")
+    for status in SUMMARY_STATUS:
+        fout.write("\t".join([status] + [str(x) for x in summary[status]]) + "\n")
+    fout.close()
+
+
+def write_npz(NpzFile, BamFiles, intervalIds, counts, summary):
+    makedir(os.path.dirname(NpzFile))
+    ## WRITE THROUGH A FILE HANDLE SO NUMPY DOES NOT APPEND .npz TO THE FILE NAME
+    with open(NpzFile, "wb") as fout:
+        np.savez_compressed(
+            fout,
+            samples=np.array(BamFiles, dtype=str),
+            interval_ids=np.array([int(x.rsplit("_", 1)[-1]) for x in intervalIds], dtype=np.int64),
+            counts=counts.astype(np.int32 if counts.max(initial=0) < 2**31 else np.int64),
+            summary_status=np.array(SUMMARY_STATUS, dtype=str),
+            summary=np.array([summary[x] for x in SUMMARY_STATUS], dtype=np.int64),
+        )
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    BamFiles = args.BAM_FILES.split(",")
+    startTime = time.time()
+    intervalIds, chroms, starts, ends, counts, summary = consensus_counts(
+        ConsensusFile=args.CONSENSUS_FILE,
+        BamFiles=BamFiles,
+        pairedEnd=args.PAIRED_END,
+        fracOverlap=args.FRAC_OVERLAP,
+        startOffset=args.START_OFFSET,
+        batchSize=args.BATCH_SIZE,
+        threads=args.THREADS,
+    )
+    write_featurecounts(
+        args.OUTFILE, BamFiles, intervalIds, chroms, starts, ends, counts, summary, command=" ".join(sys.argv)
+    )
+    if args.NPZ_FILE:
+        write_npz(args.NPZ_FILE, BamFiles, intervalIds, counts, summary)
+    print(
+        "Counted {} BAM files against {} intervals in {:.1f}s, peak memory {:.1f} MB".format(
+            len(BamFiles), len(intervalIds), time.time() - startTime, peak_memory_mb()
+        )
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+############################################
+############################################
+############################################
+############################################
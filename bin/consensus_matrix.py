@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Columnar binary consensus peak matrix and reader API
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import zipfile
+import argparse
+
+import numpy as np
+
+## The matrix holds the same data as the *.boolean.txt file written by macs2_merged_expand.py. It is saved as an
+## uncompressed .npz archive so every array can be memory-mapped straight from the zip member without a copy:
+##
+##   samples, chrom_names, chrom_offsets    sample names, chromosomes in file order and their row ranges
+##   starts, ends, interval_ids             interval coordinates and the N of 'Interval_N'
+##   num_peaks, num_samples                 the 'num_peaks' and 'num_samples' columns
+##   membership                             packed interval x sample bit-matrix, little bit order (np.packbits)
+##   peak_offsets                           peaks of interval i are peak_offsets[i]:peak_offsets[i + 1]
+##   peak_sample                            sample column of each peak, peaks are ordered by sample per interval
+##   fc, qval, pval, start, end, summit     peak values, i.e. the ';'-joined lists in the boolean file
+##
+## Example:
+##   from consensus_matrix import ConsensusMatrix
+##   matrix = ConsensusMatrix.load("H3K4me3.consensus_peaks.boolean.npz")
+##   view = matrix.region("chr1", 1000000, 2000000).select(["WT_REP1", "WT_REP2"])
+##   offsets, samples, fc = view.values("fc")
+
+MATRIX_VERSION = 1
+
+VALUE_COLUMNS = ["fc", "qval", "pval", "start", "end", "summit"]
+VALUE_DTYPES = {
+    "fc": np.float64,
+    "qval": np.float64,
+    "pval": np.float64,
+    "start": np.int64,
+    "end": np.int64,
+    "summit": np.int64,
+}
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Convert a consensus peak *.boolean.txt file written by macs2_merged_expand.py to a binary .npz matrix, or summarise an existing matrix."
+    Epilog = """Example usage: python consensus_matrix.py <BOOLEAN_FILE> <MATRIX_FILE>"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("BOOLEAN_FILE", help="Consensus peak *.boolean.txt file, or a .npz matrix to summarise.")
+    argParser.add_argument("MATRIX_FILE", nargs="?", default="", help="Output .npz matrix file.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-cs",
+        "--chunk_size",
+        type=int,
+        dest="CHUNK_SIZE",
+        default=100000,
+        help="Number of boolean file rows converted per batch (default: 100000).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def load_npz_mmap(NpzFile):
+    """
+    Memory-map every array of an uncompressed .npz file, which np.load() cannot do itself. Each zip member is a
+    .npy file stored contiguously so its data starts after the zip local file header and the .npy header.
+    """
+    arrays = {}
+    with zipfile.ZipFile(NpzFile, "r") as zfile, open(NpzFile, "rb") as fin:
+        for info in zfile.infolist():
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(zfile.open(info), allow_pickle=False)
+                continue
+            ## LOCAL FILE HEADER IS 30 BYTES FOLLOWED BY THE FILE NAME AND EXTRA FIELD
+            fin.seek(info.header_offset + 26)
+            nameLength, extraLength = np.frombuffer(fin.read(4), dtype="<u2").tolist()
+            fin.seek(info.header_offset + 30 + nameLength + extraLength)
+            version = np.lib.format.read_magic(fin)
+            if version == (1, 0):
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(fin)
+            else:
+                shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(fin)
+            if dtype.hasobject:
+                raise ValueError("Object arrays are not supported in {}".format(NpzFile))
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    NpzFile,
+                    dtype=dtype,
+                    mode="r",
+                    offset=fin.tell(),
+                    shape=shape,
+                    order="F" if fortranOrder else "C",
+                )
+    return arrays
+
+
+############################################
+############################################
+## WRITER
+############################################
+############################################
+
+
+class ConsensusMatrixWriter:
+    """
+    Accumulate batches of consensus intervals in boolean file order and save them with close(). Each batch is a dict
+    with 'chroms', 'starts', 'ends', 'num_peaks', 'num_samples', 'membership' (bool interval x sample matrix),
+    'peak_counts' (peaks per interval), 'peak_sample' and one array per value column in VALUE_COLUMNS.
+    """
+
+    def __init__(self, MatrixFile, samples, isNarrow=False):
+        self.MatrixFile = MatrixFile
+        self.samples = list(samples)
+        self.isNarrow = bool(isNarrow)
+        self.columns = [x for x in VALUE_COLUMNS if x != "summit" or isNarrow]
+        self.chromNames = []
+        self.chromCounts = []
+        self.batches = {x: [] for x in ["starts", "ends", "interval_ids", "num_peaks", "num_samples"]}
+        self.batches.update({x: [] for x in ["membership", "peak_counts", "peak_sample"] + self.columns})
+
+    def add(self, batch, intervalIds):
+        for chromID in batch["chroms"]:
+            if not self.chromNames or self.chromNames[-1] != chromID:
+                if chromID in self.chromNames:
+                    raise ValueError("Consensus intervals for {} are not contiguous".format(chromID))
+                self.chromNames.append(chromID)
+                self.chromCounts.append(0)
+            self.chromCounts[-1] += 1
+        self.batches["interval_ids"].append(np.asarray(intervalIds, dtype=np.int64))
+        self.batches["membership"].append(
+            np.packbits(np.asarray(batch["membership"], dtype=bool), axis=1, bitorder="little")
+        )
+        for key in ["starts", "ends", "num_peaks", "num_samples", "peak_counts", "peak_sample"]:
+            self.batches[key].append(np.asarray(batch[key]))
+        for col in self.columns:
+            self.batches[col].append(np.asarray(batch[col], dtype=VALUE_DTYPES[col]))
+
+    def close(self):
+        def concat(key, dtype):
+            return (
+                np.concatenate(self.batches[key]).astype(dtype, copy=False) if self.batches[key] else np.zeros(0, dtype)
+            )
+
+        peakOffsets = np.zeros(len(concat("starts", np.int64)) + 1, dtype=np.int64)
+        np.cumsum(concat("peak_counts", np.int64), out=peakOffsets[1:])
+        chromOffsets = np.zeros(len(self.chromNames) + 1, dtype=np.int64)
+        np.cumsum(self.chromCounts, out=chromOffsets[1:])
+        numBytes = (len(self.samples) + 7) // 8
+        arrays = {
+            "version": np.int64(MATRIX_VERSION),
+            "samples": np.array(self.samples, dtype=str),
+            "is_narrow": np.bool_(self.isNarrow),
+            "chrom_names": np.array(self.chromNames, dtype=str),
+            "chrom_offsets": chromOffsets,
+            "starts": concat("starts", np.int64),
+            "ends": concat("ends", np.int64),
+            "interval_ids": concat("interval_ids", np.int64),
+            "num_peaks": concat("num_peaks", np.int32),
+            "num_samples": concat("num_samples", np.int32),
+            "membership": (
+                np.concatenate(self.batches["membership"])
+                if self.batches["membership"]
+                else np.zeros((0, numBytes), dtype=np.uint8)
+            ),
+            "peak_offsets": peakOffsets,
+            "peak_sample": concat("peak_sample", np.int32),
+        }
+        for col in self.columns:
+            arrays[col] = concat(col, VALUE_DTYPES[col])
+
+        ## UNCOMPRESSED SO THE READER CAN MEMORY-MAP THE ARRAYS. WRITE THROUGH A FILE HANDLE SO NUMPY DOES NOT
+        ## APPEND .npz TO THE FILE NAME
+        makedir(os.path.dirname(self.MatrixFile))
+        with open(self.MatrixFile, "wb") as fout:
+            np.savez(fout, **arrays)
+        self.batches = None
+
+
+def parse_boolean_rows(lines, samples, isNarrow=False):
+    """Parse *.boolean.txt data lines into a ConsensusMatrixWriter batch and the interval IDs of the rows."""
+    numSamples = len(samples)
+    columns = [x for x in VALUE_COLUMNS if x != "summit" or isNarrow]
+    batch = {x: [] for x in ["chroms", "starts", "ends", "num_peaks", "num_samples", "peak_counts", "peak_sample"]}
+    batch.update({x: [] for x in columns})
+    membership = np.zeros((len(lines), numSamples), dtype=bool)
+    intervalIds = []
+    for row, line in enumerate(lines):
+        lspl = line.rstrip("\n").split("\t")
+        batch["chroms"].append(lspl[0])
+        batch["starts"].append(int(lspl[1]))
+        batch["ends"].append(int(lspl[2]))
+        intervalIds.append(int(lspl[3].rsplit("_", 1)[-1]))
+        batch["num_peaks"].append(int(lspl[4]))
+        batch["num_samples"].append(int(lspl[5]))
+        membership[row] = [x == "TRUE" for x in lspl[6 : 6 + numSamples]]
+        numPeaks = 0
+        for sampleIdx in np.flatnonzero(membership[row]).tolist():
+            cells = [lspl[6 + numSamples * (idx + 1) + sampleIdx].split(";") for idx in range(len(columns))]
+            for idx, col in enumerate(columns):
+                batch[col].extend(cells[idx])
+            batch["peak_sample"].extend([sampleIdx] * len(cells[0]))
+            numPeaks += len(cells[0])
+        batch["peak_counts"].append(numPeaks)
+    batch["membership"] = membership
+    for col in columns:
+        batch[col] = np.array(batch[col], dtype=VALUE_DTYPES[col])
+    return batch, intervalIds
+
+
+def boolean_to_matrix(BooleanFile, MatrixFile, chunkSize=100000):
+    """Convert an existing *.boolean.txt file to a .npz matrix. Returns the number of intervals converted."""
+    fin = open(BooleanFile, "r")
+    header = fin.readline().rstrip("\n").split("\t")
+    samples = [x[:-5] for x in header if x.endswith(".bool")]
+    isNarrow = header[-1].endswith(".summit")
+    writer = ConsensusMatrixWriter(MatrixFile, samples, isNarrow=isNarrow)
+    numIntervals = 0
+    while True:
+        lines = [x for x in (fin.readline() for idx in range(chunkSize)) if x]
+        if not lines:
+            break
+        writer.add(*parse_boolean_rows(lines, samples, isNarrow=isNarrow))
+        numIntervals += len(lines)
+    fin.close()
+    writer.close()
+    return numIntervals
+
+
+############################################
+############################################
+## READER
+############################################
+############################################
+
+
+class ConsensusMatrix:
+    """
+    Read-only view of a consensus matrix over a contiguous range of intervals and a subset of samples. Arrays are
+    memory-mapped, so views created by chrom(), rows() and region() slice them without copying. Selecting samples
+    with select() filters the membership bits and peak values when they are accessed.
+    """
+
+    def __init__(self, arrays, lo=0, hi=None, sampleIdx=None):
+        self.arrays = arrays
+        self.allSamples = arrays["samples"].tolist()
+        self.isNarrow = bool(arrays["is_narrow"])
+        self.lo = lo
+        self.hi = len(arrays["starts"]) if hi is None else hi
+        self.sampleIdx = sampleIdx
+
+    @classmethod
+    def load(cls, MatrixFile):
+        arrays = load_npz_mmap(MatrixFile)
+        if int(arrays["version"]) != MATRIX_VERSION:
+            raise ValueError(
+                "Unsupported consensus matrix version {} in {}, expected {}.".format(
+                    int(arrays["version"]), MatrixFile, MATRIX_VERSION
+                )
+            )
+        return cls(arrays)
+
+    def __len__(self):
+        return self.hi - self.lo
+
+    def _view(self, lo, hi, sampleIdx):
+        return ConsensusMatrix(self.arrays, lo=lo, hi=hi, sampleIdx=sampleIdx)
+
+    @property
+    def samples(self):
+        if self.sampleIdx is None:
+            return list(self.allSamples)
+        return [self.allSamples[x] for x in self.sampleIdx.tolist()]
+
+    @property
+    def chroms(self):
+        """Chromosomes with intervals in this view, in file order."""
+        names = self.arrays["chrom_names"].tolist()
+        offsets = self.arrays["chrom_offsets"]
+        return [x for idx, x in enumerate(names) if offsets[idx] < self.hi and offsets[idx + 1] > self.lo]
+
+    def _column(self, key):
+        return self.arrays[key][self.lo : self.hi]
+
+    @property
+    def starts(self):
+        return self._column("starts")
+
+    @property
+    def ends(self):
+        return self._column("ends")
+
+    @property
+    def interval_ids(self):
+        return self._column("interval_ids")
+
+    @property
+    def num_peaks(self):
+        return self._column("num_peaks")
+
+    @property
+    def num_samples(self):
+        return self._column("num_samples")
+
+    def chrom_array(self):
+        """Chromosome name of every interval in the view."""
+        names = self.arrays["chrom_names"]
+        offsets = self.arrays["chrom_offsets"]
+        return names[np.searchsorted(offsets, np.arange(self.lo, self.hi), side="right") - 1]
+
+    def rows(self, start, stop):
+        """Intervals start:stop of this view."""
+        start, stop, step = slice(start, stop).indices(len(self))
+        return self._view(self.lo + start, self.lo + max(start, stop), self.sampleIdx)
+
+    def chrom(self, chromID):
+        """Intervals on chromosome chromID."""
+        names = self.arrays["chrom_names"].tolist()
+        if chromID not in names:
+            return self._view(self.lo, self.lo, self.sampleIdx)
+        idx = names.index(chromID)
+        offsets = self.arrays["chrom_offsets"]
+        lo = min(max(int(offsets[idx]), self.lo), self.hi)
+        hi = max(min(int(offsets[idx + 1]), self.hi), lo)
+        return self._view(lo, hi, self.sampleIdx)
+
+    def region(self, chromID, start, end):
+        """Intervals on chromID overlapping the 0-based, half-open range start:end."""
+        view = self.chrom(chromID)
+        ## CONSENSUS INTERVALS DO NOT OVERLAP SO ENDS ARE SORTED AS WELL AS STARTS
+        lo = view.lo + int(np.searchsorted(view.ends, start, side="right"))
+        hi = view.lo + int(np.searchsorted(view.starts, end, side="left"))
+        return self._view(lo, max(lo, hi), self.sampleIdx)
+
+    def select(self, samples):
+        """Restrict the view to the named samples, in the order given."""
+        index = {x: idx for idx, x in enumerate(self.allSamples)}
+        missing = [x for x in samples if x not in index]
+        if missing:
+            raise KeyError("Samples not in consensus matrix: {}".format(", ".join(missing)))
+        return self._view(self.lo, self.hi, np.array([index[x] for x in samples], dtype=np.int64))
+
+    def membership(self):
+        """Boolean interval x sample matrix of the samples with a peak in each interval."""
+        packed = self._column("membership")
+        matrix = np.unpackbits(packed, axis=1, count=len(self.allSamples), bitorder="little").astype(bool)
+        return matrix if self.sampleIdx is None else matrix[:, self.sampleIdx]
+
+    def values(self, col):
+        """
+        Ragged peak values of col for the view as (offsets, sampleIdx, values): peaks of interval i are
+        offsets[i]:offsets[i + 1] and sampleIdx indexes self.samples. Zero-copy unless samples were selected.
+        """
+        if col not in self.arrays:
+            raise KeyError("Consensus matrix has no '{}' column".format(col))
+        peakOffsets = self.arrays["peak_offsets"][self.lo : self.hi + 1]
+        first = int(peakOffsets[0]) if len(peakOffsets) else 0
+        last = int(peakOffsets[-1]) if len(peakOffsets) else 0
+        offsets = peakOffsets - first
+        sampleIdx = self.arrays["peak_sample"][first:last]
+        values = self.arrays[col][first:last]
+        if self.sampleIdx is None:
+            return offsets, sampleIdx, values
+
+        columnMap = np.full(len(self.allSamples), -1, dtype=np.int64)
+        columnMap[self.sampleIdx] = np.arange(len(self.sampleIdx))
+        mapped = columnMap[sampleIdx]
+        keep = mapped >= 0
+        counts = np.add.reduceat(keep.astype(np.int64), offsets[:-1]) if len(keep) else np.zeros(len(self), np.int64)
+        ## reduceat() RETURNS THE ELEMENT ITSELF FOR EMPTY SEGMENTS
+        counts[np.diff(offsets) == 0] = 0
+        newOffsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=newOffsets[1:])
+        ## PEAKS ARE ORDERED BY THE ORIGINAL SAMPLE COLUMN, REORDER THEM TO THE SELECTED SAMPLE ORDER PER INTERVAL
+        peakInterval = np.repeat(np.arange(len(self)), np.diff(offsets))[keep]
+        order = np.lexsort((mapped[keep], peakInterval))
+        return newOffsets, mapped[keep][order], np.asarray(values)[keep][order]
+
+    def cell(self, col, row, sample):
+        """List of col values for the peaks of sample in interval row of the view."""
+        offsets, sampleIdx, values = self.rows(row, row + 1).values(col)
+        return values[sampleIdx == self.samples.index(sample)].tolist()
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    startTime = time.time()
+    if args.MATRIX_FILE:
+        numIntervals = boolean_to_matrix(args.BOOLEAN_FILE, args.MATRIX_FILE, chunkSize=args.CHUNK_SIZE)
+        print("Converted {} intervals in {:.1f}s".format(numIntervals, time.time() - startTime))
+    else:
+        matrix = ConsensusMatrix.load(args.BOOLEAN_FILE)
+        print("samples\t{}".format(",".join(matrix.samples)))
+        print("intervals\t{}".format(len(matrix)))
+        print("peaks\t{}".format(int(matrix.arrays["peak_offsets"][-1])))
+        for chromID in matrix.chroms:
+            print("{}\t{}".format(chromID, len(matrix.chrom(chromID))))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Fraction of reads in peaks (FRiP) from an indexed BAM file
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import hashlib
+import argparse
+import itertools
+import resource
+import multiprocessing
+
+import pysam
+
+try:
+    from result_cache import cached_run
+except ImportError:
+    cached_run = None
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Calculate the fraction of mapped reads overlapping one or more peak files from an indexed BAM file."
+    Epilog = """Example usage: python frip_score.py <BAM_FILE> <PEAK_FILES> <OUTFILE> --peak_names SAMPLE_R1 --min_overlap 0.2 --threads 4"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument(
+        "BAM_FILE", help="Coordinate-sorted BAM file. A .bai/.csi index enables parallel per-chromosome counting."
+    )
+    argParser.add_argument(
+        "PEAK_FILES", help="Comma-separated list of BED, narrowPeak or broadPeak files to calculate FRiP for."
+    )
+    argParser.add_argument("OUTFILE", help="Tab-delimited output file with one '<name>\\t<FRiP>' line per peak file.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-pn",
+        "--peak_names",
+        dest="PEAK_NAMES",
+        default="",
+        help="Comma-separated list of names written to OUTFILE for each peak file (default: peak file names).",
+    )
+    argParser.add_argument(
+        "-mo",
+        "--min_overlap",
+        type=float,
+        dest="MIN_OVERLAP",
+        default=0.2,
+        help="Minimum fraction of the read that must overlap a peak for it to be counted, as for 'intersectBed -f' (default: 0.2).",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of chromosomes counted in parallel (default: 1).",
+    )
+    argParser.add_argument(
+        "-cd",
+        "--cache_dir",
+        type=str,
+        dest="CACHE_DIR",
+        default="",
+        help="Restore outputs from, or add them to, the result cache in this directory, keyed on the peak files, the BAM index, the size and first and last MB of the BAM file and the parameters that affect the outputs (default: '').",
+    )
+    argParser.add_argument(
+        "-cm",
+        "--cache_max_size",
+        type=int,
+        dest="CACHE_MAX_SIZE",
+        default=10240,
+        help="Maximum size of --cache_dir in MB. Least recently used results are evicted beyond it (default: 10240).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def bam_index_file(BAMFile):
+    """Path of the .bai or .csi index of BAMFile, as found by samtools, or '' if there is none."""
+    for IndexFile in [BAMFile + ".bai", os.path.splitext(BAMFile)[0] + ".bai", BAMFile + ".csi"]:
+        if os.path.exists(IndexFile):
+            return IndexFile
+    return ""
+
+
+def bam_identity(BAMFile, blockSize=1024 * 1024):
+    """
+    Cheap identity of BAMFile for the result cache key: its size and the SHA-256 of its first and last blockSize
+    bytes. The first block holds the header and the last block the final reads and the BGZF EOF marker, so
+    re-sorted, re-filtered or truncated BAMs get a new key without hashing the whole file. The BAM index, which
+    records the file offset of every 16 kb window, is hashed in full as one of the input files instead.
+    """
+    bamSize = os.path.getsize(BAMFile)
+    fin = open(BAMFile, "rb")
+    head = hashlib.sha256(fin.read(blockSize)).hexdigest()
+    fin.seek(max(bamSize - blockSize, 0))
+    tail = hashlib.sha256(fin.read(blockSize)).hexdigest()
+    fin.close()
+    return {"size": bamSize, "head": head, "tail": tail}
+
+
+def load_peaks(PeakFile):
+    """
+    Read a peak file into a dict of {chrom: [(start, end), ...]} sorted by start.
+    Overlapping peaks are kept separate so a read overlapping two peaks is counted twice, as with 'intersectBed -c'.
+    """
+    peakDict = {}
+    fin = open(PeakFile, "r")
+    for line in fin:
+        if not line.strip() or line.startswith(("#", "track", "browser")):
+            continue
+        lspl = line.strip().split("\t")
+        peakDict.setdefault(lspl[0], []).append((int(lspl[1]), int(lspl[2])))
+    fin.close()
+    for chrom in peakDict:
+        peakDict[chrom].sort()
+    return peakDict
+
+
+def format_frip(readsInPeaks, mappedReads):
+    """Format the FRiP score the way awk prints 'a/$1' i.e. '%.6g' (integers print without a decimal point)."""
+    if not mappedReads:
+        return "0"
+    return "%.6g" % (float(readsInPeaks) / mappedReads)
+
+
+############################################
+############################################
+## COUNTING
+############################################
+############################################
+
+
+def count_reads(reads, peakLists, minOverlap):
+    """
+    Count mapped reads and peak overlaps from an iterator of coordinate-sorted alignments.
+    peakLists holds one start-sorted [(start, end), ...] list per peak file for the alignments' chromosome.
+    Returns (mappedReads, [readsInPeaks per peak file]).
+
+    Each peak list is swept with a moving pointer and an active list of peaks that may still overlap
+    the current read, so every peak is visited a bounded number of times regardless of read depth.
+    """
+    mappedReads = 0
+    numSets = len(peakLists)
+    inPeaks = [0] * numSets
+    pointers = [0] * numSets
+    actives = [[] for x in range(numSets)]
+    for read in reads:
+        flag = read.flag
+        if flag & 0x4:
+            continue
+        ## 'samtools flagstat' reports QC-passed mapped reads in the first column
+        if not flag & 0x200:
+            mappedReads += 1
+        readStart = read.reference_start
+        readEnd = read.reference_end
+        if readEnd is None:
+            continue
+        readLength = readEnd - readStart
+        for idx in range(numSets):
+            peaks = peakLists[idx]
+            active = actives[idx]
+            pointer = pointers[idx]
+            while pointer < len(peaks) and peaks[pointer][0] < readEnd:
+                active.append(peaks[pointer])
+                pointer += 1
+            pointers[idx] = pointer
+            stale = False
+            for peakStart, peakEnd in active:
+                if peakEnd <= readStart:
+                    stale = True
+                    continue
+                if peakStart >= readEnd:
+                    continue
+                overlap = min(readEnd, peakEnd) - max(readStart, peakStart)
+                if float(overlap) / readLength >= minOverlap:
+                    inPeaks[idx] += 1
+            ## Reads are sorted by start so peaks ending before this read can never overlap a later one
+            if stale:
+                active[:] = [x for x in active if x[1] > readStart]
+    return mappedReads, inPeaks
+
+
+def count_chromosome(task):
+    """Pool worker: count one chromosome of an indexed BAM file."""
+    BAMFile, chrom, peakLists, minOverlap = task
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    counts = count_reads(bam.fetch(chrom), peakLists, minOverlap)
+    bam.close()
+    return counts
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def frip_score(BAMFile, PeakFiles, minOverlap=0.2, threads=1):
+    """
+    Return (mappedReads, [readsInPeaks per peak file]) for BAMFile.
+
+    With a BAM index every chromosome is fetched and counted independently in a process pool, reading
+    the BAM once for all peak files. Without an index the BAM is streamed once in a single process.
+    """
+    peakDicts = [load_peaks(x) for x in PeakFiles]
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    chroms = list(bam.references)
+    hasIndex = bam.has_index()
+
+    mappedReads = 0
+    inPeaks = [0] * len(PeakFiles)
+    if hasIndex:
+        lengths = dict(zip(chroms, bam.lengths))
+        bam.close()
+        tasks = [(BAMFile, chrom, [x.get(chrom, []) for x in peakDicts], minOverlap) for chrom in chroms]
+        ## Largest chromosomes first so the pool is not left waiting on a big one at the end
+        tasks.sort(key=lambda x: -lengths[x[1]])
+        if threads > 1:
+            pool = multiprocessing.Pool(processes=threads)
+            results = pool.imap_unordered(count_chromosome, tasks)
+        else:
+            pool = None
+            results = map(count_chromosome, tasks)
+        for chromMapped, chromInPeaks in results:
+            mappedReads += chromMapped
+            inPeaks = [x + y for x, y in zip(inPeaks, chromInPeaks)]
+        if pool is not None:
+            pool.close()
+            pool.join()
+    else:
+        print("WARNING: No index found for {}, counting in a single pass without parallelism.".format(BAMFile))
+        for tid, reads in itertools.groupby(bam.fetch(until_eof=True), key=lambda x: x.reference_id):
+            chrom = chroms[tid] if tid >= 0 else None
+            chromMapped, chromInPeaks = count_reads(reads, [x.get(chrom, []) for x in peakDicts], minOverlap)
+            mappedReads += chromMapped
+            inPeaks = [x + y for x, y in zip(inPeaks, chromInPeaks)]
+        bam.close()
+    return mappedReads, inPeaks
+
+
+def main(args=None):
+    args = parse_args(args)
+    PeakFiles = args.PEAK_FILES.split(",")
+    PeakNames = args.PEAK_NAMES.split(",") if args.PEAK_NAMES else [os.path.basename(x) for x in PeakFiles]
+    if len(PeakNames) != len(PeakFiles):
+        print(
+            "ERROR: Number of peak names ({}) does not match number of peak files ({})!".format(
+                len(PeakNames), len(PeakFiles)
+            )
+        )
+        sys.exit(1)
+
+    def run():
+        startTime = time.time()
+        mappedReads, inPeaks = frip_score(
+            BAMFile=args.BAM_FILE, PeakFiles=PeakFiles, minOverlap=args.MIN_OVERLAP, threads=args.THREADS
+        )
+
+        makedir(os.path.dirname(args.OUTFILE))
+        fout = open(args.OUTFILE, "w")
+        for name, readsInPeaks in zip(PeakNames, inPeaks):
+            fout.write("{}\t{}\n".format(name, format_frip(readsInPeaks, mappedReads)))
+        fout.close()
+
+        print(
+            "Counted {} mapped reads against {} peak file(s) in {:.1f}s, peak memory {:.1f} MB".format(
+                mappedReads, len(PeakFiles), time.time() - startTime, peak_memory_mb()
+            )
+        )
+
+    if args.CACHE_DIR and cached_run is not None:
+        IndexFile = bam_index_file(args.BAM_FILE)
+        cached_run(
+            args.CACHE_DIR,
+            os.path.abspath(__file__),
+            PeakFiles + ([IndexFile] if IndexFile else []),
+            {"peak_names": PeakNames, "min_overlap": args.MIN_OVERLAP, "bam": bam_identity(args.BAM_FILE)},
+            {"frip": args.OUTFILE},
+            run,
+            maxSizeMb=args.CACHE_MAX_SIZE,
+        )
+    else:
+        if args.CACHE_DIR:
+            print("WARNING: result_cache.py not found next to this script, --cache_dir is ignored.")
+        run()
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Include regions of a genome with blacklisted regions removed
+#######################################################################
+#######################################################################
+
+import os
+import time
+import errno
+import argparse
+import resource
+
+import numpy as np
+
+try:
+    from result_cache import cached_run
+except ImportError:
+    cached_run = None
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Write the regions of a genome left after removing blacklisted regions as a BED file, as "
+        "'sortBed | complementBed'."
+    )
+    Epilog = """Example usage: python genome_regions.py <SIZES_FILE> <OUTFILE> --blacklist <BLACKLIST_FILE>"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("SIZES_FILE", help="Tab-delimited file of chromosome names and sizes e.g. genome.fa.sizes.")
+    argParser.add_argument("OUTFILE", help="BED file of include regions in the chromosome order of SIZES_FILE.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-bl",
+        "--blacklist",
+        type=str,
+        dest="BLACKLIST",
+        default="",
+        help="BED file of regions to exclude. Whole chromosomes are written without it (default: '').",
+    )
+    argParser.add_argument(
+        "-cd",
+        "--cache_dir",
+        type=str,
+        dest="CACHE_DIR",
+        default="",
+        help="Restore outputs from, or add them to, the result cache in this directory, keyed on the contents of the sizes and blacklist files (default: '').",
+    )
+    argParser.add_argument(
+        "-cm",
+        "--cache_max_size",
+        type=int,
+        dest="CACHE_MAX_SIZE",
+        default=10240,
+        help="Maximum size of --cache_dir in MB. Least recently used results are evicted beyond it (default: 10240).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def read_chrom_sizes(SizesFile):
+    """Return [(chrom, size), ...] in file order."""
+    chromSizes = []
+    fin = open(SizesFile, "r")
+    for line in fin:
+        lspl = line.strip().split("\t")
+        if len(lspl) >= 2:
+            chromSizes.append((lspl[0], int(lspl[1])))
+    fin.close()
+    return chromSizes
+
+
+def read_bed_intervals(BedFile):
+    """Read a BED file into a dict of {chrom: (starts, ends)} NumPy arrays in file order."""
+    intervalDict = {}
+    fin = open(BedFile, "r")
+    for line in fin:
+        if not line.strip() or line.startswith(("#", "track", "browser")):
+            continue
+        lspl = line.strip().split("\t")
+        intervalDict.setdefault(lspl[0], ([], []))
+        intervalDict[lspl[0]][0].append(int(lspl[1]))
+        intervalDict[lspl[0]][1].append(int(lspl[2]))
+    fin.close()
+    return dict(
+        [(x, (np.array(y[0], dtype=np.int64), np.array(y[1], dtype=np.int64))) for x, y in intervalDict.items()]
+    )
+
+
+def merge_intervals(starts, ends):
+    """Sort and merge overlapping and book-ended intervals, returning (starts, ends)."""
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = np.maximum.accumulate(ends[order])
+    ## A new interval starts wherever the start lies beyond every end seen so far
+    newGroup = np.ones(len(starts), dtype=bool)
+    newGroup[1:] = starts[1:] > ends[:-1]
+    groupStarts = np.nonzero(newGroup)[0]
+    groupEnds = np.append(groupStarts[1:], len(starts)) - 1
+    return starts[groupStarts], ends[groupEnds]
+
+
+def complement_intervals(starts, ends, chromLength):
+    """Gaps of length > 0 between merged intervals on a chromosome of chromLength, as for 'complementBed'."""
+    starts = np.clip(starts, 0, chromLength)
+    ends = np.clip(ends, 0, chromLength)
+    gapStarts = np.concatenate([[0], ends])
+    gapEnds = np.concatenate([starts, [chromLength]])
+    keep = gapEnds > gapStarts
+    return gapStarts[keep], gapEnds[keep]
+
+
+def build_include_regions(SizesFile, BlacklistFile=""):
+    """Whole chromosomes of SizesFile minus the regions in BlacklistFile, as [(chrom, starts, ends), ...]."""
+    chromSizes = read_chrom_sizes(SizesFile)
+    blacklist = read_bed_intervals(BlacklistFile) if BlacklistFile else {}
+    includeRegions = []
+    for chrom, size in chromSizes:
+        if chrom in blacklist:
+            includeRegions.append(
+                (chrom,) + complement_intervals(*merge_intervals(*blacklist[chrom]), chromLength=size)
+            )
+        elif size > 0:
+            includeRegions.append((chrom, np.array([0], dtype=np.int64), np.array([size], dtype=np.int64)))
+    return includeRegions
+
+
+def write_bed(includeRegions, BedFile):
+    makedir(os.path.dirname(BedFile))
+    fout = open(BedFile, "w")
+    for chrom, starts, ends in includeRegions:
+        for start, end in zip(starts, ends):
+            fout.write("{}\t{}\t{}\n".format(chrom, start, end))
+    fout.close()
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    def run():
+        startTime = time.time()
+        includeRegions = build_include_regions(args.SIZES_FILE, BlacklistFile=args.BLACKLIST)
+        write_bed(includeRegions, args.OUTFILE)
+        print(
+            "Wrote {} include regions covering {} bp in {:.1f}s, peak memory {:.1f} MB".format(
+                sum([len(x[1]) for x in includeRegions]),
+                sum([int((x[2] - x[1]).sum()) for x in includeRegions]),
+                time.time() - startTime,
+                peak_memory_mb(),
+            )
+        )
+
+    InputFiles = [args.SIZES_FILE] + ([args.BLACKLIST] if args.BLACKLIST else [])
+    OutputFiles = {"bed": args.OUTFILE}
+    if args.CACHE_DIR and cached_run is not None:
+        cached_run(
+            args.CACHE_DIR,
+            os.path.abspath(__file__),
+            InputFiles,
+            {"blacklist": bool(args.BLACKLIST)},
+            OutputFiles,
+            run,
+            maxSizeMb=args.CACHE_MAX_SIZE,
+        )
+    else:
+        if args.CACHE_DIR:
+            print("WARNING: result_cache.py not found next to this script, --cache_dir is ignored.")
+        run()
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Convert a GTF/GFF annotation to BED12, one line per transcript
+## Python port of the gtf2bed Perl script by Erik Aronesty (MIT licence)
+#######################################################################
+#######################################################################
+
+import io
+import os
+import re
+import sys
+import time
+import gzip
+import array
+import errno
+import zipfile
+import argparse
+import resource
+import multiprocessing
+
+try:
+    from result_cache import cached_run
+except ImportError:
+    cached_run = None
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Convert the exons of a GTF or GFF annotation to BED12 with one line per transcript, with the start and stop "
+        "codons as the thick region. Output is identical to the gtf2bed Perl script previously bundled with the pipeline."
+    )
+    Epilog = """Example usage: python gtf2bed.py <GTF_FILE> <OUTFILE> --threads 4"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("GTF_FILE", help="GTF or GFF annotation, optionally compressed with gzip or zip.")
+    argParser.add_argument("OUTFILE", help="BED12 file of transcripts sorted by chromosome and start.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-x",
+        "--extended",
+        dest="EXTENDED",
+        action="store_true",
+        help="Append the gene name, or the gene ID if there is no name, as a 13th column.",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of blocks of the annotation parsed in parallel (default: 1).",
+    )
+    argParser.add_argument(
+        "-bs",
+        "--block_size",
+        type=int,
+        dest="BLOCK_SIZE",
+        default=64,
+        help="Size in MB of the blocks of annotation text handed to each worker with --threads (default: 64).",
+    )
+    argParser.add_argument(
+        "-cd",
+        "--cache_dir",
+        type=str,
+        dest="CACHE_DIR",
+        default="",
+        help="Restore outputs from, or add them to, the result cache in this directory, keyed on the contents of the annotation and the parameters that affect the outputs (default: '').",
+    )
+    argParser.add_argument(
+        "-cm",
+        "--cache_max_size",
+        type=int,
+        dest="CACHE_MAX_SIZE",
+        default=10240,
+        help="Maximum size of --cache_dir in MB. Least recently used results are evicted beyond it (default: 10240).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## Features read from the annotation, all others are skipped
+FEATURES = frozenset(["exon", "miRNA", "start_codon", "stop_codon"])
+
+GFF_VERSION_REGEX = re.compile(r"^##gff-version ([23])", re.M)
+GTF_ID_REGEX = re.compile(r'transcript_id "([^"]+)"')
+GFF_ID_REGEX = re.compile(r'\bID="([^"]+)"')
+GFF3_NAME_REGEX = re.compile(r'\bName=([^";]+)')
+GFF3_EXON_SUFFIX_REGEX = re.compile(r":\d+$")
+GENE_NAME_REGEX = re.compile(r'gene_name "([^"]+)"')
+GENE_ID_REGEX = re.compile(r'gene_id "([^"]+)"')
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def is_true(value):
+    """Perl truthiness of a field: missing, empty and '0' are false."""
+    return value is not None and value != "" and value != "0"
+
+
+def open_annotation(GTFFile):
+    """
+    Open a plain, gzip or zip compressed annotation as text. All members of a zip file are read in turn.
+    Latin-1 maps every byte to one character so IDs are written back byte for byte, whatever their encoding.
+    """
+    if GTFFile.endswith(".gz"):
+        return gzip.open(GTFFile, "rt", encoding="latin-1")
+    if GTFFile.endswith(".zip"):
+        archive = zipfile.ZipFile(GTFFile)
+        text = "".join([archive.read(x).decode("latin-1") for x in archive.namelist()])
+        archive.close()
+        return io.StringIO(text)
+    return open(GTFFile, "r", encoding="latin-1")
+
+
+def iter_blocks(fin, blockSize):
+    """Yield (text, gff version in force at the start of the block) for blocks of whole lines of about blockSize."""
+    gff = 0
+    while True:
+        block = fin.read(blockSize)
+        if not block:
+            return
+        if not block.endswith("\n"):
+            block += fin.readline()
+        yield block, gff
+        if "##gff-version" in block:
+            versions = GFF_VERSION_REGEX.findall(block)
+            if versions:
+                gff = int(versions[-1])
+
+
+class Transcripts:
+    """
+    Exons, start and stop codons of the transcripts in a block of the annotation.
+    Exon coordinates are kept per transcript in a flat array of (start, end) pairs.
+    """
+
+    def __init__(self):
+        ## {id: (chrom, strand, first start, attributes)} from the first exon (or miRNA) seen
+        self.first = {}
+        self.exons = {}
+        self.codons = {}
+
+    def parse(self, block, gff, lineOffset=0, extended=False):
+        """Parse a block of lines with the GFF version in force at its start. Returns the GFF version at its end."""
+        for lineNo, line in enumerate(block.split("\n"), start=lineOffset + 1):
+            if line.startswith("#"):
+                if line.startswith("##gff-version 2"):
+                    gff = 2
+                elif line.startswith("##gff-version 3"):
+                    gff = 3
+                if gff:
+                    continue
+
+            ## 0-chr 1-src 2-feat 3-beg 4-end 5-scor 6-dir 7-fram 8-attr
+            lspl = line.rstrip(" \t\r\n\f\v").split("\t")
+            if len(lspl) < 9:
+                continue
+            ## Other features are ignored, so skip them before the more expensive ID lookup
+            feature = lspl[2]
+            if feature not in FEATURES:
+                continue
+            attr = lspl[8]
+            if gff:
+                ## Most version 2 files put gene names in the ID field, most version 3 ones use unquoted names
+                match = GFF_ID_REGEX.search(attr)
+                if not match and gff == 3:
+                    match = GFF3_NAME_REGEX.search(attr)
+            else:
+                match = GTF_ID_REGEX.search(attr)
+            if not match:
+                continue
+            txId = match.group(1)
+            if txId == "0" or not is_true(lspl[0]):
+                continue
+
+            if feature == "exon" or feature == "miRNA":
+                if feature == "exon":
+                    if not is_true(lspl[3]):
+                        print("ERROR: no position at exon on line {}".format(lineNo))
+                        sys.exit(1)
+                    ## GFF3 sometimes appends ':<number>' to exon IDs
+                    if gff == 3:
+                        txId = GFF3_EXON_SUFFIX_REGEX.sub("", txId)
+                start = int(lspl[3])
+                if txId not in self.first:
+                    self.first[txId] = (lspl[0], lspl[6], start, attr if extended else "")
+                    self.exons[txId] = array.array("q")
+                self.exons[txId].extend((start, int(lspl[4])))
+            elif feature == "start_codon":
+                self.codons.setdefault(txId, [None, None])[0] = lspl[3]
+            elif feature == "stop_codon":
+                self.codons.setdefault(txId, [None, None])[1] = lspl[4]
+        return gff
+
+    def merge(self, other):
+        """Add the transcripts of the block following this one."""
+        for txId, first in other.first.items():
+            if txId in self.first:
+                self.exons[txId].extend(other.exons[txId])
+            else:
+                self.first[txId] = first
+                self.exons[txId] = other.exons[txId]
+        for txId, (codonStart, codonEnd) in other.codons.items():
+            codons = self.codons.setdefault(txId, [None, None])
+            if codonStart is not None:
+                codons[0] = codonStart
+            if codonEnd is not None:
+                codons[1] = codonEnd
+        return self
+
+    def bed_lines(self, extended=False):
+        """Yield BED12 lines sorted by chromosome, then start of the first exon seen for each transcript."""
+        for txId in sorted(self.first, key=lambda x: (self.first[x][0], self.first[x][2])):
+            chrom, strand, firstStart, attr = self.first[txId]
+            exons = self.exons[txId]
+            exonList = sorted(zip(exons[0::2], exons[1::2]), key=lambda x: x[0])
+            txStart = exonList[0][0]
+            txEnd = exonList[-1][1]
+
+            codonStart, codonEnd = self.codons.get(txId, [None, None])
+            cdsStart = int(codonStart) if is_true(codonStart) else 0
+            cdsEnd = int(codonEnd) if is_true(codonEnd) else 0
+            if strand == "-":
+                cdsStart, cdsEnd = cdsEnd, cdsStart
+                if cdsStart:
+                    cdsStart -= 2
+                if cdsEnd:
+                    cdsEnd += 2
+            ## Without codons the thick region spans the exons
+            if not cdsStart:
+                cdsStart = txStart
+            if not cdsEnd:
+                cdsEnd = txEnd
+
+            fields = [
+                chrom,
+                str(txStart - 1),
+                str(txEnd),
+                txId,
+                "0",
+                strand,
+                str(cdsStart - 1),
+                str(cdsEnd),
+                "0",
+                str(len(exonList)),
+                ",".join([str(x[1] - x[0] + 1) for x in exonList]) + ",",
+                ",".join([str(x[0] - txStart) for x in exonList]) + ",",
+            ]
+            line = "\t".join(fields)
+            if extended:
+                match = GENE_NAME_REGEX.search(attr) or GENE_ID_REGEX.search(attr)
+                line += "\t" + (match.group(1) if match else "")
+            yield line
+
+
+def parse_block(task):
+    """Pool worker: parse one block of the annotation."""
+    block, gff, lineOffset, extended = task
+    transcripts = Transcripts()
+    transcripts.parse(block, gff, lineOffset=lineOffset, extended=extended)
+    return transcripts
+
+
+def iter_tasks(fin, blockSize, extended):
+    lineOffset = 0
+    for block, gff in iter_blocks(fin, blockSize):
+        yield block, gff, lineOffset, extended
+        lineOffset += block.count("\n")
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def gtf2bed(GTFFile, OutFile, extended=False, threads=1, blockSize=64 * 1024 * 1024):
+    """
+    Stream GTFFile and write one BED12 line per transcript to OutFile. Returns the number of transcripts.
+
+    The annotation is read in blocks of whole lines. With threads > 1 blocks are parsed in a process pool and the
+    per-block transcripts are merged in file order, so the output does not depend on the number of threads.
+    """
+    fin = open_annotation(GTFFile)
+    tasks = iter_tasks(fin, blockSize, extended)
+    if threads > 1:
+        pool = multiprocessing.Pool(processes=threads)
+        results = pool.imap(parse_block, tasks)
+    else:
+        pool = None
+        results = map(parse_block, tasks)
+    transcripts = Transcripts()
+    for blockTranscripts in results:
+        transcripts.merge(blockTranscripts)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    fin.close()
+
+    makedir(os.path.dirname(OutFile))
+    fout = open(OutFile, "w", encoding="latin-1")
+    for line in transcripts.bed_lines(extended=extended):
+        fout.write(line + "\n")
+    fout.close()
+    return len(transcripts.first)
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    def run():
+        startTime = time.time()
+        numTranscripts = gtf2bed(
+            args.GTF_FILE,
+            args.OUTFILE,
+            extended=args.EXTENDED,
+            threads=args.THREADS,
+            blockSize=max(args.BLOCK_SIZE, 1) * 1024 * 1024,
+        )
+        print(
+            "Wrote {} transcripts in {:.1f}s, peak memory {:.1f} MB".format(
+                numTranscripts, time.time() - startTime, peak_memory_mb()
+            )
+        )
+
+    if args.CACHE_DIR and cached_run is not None:
+        cached_run(
+            args.CACHE_DIR,
+            os.path.abspath(__file__),
+            [args.GTF_FILE],
+            {"extended": args.EXTENDED},
+            {"bed": args.OUTFILE},
+            run,
+            maxSizeMb=args.CACHE_MAX_SIZE,
+        )
+    else:
+        if args.CACHE_DIR:
+            print("WARNING: result_cache.py not found next to this script, --cache_dir is ignored.")
+        run()
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -7,8 +7,39 @@
 #######################################################################
 
 import os
+import sys
 import errno
+import time
+import heapq
+import hashlib
+import shutil
 import argparse
+import resource
+import tempfile
+import itertools
+import contextlib
+import collections
+import multiprocessing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from result_cache import cached_run
+except ImportError:
+    cached_run = None
+
+try:
+    from consensus_matrix import ConsensusMatrixWriter, boolean_to_matrix
+except ImportError:
+    ConsensusMatrixWriter = None
+
+try:
+    from perf_stats import PerfRecorder
+except ImportError:
+    PerfRecorder = None
 
 ############################################
 ############################################
@@ -16,36 +47,176 @@ import argparse
 ############################################
 ############################################
 
-Description = "Add sample boolean files and aggregate columns from merged MACS narrow or broad peak file."
-Epilog = """Example usage: python macs2_merged_expand.py <MERGED_INTERVAL_FILE> <SAMPLE_NAME_LIST> <OUTFILE> --is_narrow_peak --min_replicates 1"""
 
-argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+def parse_args(args=None):
+    Description = "Add sample boolean files and aggregate columns from merged MACS narrow or broad peak file."
+    Epilog = """Example usage: python macs2_merged_expand.py <MERGED_INTERVAL_FILE> <SAMPLE_NAME_LIST> <OUTFILE> --is_narrow_peak --min_replicates 1"""
 
-## REQUIRED PARAMETERS
-argParser.add_argument("MERGED_INTERVAL_FILE", help="Merged MACS2 interval file created using linux sort and mergeBed.")
-argParser.add_argument(
-    "SAMPLE_NAME_LIST",
-    help="Comma-separated list of sample names as named in individual MACS2 broadPeak/narrowPeak output file e.g. SAMPLE_R1 for SAMPLE_R1_peak_1.",
-)
-argParser.add_argument("OUTFILE", help="Full path to output directory.")
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument(
+        "MERGED_INTERVAL_FILE",
+        help="Merged MACS2 interval file created using linux sort and mergeBed, comma-separated list of coordinate-sorted MACS2 broadPeak/narrowPeak files when --peak_files is provided, or manifest of groups when --manifest is provided.",
+    )
+    argParser.add_argument(
+        "SAMPLE_NAME_LIST",
+        help="Comma-separated list of sample names as named in individual MACS2 broadPeak/narrowPeak output file e.g. SAMPLE_R1 for SAMPLE_R1_peak_1, or of the groups in the manifest to process when --manifest is provided.",
+    )
+    argParser.add_argument(
+        "OUTFILE",
+        help="Full path to output boolean file. With --manifest, '{group}' is replaced by the name of each group.",
+    )
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-in",
+        "--is_narrow_peak",
+        dest="IS_NARROW_PEAK",
+        help="Whether merged interval file was generated from narrow or broad peak files (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-mr",
+        "--min_replicates",
+        type=int,
+        dest="MIN_REPLICATES",
+        default=1,
+        help="Minumum number of replicates per sample required to contribute to merged peak (default: 1).",
+    )
+    argParser.add_argument(
+        "-cs",
+        "--chunk_size",
+        type=int,
+        dest="CHUNK_SIZE",
+        default=0,
+        help="Number of merged intervals parsed per batch by the NumPy engine. 0 uses 100000, or a size scaled to the number of samples in --streaming mode (default: 0).",
+    )
+    argParser.add_argument(
+        "-pf",
+        "--peak_files",
+        dest="PEAK_FILES",
+        help="Merge the individual MACS2 peak files listed in MERGED_INTERVAL_FILE in-process instead of reading mergeBed output (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-mf",
+        "--manifest",
+        dest="MANIFEST",
+        help="Build the consensus of several groups, e.g. antibodies, in one run. MERGED_INTERVAL_FILE is a tab-separated manifest of group, sample name and coordinate-sorted peak file per line and the groups are processed by a pool of --threads workers. Peak files listed for more than one group are parsed once and shared. '{group}' in OUTFILE and the other output paths is replaced by the name of each group (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-bf",
+        "--bed_file",
+        type=str,
+        dest="BED_FILE",
+        default="",
+        help="Also write consensus intervals to this BED file (default: '').",
+    )
+    argParser.add_argument(
+        "-sf",
+        "--saf_file",
+        type=str,
+        dest="SAF_FILE",
+        default="",
+        help="Also write consensus intervals to this SAF file for featureCounts (default: '').",
+    )
+    argParser.add_argument(
+        "-mx",
+        "--matrix_file",
+        type=str,
+        dest="MATRIX_FILE",
+        default="",
+        help="Also write the consensus intervals as a binary .npz matrix with packed sample membership bits and ragged per-peak value arrays that can be read with consensus_matrix.py (default: '').",
+    )
+    argParser.add_argument(
+        "-st",
+        "--streaming",
+        dest="STREAMING",
+        help="Bound memory for large cohorts by spilling sample combination counts to disk once --max_combinations distinct combinations are held (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-mc",
+        "--max_combinations",
+        type=int,
+        dest="MAX_COMBINATIONS",
+        default=1000000,
+        help="Maximum number of distinct sample combinations held in memory in --streaming mode (default: 1000000).",
+    )
+    argParser.add_argument(
+        "-td",
+        "--tmp_dir",
+        type=str,
+        dest="TMP_DIR",
+        default=".",
+        help="Directory for temporary files spilled in --streaming mode (default: '.').",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of processes expanding batches of merged intervals in parallel with the NumPy batch engine, or building the consensus of the groups in parallel with --manifest. Output is identical to a serial run (default: 1).",
+    )
+    argParser.add_argument(
+        "-ix",
+        "--index_file",
+        type=str,
+        dest="INDEX_FILE",
+        default="",
+        help="Also write a consensus index of every merged interval, its stable interval ID and contributing peaks to this .npz file so samples can be added later with --previous_index. Requires --peak_files (default: '').",
+    )
+    argParser.add_argument(
+        "-pi",
+        "--previous_index",
+        type=str,
+        dest="PREVIOUS_INDEX",
+        default="",
+        help="Fold the peak files in MERGED_INTERVAL_FILE for the samples in SAMPLE_NAME_LIST into a consensus index written by a previous run with --index_file. Peaks already indexed for these samples are replaced. Interval IDs are kept where interval boundaries are unchanged and the changes are written to <OUTFILE>.diff.txt. Requires --peak_files (default: '').",
+    )
+    argParser.add_argument(
+        "-cd",
+        "--cache_dir",
+        type=str,
+        dest="CACHE_DIR",
+        default="",
+        help="Restore outputs from, or add them to, the result cache in this directory, keyed on the contents of the input files and the parameters that affect the outputs (default: '').",
+    )
+    argParser.add_argument(
+        "-cm",
+        "--cache_max_size",
+        type=int,
+        dest="CACHE_MAX_SIZE",
+        default=10240,
+        help="Maximum size of --cache_dir in MB. Least recently used results are evicted beyond it (default: 10240).",
+    )
+    argParser.add_argument(
+        "-lg",
+        "--legacy",
+        dest="LEGACY",
+        help="Use the original line-by-line implementation instead of the NumPy batch engine (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-ps",
+        "--perf_file",
+        type=str,
+        dest="PERF_FILE",
+        default="",
+        help="Write the time, rows processed and peak memory of the parse, group, write and summary phases to this *.perf.json file (default: '').",
+    )
+    argParser.add_argument(
+        "-pp",
+        "--profile",
+        dest="PROFILE",
+        help="Also profile the run with cProfile and trace allocations with tracemalloc for --perf_file. Both can also be enabled with the PERF_PROFILE and PERF_TRACEMALLOC environment variables (default: False).",
+        action="store_true",
+    )
+    return argParser.parse_args(args)
 
-## OPTIONAL PARAMETERS
-argParser.add_argument(
-    "-in",
-    "--is_narrow_peak",
-    dest="IS_NARROW_PEAK",
-    help="Whether merged interval file was generated from narrow or broad peak files (default: False).",
-    action="store_true",
-)
-argParser.add_argument(
-    "-mr",
-    "--min_replicates",
-    type=int,
-    dest="MIN_REPLICATES",
-    default=1,
-    help="Minumum number of replicates per sample required to contribute to merged peak (default: 1).",
-)
-args = argParser.parse_args()
 
 ############################################
 ############################################
@@ -64,6 +235,68 @@ def makedir(path):
                 raise
 
 
+def sample_from_peak_name(name):
+    """Strip the trailing '_peak_<N>' added by MACS2 e.g. SAMPLE_R1_peak_1 -> SAMPLE_R1."""
+    fields = name.rsplit("_", 2)
+    return fields[0] if len(fields) == 3 else ""
+
+
+def group_from_sample(sample):
+    """Strip the trailing replicate suffix e.g. SAMPLE_R1 -> SAMPLE."""
+    return "_".join(sample.split("_")[:-1])
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def perf_phase(perf, name):
+    """Time the body of a with statement as phase name of the PerfRecorder perf, if any."""
+    return perf.phase(name) if perf is not None else contextlib.nullcontext()
+
+
+def perf_iter(perf, name, iterable, rows=None):
+    """Count the time taken to produce the items of iterable as phase name of the PerfRecorder perf, if any."""
+    return perf.timed_iter(name, iterable, rows=rows) if perf is not None else iterable
+
+
+def write_bed_saf_files(BooleanFile, BedFile="", SafFile=""):
+    """Write consensus BED and featureCounts SAF files from the first columns of an existing boolean file."""
+    fbed = open(BedFile, "w") if BedFile else None
+    fsaf = open(SafFile, "w") if SafFile else None
+    if fsaf:
+        fsaf.write("GeneID\tChr\tStart\tEnd\tStrand\n")
+    with open(BooleanFile, "r") as fin:
+        fin.readline()
+        for line in fin:
+            chromID, mstart, mend, intervalID = line.split("\t", 4)[:4]
+            if fbed:
+                fbed.write("%s\t%s\t%s\t%s\t0\t+\n" % (chromID, mstart, mend, intervalID))
+            if fsaf:
+                fsaf.write("%s\t%s\t%s\t%s\t+\n" % (intervalID, chromID, mstart, mend))
+    for fh in [fbed, fsaf]:
+        if fh:
+            fh.close()
+
+
+def write_intersect_file(combFreqDict, OutFile):
+    """Write the UpSetR-compatible sample combination frequencies next to OutFile."""
+    fout = open(OutFile[:-4] + ".intersect.txt", "w")
+    combFreqItems = sorted([(combFreqDict[x], x) for x in combFreqDict.keys()], reverse=True)
+    for k, v in combFreqItems:
+        fout.write("%s\t%s\n" % ("&".join(v), k))
+    fout.close()
+
+
 ############################################
 ############################################
 ## MAIN FUNCTION
@@ -197,26 +430,1345 @@ def macs2_merged_expand(MergedIntervalTxtFile, SampleNameList, OutFile, isNarrow
 
     ## WRITE FILE FOR INTERVAL INTERSECT ACROSS SAMPLES.
     ## COMPATIBLE WITH UPSETR PACKAGE.
-    fout = open(OutFile[:-4] + ".intersect.txt", "w")
-    combFreqItems = sorted([(combFreqDict[x], x) for x in combFreqDict.keys()], reverse=True)
-    for k, v in combFreqItems:
-        fout.write("%s\t%s\n" % ("&".join(v), k))
+    write_intersect_file(combFreqDict, OutFile)
+
+
+############################################
+############################################
+## NUMPY BATCH ENGINE
+############################################
+############################################
+
+## The batch engine produces byte-identical output to macs2_merged_expand() above. Merged intervals are read in
+## chunks and every comma-collapsed column is flattened into a single typed array per chunk. The interval each
+## peak belongs to is recovered from an offset index built from the number of peaks per interval, so the sample
+## boolean matrix, the replicate threshold mask and the per-sample aggregate columns are computed as group-bys
+## over the whole chunk rather than by rebuilding dictionaries for every row.
+
+
+if np is not None:
+    BOOL_STRINGS = np.array(["FALSE", "TRUE"], dtype=object)
+    RUN_SEPARATORS = np.array([";", "\x00"], dtype=object)
+
+## INTERVALS PER CHUNK AND, IN --streaming MODE, THE APPROXIMATE NUMBER OF INTERVAL X SAMPLE CELLS PER CHUNK
+DEFAULT_CHUNK_SIZE = 100000
+STREAMING_CHUNK_CELLS = 200000
+
+## BUFFER SIZE FOR THE BOOLEAN, BED AND SAF OUTPUT FILES
+WRITE_BUFFER_SIZE = 1 << 20
+
+## POSITION OF THE COLLAPSED PEAK COLUMNS IN THE MERGEBED OUTPUT. SUBTRACT 2 FOR THE ORIGINAL PEAK FILE COLUMNS.
+COLLAPSED_COLUMNS = {"start": 3, "end": 4, "name": 5, "fc": 8, "pval": 9, "qval": 10, "summit": 11}
+
+
+class SampleIndex:
+    """
+    Map sample names to column indices. Samples provided on the command-line occupy the first columns in sorted
+    order, samples only seen in the peak names are appended as they are encountered so they still contribute to
+    'num_samples' and the intersect file as in the original implementation.
+    """
+
+    def __init__(self, SampleNameList):
+        self.names = sorted(SampleNameList)
+        self.numOutput = len(self.names)
+        self.index = {x: idx for idx, x in enumerate(self.names)}
+        self.groupIndex = {}
+        self.groups = []
+        for sample in self.names:
+            self._add_group(sample)
+
+    def _add_group(self, sample):
+        gID = group_from_sample(sample)
+        if gID not in self.groupIndex:
+            self.groupIndex[gID] = len(self.groupIndex)
+        self.groups.append(self.groupIndex[gID])
+
+    def lookup(self, samples):
+        for sample in sorted(set(samples).difference(self.index)):
+            self.index[sample] = len(self.names)
+            self.names.append(sample)
+            self._add_group(sample)
+        return np.fromiter(map(self.index.__getitem__, samples), dtype=np.int64, count=len(samples))
+
+    def group_matrix(self):
+        groupMatrix = np.zeros((len(self.names), len(self.groupIndex)), dtype=np.int32)
+        groupMatrix[np.arange(len(self.names)), self.groups] = 1
+        return groupMatrix
+
+
+class IntervalChunk:
+    """
+    Flat typed arrays for a chunk of merged intervals. Per-peak arrays are concatenated across intervals and
+    'offsets' holds the position of the first peak of each interval i.e. peaks for interval i are
+    offsets[i]:offsets[i + 1].
+    """
+
+    def __init__(self, chroms, mstarts, mends, numPeaks, tokens, sampleIndex, isNarrow=False, intervalIds=None):
+        self.chroms = chroms
+        self.intervalIds = intervalIds
+        self.mstarts = np.fromiter(map(int, mstarts), dtype=np.int64, count=len(mstarts))
+        self.mends = np.fromiter(map(int, mends), dtype=np.int64, count=len(mends))
+        self.numPeaks = np.array(numPeaks, dtype=np.int64)
+        self.offsets = np.zeros(len(chroms) + 1, dtype=np.int64)
+        np.cumsum(self.numPeaks, out=self.offsets[1:])
+        self.intervalIdx = np.repeat(np.arange(len(chroms), dtype=np.int64), self.numPeaks)
+        self.sampleIdx = sampleIndex.lookup([sample_from_peak_name(x) for x in tokens["name"]])
+
+        self.values = {}
+        for col, dtype, conv in [
+            ("start", np.int64, int),
+            ("end", np.int64, int),
+            ("fc", np.float64, float),
+            ("qval", np.float64, float),
+            ("pval", np.float64, float),
+            ("summit", np.int64, int),
+        ]:
+            if col == "summit" and not isNarrow:
+                continue
+            self.values[col] = np.fromiter(map(conv, tokens[col]), dtype=dtype, count=len(tokens[col]))
+
+    @classmethod
+    def from_lines(cls, lines, sampleIndex, isNarrow=False):
+        """Build a chunk from mergeBed output lines with comma-collapsed peak columns."""
+        chroms, mstarts, mends = [], [], []
+        cols = {x: [] for x in COLLAPSED_COLUMNS}
+        for line in lines:
+            lspl = line.strip().split("\t")
+            chroms.append(lspl[0])
+            mstarts.append(lspl[1])
+            mends.append(lspl[2])
+            for col, idx in COLLAPSED_COLUMNS.items():
+                if col != "summit" or isNarrow:
+                    cols[col].append(lspl[idx])
+        numPeaks = [x.count(",") + 1 for x in cols["name"]]
+        tokens = {col: ",".join(values).split(",") for col, values in cols.items() if values}
+        return cls(chroms, mstarts, mends, numPeaks, tokens, sampleIndex, isNarrow=isNarrow)
+
+    @classmethod
+    def from_records(cls, records, sampleIndex, isNarrow=False):
+        """
+        Build a chunk from merged intervals yielded by merge_peak_files(). Records may carry a fifth field with a
+        stable interval ID to write instead of numbering consensus intervals sequentially.
+        """
+        chroms, mstarts, mends, numPeaks, intervalIds = [], [], [], [], []
+        cols = {x: [] for x in COLLAPSED_COLUMNS}
+        for record in records:
+            chromID, mstart, mend, peaks = record[:4]
+            if len(record) > 4:
+                intervalIds.append(record[4])
+            chroms.append(chromID)
+            mstarts.append(mstart)
+            mends.append(mend)
+            numPeaks.append(len(peaks))
+            for lspl in peaks:
+                for col, idx in COLLAPSED_COLUMNS.items():
+                    if col != "summit" or isNarrow:
+                        cols[col].append(lspl[idx - 2])
+        return cls(
+            chroms,
+            mstarts,
+            mends,
+            numPeaks,
+            cols,
+            sampleIndex,
+            isNarrow=isNarrow,
+            intervalIds=np.array(intervalIds, dtype=np.int64) if intervalIds else None,
+        )
+
+    def __len__(self):
+        return len(self.chroms)
+
+
+def expand_chunk(chunk, sampleIndex, minReplicates=1):
+    """
+    Vectorised equivalent of the per-row loop in macs2_merged_expand(). Returns the boolean matrix of samples that
+    pass the replicate threshold, the mask of intervals that are written, a dict of per-sample aggregate columns and
+    the positions of the peaks in those columns ordered by interval and sample. Aggregate columns are object matrices
+    (interval x sample) of ';'-joined strings with 'NA' where a sample has no peak.
+    """
+    numIntervals = len(chunk)
+    numSamples = len(sampleIndex.names)
+
+    ## SAMPLE BOOLEAN MATRIX
+    present = np.zeros((numIntervals, numSamples), dtype=bool)
+    present[chunk.intervalIdx, chunk.sampleIdx] = True
+
+    ## REPLICATE THRESHOLD MASK: NUMBER OF SAMPLES PER GROUP PER INTERVAL
+    groupCounts = present.astype(np.int32) @ sampleIndex.group_matrix()
+    passed = present & (groupCounts >= minReplicates)[:, sampleIndex.groups]
+    keep = passed.any(axis=1)
+
+    ## PER-SAMPLE AGGREGATE COLUMNS. A STABLE SORT ON (INTERVAL, SAMPLE) KEEPS THE ORIGINAL PEAK ORDER.
+    peakKeep = passed[chunk.intervalIdx, chunk.sampleIdx] & (chunk.sampleIdx < sampleIndex.numOutput)
+    peakPos = np.flatnonzero(peakKeep)
+    key = chunk.intervalIdx[peakPos] * numSamples + chunk.sampleIdx[peakPos]
+    order = np.argsort(key, kind="stable")
+    peakPos = peakPos[order]
+    key = key[order]
+    lastInRun = np.append(key[1:] != key[:-1], True) if len(key) else np.zeros(0, dtype=bool)
+    runKey = key[lastInRun]
+    runIdx = (runKey // numSamples) * sampleIndex.numOutput + runKey % numSamples
+
+    ## ';'-JOIN EVERY RUN WITH A SINGLE STRING JOIN AND SPLIT ON A RUN SEPARATOR
+    seps = RUN_SEPARATORS[lastInRun.astype(np.intp)].tolist()
+    columns = {}
+    for col, values in chunk.values.items():
+        flat = np.empty(numIntervals * sampleIndex.numOutput, dtype=object)
+        flat[:] = "NA"
+        if len(key):
+            parts = [None] * (2 * len(key))
+            parts[::2] = map(str, values[peakPos].tolist())
+            parts[1::2] = seps
+            flat[runIdx] = "".join(parts)[:-1].split("\x00")
+        columns[col] = flat.reshape(numIntervals, sampleIndex.numOutput)
+
+    return passed, keep, columns, peakPos
+
+
+def chunk_matrix_batch(chunk, passed, keepIdx, peakPos, numOutput):
+    """Return the consensus matrix arrays of the written intervals of a chunk, see ConsensusMatrixWriter."""
+    batch = {
+        "chroms": [chunk.chroms[x] for x in keepIdx.tolist()],
+        "starts": chunk.mstarts[keepIdx],
+        "ends": chunk.mends[keepIdx],
+        "num_peaks": chunk.numPeaks[keepIdx],
+        "num_samples": passed[keepIdx].sum(axis=1),
+        "membership": passed[keepIdx, :numOutput],
+        "peak_counts": np.bincount(chunk.intervalIdx[peakPos], minlength=len(chunk))[keepIdx],
+        "peak_sample": chunk.sampleIdx[peakPos].astype(np.int32),
+    }
+    for col, values in chunk.values.items():
+        batch[col] = values[peakPos]
+    return batch
+
+
+def iter_chunks(iterable, chunkSize):
+    """Yield successive lists of at most chunkSize items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunkSize))
+        if not chunk:
+            break
+        yield chunk
+
+
+class CombinationCounter:
+    """
+    Count sample combinations keyed by integer bitsets where bit i is set when column i of the SampleIndex passes
+    the replicate threshold. With maxEntries > 0 at most that many keys are held in memory: a full table is spilled
+    to a run file sorted by key and cleared. Runs are reduced with a k-way merge and externally sorted when the
+    intersect file is written so memory stays bounded however many distinct combinations a cohort produces.
+    """
+
+    def __init__(self, sampleIndex, maxEntries=0, tmpDir=None):
+        self.sampleIndex = sampleIndex
+        self.maxEntries = maxEntries
+        self.tmpDir = tmpDir
+        self.table = {}
+        self.keyRuns = []
+        self.numRuns = 0
+        self.spillDir = None
+
+    def add_matrix(self, passed):
+        """Count every row of a boolean interval x sample matrix."""
+        for bitset, count in zip(*combination_bitsets(passed)):
+            self.add(bitset, count)
+
+    def add(self, bitset, count=1):
+        if bitset in self.table:
+            self.table[bitset] += count
+        else:
+            if self.maxEntries and len(self.table) >= self.maxEntries:
+                self._spill()
+            self.table[bitset] = count
+
+    def samples(self, bitset):
+        names = self.sampleIndex.names
+        return tuple(sorted(names[idx] for idx in range(bitset.bit_length()) if bitset >> idx & 1))
+
+    def _new_run(self, runs):
+        if self.spillDir is None:
+            self.spillDir = tempfile.mkdtemp(prefix="macs2_merged_expand.", dir=self.tmpDir)
+        path = os.path.join(self.spillDir, "run_{}.txt".format(self.numRuns))
+        self.numRuns += 1
+        runs.append(path)
+        return path
+
+    def _spill(self):
+        with open(self._new_run(self.keyRuns), "w") as fout:
+            for bitset in sorted(self.table):
+                fout.write("%x\t%d\n" % (bitset, self.table[bitset]))
+        self.table = {}
+
+    @staticmethod
+    def _read_key_run(path):
+        with open(path, "r") as fin:
+            for line in fin:
+                key, count = line.split("\t")
+                yield int(key, 16), int(count)
+
+    @staticmethod
+    def _read_intersect_run(path):
+        with open(path, "r") as fin:
+            for line in fin:
+                yield line
+
+    @staticmethod
+    def _intersect_key(line):
+        samples, count = line.rstrip("\n").split("\t")
+        return int(count), tuple(samples.split("&"))
+
+    def reduced_items(self):
+        """Yield (bitset, count) with counts summed across the in-memory table and every spilled run."""
+        if not self.keyRuns:
+            for item in self.table.items():
+                yield item
+            return
+        self._spill()
+        prevKey, total = None, 0
+        for key, count in heapq.merge(*[self._read_key_run(x) for x in self.keyRuns]):
+            if key != prevKey:
+                if prevKey is not None:
+                    yield prevKey, total
+                prevKey, total = key, 0
+            total += count
+        if prevKey is not None:
+            yield prevKey, total
+
+    def write_intersect_file(self, OutFile):
+        if not self.keyRuns:
+            write_intersect_file({self.samples(k): v for k, v in self.table.items()}, OutFile)
+            return
+
+        ## EXTERNAL SORT OF THE REDUCED COMBINATIONS BY DESCENDING (COUNT, SAMPLES)
+        intersectRuns = []
+        for items in iter_chunks(self.reduced_items(), self.maxEntries):
+            combFreqItems = sorted([(v, self.samples(k)) for k, v in items], reverse=True)
+            with open(self._new_run(intersectRuns), "w") as fout:
+                for k, v in combFreqItems:
+                    fout.write("%s\t%s\n" % ("&".join(v), k))
+        with open(OutFile[:-4] + ".intersect.txt", "w") as fout:
+            for line in heapq.merge(
+                *[self._read_intersect_run(x) for x in intersectRuns], key=self._intersect_key, reverse=True
+            ):
+                fout.write(line)
+        shutil.rmtree(self.spillDir)
+        self.spillDir = None
+
+
+def combination_bitsets(passed):
+    """Return the distinct rows of a boolean interval x sample matrix as integer bitsets and their counts."""
+    if len(passed) == 0:
+        return [], []
+    packed = np.packbits(passed, axis=1, bitorder="little")
+    combs, counts = np.unique(packed, axis=0, return_counts=True)
+    return [int.from_bytes(x.tobytes(), "little") for x in combs], counts.tolist()
+
+
+def expand_chunk_rows(chunk, sampleIndex, isNarrow=False, minReplicates=1, matrix=False):
+    """
+    Expand an IntervalChunk into the boolean file fields of its consensus intervals. Returns the mask of intervals
+    that are written, the boolean matrix of those intervals, their 'chr<TAB>start<TAB>end' fields, the tab-joined
+    fields that follow interval_id, their stable interval IDs if the chunk carries them (otherwise None) and, with
+    matrix=True, their consensus matrix arrays (otherwise None).
+    """
+    passed, keep, columns, peakPos = expand_chunk(chunk, sampleIndex, minReplicates=minReplicates)
+    keepIdx = np.flatnonzero(keep)
+    matrixBatch = chunk_matrix_batch(chunk, passed, keepIdx, peakPos, sampleIndex.numOutput) if matrix else None
+    if len(keepIdx) == 0:
+        return keep, passed[keepIdx], [], [], None if chunk.intervalIds is None else [], matrixBatch
+
+    numOutput = sampleIndex.numOutput
+    colOrder = ["fc", "qval", "pval", "start", "end"] + (["summit"] if isNarrow else [])
+    rowMatrix = np.empty((len(keepIdx), 5 + numOutput * (len(colOrder) + 1)), dtype=object)
+    rowMatrix[:, 0] = [chunk.chroms[x] for x in keepIdx.tolist()]
+    rowMatrix[:, 1] = list(map(str, chunk.mstarts[keepIdx].tolist()))
+    rowMatrix[:, 2] = list(map(str, chunk.mends[keepIdx].tolist()))
+    rowMatrix[:, 3] = list(map(str, chunk.numPeaks[keepIdx].tolist()))
+    rowMatrix[:, 4] = list(map(str, passed[keepIdx].sum(axis=1).tolist()))
+    rowMatrix[:, 5 : 5 + numOutput] = BOOL_STRINGS[passed[keepIdx, :numOutput].astype(np.intp)]
+    for idx, col in enumerate(colOrder):
+        rowMatrix[:, 5 + numOutput * (idx + 1) : 5 + numOutput * (idx + 2)] = columns[col][keepIdx]
+
+    rows = rowMatrix.tolist()
+    heads = ["\t".join(x[:3]) for x in rows]
+    tails = ["\t".join(x[3:]) for x in rows]
+    intervalIds = chunk.intervalIds[keepIdx].tolist() if chunk.intervalIds is not None else None
+    return keep, passed[keepIdx], heads, tails, intervalIds, matrixBatch
+
+
+def expand_batch(batch, sampleIndex, fromLines=False, isNarrow=False, minReplicates=1, matrix=False):
+    """
+    Build and expand one batch of mergeBed lines or merge_peak_files() records. Returns (numIntervals, keep, heads,
+    tails, intervalIds, bitsets, counts, extraSamples, matrixBatch) where bitsets and counts are the sample
+    combinations of the written intervals, extraSamples the samples only seen in peak names, in the column order of
+    sampleIndex, and matrixBatch the consensus matrix arrays with matrix=True.
+    """
+    if fromLines:
+        chunk = IntervalChunk.from_lines(batch, sampleIndex, isNarrow=isNarrow)
+    else:
+        chunk = IntervalChunk.from_records(batch, sampleIndex, isNarrow=isNarrow)
+    keep, passed, heads, tails, intervalIds, matrixBatch = expand_chunk_rows(
+        chunk, sampleIndex, isNarrow=isNarrow, minReplicates=minReplicates, matrix=matrix
+    )
+    bitsets, counts = combination_bitsets(passed)
+    extraSamples = sampleIndex.names[sampleIndex.numOutput :]
+    return len(chunk), keep, heads, tails, intervalIds, bitsets, counts, extraSamples, matrixBatch
+
+
+## Batches are independent apart from the running Interval_N counter and the sample combination counts, so with
+## --threads they are expanded in a process pool and the results consumed in input order. Interval IDs are assigned
+## as rows are written and combination counts are reduced in the parent, giving output identical to a serial run.
+## Each worker keeps its own SampleIndex so samples only seen in peak names may be assigned different columns than
+## in the parent; their combination bits are remapped by name before counting.
+
+EXPAND_WORKER = {}
+
+
+def init_expand_worker(SampleNameList, fromLines, isNarrow, minReplicates, matrix=False):
+    EXPAND_WORKER["sampleIndex"] = SampleIndex(SampleNameList)
+    EXPAND_WORKER["options"] = {
+        "fromLines": fromLines,
+        "isNarrow": isNarrow,
+        "minReplicates": minReplicates,
+        "matrix": matrix,
+    }
+
+
+def expand_batch_worker(batch):
+    """Pool worker: expand_batch() with the SampleIndex and options of this worker process."""
+    return expand_batch(batch, EXPAND_WORKER["sampleIndex"], **EXPAND_WORKER["options"])
+
+
+def iter_pool_results(pool, func, tasks, maxPending):
+    """
+    Like pool.imap(func, tasks) but with at most maxPending tasks submitted ahead of the result being consumed, as
+    imap() reads the whole task iterator up front which would buffer the entire input in memory.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= maxPending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def remap_bitset(bitset, numOutput, columnMap):
+    """Move the bits of samples only seen in peak names to their columns in the parent SampleIndex."""
+    remapped = bitset & ((1 << numOutput) - 1)
+    for idx, column in enumerate(columnMap):
+        if bitset >> (numOutput + idx) & 1:
+            remapped |= 1 << column
+    return remapped
+
+
+def iter_expanded_rows(
+    batches,
+    sampleIndex,
+    combCounter,
+    fromLines=False,
+    isNarrow=False,
+    minReplicates=1,
+    stats=None,
+    keepMasks=None,
+    threads=1,
+    matrixWriter=None,
+    perf=None,
+):
+    """
+    Expand batches of mergeBed lines (fromLines=True) or merge_peak_files() records and yield (head, interval_id,
+    tail) for every consensus interval in boolean file order, where head holds the 'chr', 'start' and 'end' fields
+    and tail the tab-joined fields after 'interval_id'. Sample combinations are added to combCounter as they are
+    produced. If provided, the stats dict is updated with the number of input intervals and output rows and the mask
+    of intervals written for each batch is appended to the keepMasks list. The consensus matrix arrays of every batch
+    are added to matrixWriter if provided. With threads > 1 batches are expanded in a process pool. Reading and
+    merging the input is timed as the 'parse' phase and expanding batches as the 'group' phase of perf if provided.
+    """
+    numOutput = sampleIndex.numOutput
+    batches = perf_iter(perf, "parse", batches, rows=len)
+    matrix = matrixWriter is not None
+    pool = None
+    if threads > 1:
+        pool = multiprocessing.Pool(
+            processes=threads,
+            initializer=init_expand_worker,
+            initargs=(sampleIndex.names[:numOutput], fromLines, isNarrow, minReplicates, matrix),
+        )
+        results = iter_pool_results(pool, expand_batch_worker, batches, 2 * threads)
+    else:
+        results = (
+            expand_batch(
+                x, sampleIndex, fromLines=fromLines, isNarrow=isNarrow, minReplicates=minReplicates, matrix=matrix
+            )
+            for x in batches
+        )
+    results = perf_iter(perf, "group", results)
+
+    try:
+        totalOutIntervals = 0
+        for numIntervals, keep, heads, tails, intervalIds, bitsets, counts, extraSamples, matrixBatch in results:
+            if stats is not None:
+                stats["intervals"] = stats.get("intervals", 0) + numIntervals
+            if keepMasks is not None:
+                keepMasks.append(keep)
+
+            ## COUNT SAMPLE COMBINATIONS ONCE PER DISTINCT ROW OF THE BOOLEAN MATRIX
+            if extraSamples != sampleIndex.names[numOutput : numOutput + len(extraSamples)]:
+                columnMap = sampleIndex.lookup(extraSamples).tolist()
+                bitsets = [remap_bitset(x, numOutput, columnMap) for x in bitsets]
+            for bitset, count in zip(bitsets, counts):
+                combCounter.add(bitset, count)
+
+            if intervalIds is None:
+                intervalIds = range(totalOutIntervals + 1, totalOutIntervals + len(heads) + 1)
+            totalOutIntervals += len(heads)
+            if matrixWriter is not None:
+                matrixWriter.add(matrixBatch, intervalIds)
+            if stats is not None:
+                stats["rows"] = totalOutIntervals
+            for head, intervalId, tail in zip(heads, intervalIds, tails):
+                yield head, "Interval_" + str(intervalId), tail
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def write_expanded_intervals(
+    batches,
+    sampleIndex,
+    OutFile,
+    fromLines=False,
+    isNarrow=False,
+    minReplicates=1,
+    BedFile="",
+    SafFile="",
+    maxCombinations=0,
+    tmpDir=None,
+    stats=None,
+    keepMasks=None,
+    threads=1,
+    MatrixFile="",
+    perf=None,
+):
+    """
+    Write the boolean and intersect files for batches of mergeBed lines or merged peak records, see
+    iter_expanded_rows(). The consensus BED and featureCounts SAF files and the binary consensus matrix are written
+    from the same rows when BedFile/SafFile/MatrixFile are provided. maxCombinations bounds the number of sample combinations held in memory, see
+    CombinationCounter. Writing the rows and the intersect file are timed as the 'write' and 'summary' phases of perf.
+    """
+
+    with perf_phase(perf, "write"):
+        makedir(os.path.dirname(OutFile))
+
+        combCounter = CombinationCounter(sampleIndex, maxEntries=maxCombinations, tmpDir=tmpDir)
+        SampleNameList = sampleIndex.names[: sampleIndex.numOutput]
+        colOrder = ["bool", "fc", "qval", "pval", "start", "end"] + (["summit"] if isNarrow else [])
+
+        fout = open(OutFile, "w", buffering=WRITE_BUFFER_SIZE)
+        oFields = ["chr", "start", "end", "interval_id", "num_peaks", "num_samples"] + [
+            x + "." + col for col in colOrder for x in SampleNameList
+        ]
+        fout.write("\t".join(oFields) + "\n")
+        fbed = open(BedFile, "w", buffering=WRITE_BUFFER_SIZE) if BedFile else None
+        fsaf = open(SafFile, "w", buffering=WRITE_BUFFER_SIZE) if SafFile else None
+        if fsaf:
+            fsaf.write("GeneID\tChr\tStart\tEnd\tStrand\n")
+        matrixWriter = ConsensusMatrixWriter(MatrixFile, SampleNameList, isNarrow=isNarrow) if MatrixFile else None
+        for head, intervalId, tail in iter_expanded_rows(
+            batches,
+            sampleIndex,
+            combCounter,
+            fromLines=fromLines,
+            isNarrow=isNarrow,
+            minReplicates=minReplicates,
+            stats=stats,
+            keepMasks=keepMasks,
+            threads=threads,
+            matrixWriter=matrixWriter,
+            perf=perf,
+        ):
+            fout.write("%s\t%s\t%s\n" % (head, intervalId, tail))
+            if fbed:
+                fbed.write("%s\t%s\t0\t+\n" % (head, intervalId))
+            if fsaf:
+                fsaf.write("%s\t%s\t+\n" % (intervalId, head))
+
+        fout.close()
+        for fh in [fbed, fsaf]:
+            if fh:
+                fh.close()
+        if matrixWriter is not None:
+            matrixWriter.close()
+
+    ## WRITE FILE FOR INTERVAL INTERSECT ACROSS SAMPLES.
+    ## COMPATIBLE WITH UPSETR PACKAGE.
+    with perf_phase(perf, "summary"):
+        combCounter.write_intersect_file(OutFile)
+
+
+def macs2_merged_expand_numpy(
+    MergedIntervalTxtFile,
+    SampleNameList,
+    OutFile,
+    isNarrow=False,
+    minReplicates=1,
+    chunkSize=100000,
+    BedFile="",
+    SafFile="",
+    maxCombinations=0,
+    tmpDir=None,
+    stats=None,
+    threads=1,
+    MatrixFile="",
+    perf=None,
+):
+    sampleIndex = SampleIndex(SampleNameList)
+    with open(MergedIntervalTxtFile, "r") as fin:
+        write_expanded_intervals(
+            iter_chunks(fin, chunkSize),
+            sampleIndex,
+            OutFile,
+            fromLines=True,
+            isNarrow=isNarrow,
+            minReplicates=minReplicates,
+            BedFile=BedFile,
+            SafFile=SafFile,
+            maxCombinations=maxCombinations,
+            tmpDir=tmpDir,
+            stats=stats,
+            threads=threads,
+            MatrixFile=MatrixFile,
+            perf=perf,
+        )
+
+
+############################################
+############################################
+## IN-PROCESS PEAK MERGING
+############################################
+############################################
+
+## Replaces 'sort -k1,1 -k2,2n <PEAK_FILES> | mergeBed -c ... -o collapse'. MACS2 writes peaks sorted by chromosome
+## name and start so the per-sample files are combined with a k-way heap merge and overlapping or book-ended peaks
+## are collapsed in a single streaming pass. Peaks with the same chromosome and start are ordered by the full line
+## as the last-resort comparison done by sort.
+
+## PEAK FILES LISTED FOR MORE THAN ONE GROUP OF A --manifest RUN, PARSED ONCE AND KEYED ON THEIR REAL PATH
+SHARED_PEAK_RECORDS = {}
+
+
+def read_peak_file(PeakFile):
+    """
+    Yield (chrom, start, line, fields) for each peak in a coordinate-sorted MACS2 narrowPeak/broadPeak file.
+    Peaks sharing the same chromosome and start are buffered and ordered by line so every stream is sorted on the
+    same key used by heapq.merge().
+    """
+    prevKey = None
+    tied = []
+    fin = open(PeakFile, "r")
+    for line in fin:
+        line = line.rstrip("\n")
+        if not line.strip():
+            continue
+        lspl = line.strip().split("\t")
+        key = (lspl[0], int(lspl[1]))
+        if prevKey is not None and key != prevKey:
+            if key < prevKey:
+                fin.close()
+                raise ValueError(
+                    "Peak file is not sorted by chromosome and start coordinate (sort -k1,1 -k2,2n): {}".format(
+                        PeakFile
+                    )
+                )
+            for record in sorted(tied):
+                yield record
+            tied = []
+        tied.append(key + (line, lspl))
+        prevKey = key
+    fin.close()
+    for record in sorted(tied):
+        yield record
+
+
+def iter_peak_file(PeakFile):
+    """Yield the records of PeakFile as read_peak_file(), from SHARED_PEAK_RECORDS if it has been parsed already."""
+    records = SHARED_PEAK_RECORDS.get(os.path.realpath(PeakFile))
+    return iter(records) if records is not None else read_peak_file(PeakFile)
+
+
+def merge_peak_records(records):
+    """
+    Collapse sorted peak records as yielded by read_peak_file() into merged intervals. Yields (chrom, start, end,
+    members) where members is the list of records contributing to the interval. Overlapping and book-ended peaks
+    are merged as by mergeBed.
+    """
+    interval = None
+    for record in records:
+        chromID, start, line, lspl = record[:4]
+        end = int(lspl[2])
+        if interval is not None and chromID == interval[0] and start <= interval[2]:
+            interval[2] = max(interval[2], end)
+            interval[3].append(record)
+        else:
+            if interval is not None:
+                yield tuple(interval)
+            interval = [chromID, start, end, [record]]
+    if interval is not None:
+        yield tuple(interval)
+
+
+def merge_peak_files(PeakFiles):
+    """
+    Yield (chrom, start, end, peaks) for every merged interval where peaks is the list of split peak file lines
+    contributing to the interval, equivalent to the rows written by mergeBed with collapsed columns.
+    """
+    for chromID, start, end, members in merge_peak_records(heapq.merge(*[iter_peak_file(x) for x in PeakFiles])):
+        yield chromID, start, end, [x[3] for x in members]
+
+
+def macs2_peaks_merge_expand(
+    PeakFiles,
+    SampleNameList,
+    OutFile,
+    isNarrow=False,
+    minReplicates=1,
+    chunkSize=100000,
+    BedFile="",
+    SafFile="",
+    maxCombinations=0,
+    tmpDir=None,
+    stats=None,
+    IndexFile="",
+    threads=1,
+    MatrixFile="",
+    perf=None,
+):
+    sampleIndex = SampleIndex(SampleNameList)
+    records = merge_peak_files(PeakFiles)
+    if IndexFile:
+        intervals, peakLines, keepMasks = [], [], []
+        records = index_records(
+            merge_peak_records(heapq.merge(*[iter_peak_file(x) for x in PeakFiles])), intervals, peakLines
+        )
+    else:
+        keepMasks = None
+    write_expanded_intervals(
+        iter_chunks(records, chunkSize),
+        sampleIndex,
+        OutFile,
+        isNarrow=isNarrow,
+        minReplicates=minReplicates,
+        BedFile=BedFile,
+        SafFile=SafFile,
+        maxCombinations=maxCombinations,
+        tmpDir=tmpDir,
+        stats=stats,
+        keepMasks=keepMasks,
+        threads=threads,
+        MatrixFile=MatrixFile,
+        perf=perf,
+    )
+
+    if IndexFile:
+        ## CONSENSUS INTERVALS KEEP THE IDS WRITTEN ABOVE, INTERVALS BELOW THE REPLICATE THRESHOLD ARE NUMBERED AFTER THEM
+        inConsensus = np.concatenate(keepMasks) if keepMasks else np.zeros(0, dtype=bool)
+        intervalIds = np.zeros(len(inConsensus), dtype=np.int64)
+        numConsensus = int(inConsensus.sum())
+        intervalIds[inConsensus] = np.arange(1, numConsensus + 1)
+        intervalIds[~inConsensus] = np.arange(numConsensus + 1, len(inConsensus) + 1)
+        with perf_phase(perf, "summary"):
+            ConsensusIndex(
+                samples=sampleIndex.names[: sampleIndex.numOutput],
+                isNarrow=isNarrow,
+                chroms=[x[0] for x in intervals],
+                starts=[x[1] for x in intervals],
+                ends=[x[2] for x in intervals],
+                numPeaks=[x[3] for x in intervals],
+                intervalIds=intervalIds,
+                inConsensus=inConsensus,
+                peakLines=peakLines,
+                nextId=len(inConsensus) + 1,
+            ).save(IndexFile)
+
+
+############################################
+############################################
+## INCREMENTAL CONSENSUS
+############################################
+############################################
+
+## --index_file saves every merged interval, including those below the replicate threshold, together with a stable
+## interval ID and the original peak file lines merged into it. --previous_index folds new peak files into that
+## index with the same heap merge used above, so the merged intervals and boolean file are identical to a full
+## rerun over all peak files. Only the interval IDs differ: an interval whose boundaries are unchanged keeps its ID
+## so downstream results keyed on it stay valid, while new, extended, merged or split intervals get new IDs.
+
+INDEX_VERSION = 1
+
+## CHANGES REPORTED IN THE DIFF FILE. UNCHANGED INTERVALS ARE NOT WRITTEN.
+INDEX_CHANGES = ["new", "updated", "extended", "shrunk", "merged", "split", "removed"]
+
+
+class ConsensusIndex:
+    """
+    Merged intervals in coordinate order with their stable IDs, whether they passed the replicate threshold and the
+    peak file lines merged into each of them i.e. peaks for interval i are offsets[i]:offsets[i + 1] of peakLines.
+    Saved as a compressed .npz archive with the peak lines packed into a single newline-delimited byte array.
+    """
+
+    def __init__(self, samples, isNarrow, chroms, starts, ends, numPeaks, intervalIds, inConsensus, peakLines, nextId):
+        self.samples = list(samples)
+        self.isNarrow = bool(isNarrow)
+        self.chroms = list(chroms)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.numPeaks = np.asarray(numPeaks, dtype=np.int64)
+        self.intervalIds = np.asarray(intervalIds, dtype=np.int64)
+        self.inConsensus = np.asarray(inConsensus, dtype=bool)
+        self.peakLines = peakLines
+        self.nextId = int(nextId)
+        self.offsets = np.zeros(len(self.chroms) + 1, dtype=np.int64)
+        np.cumsum(self.numPeaks, out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.chroms)
+
+    @classmethod
+    def load(cls, IndexFile):
+        data = np.load(IndexFile, allow_pickle=False)
+        if int(data["version"]) != INDEX_VERSION:
+            raise ValueError(
+                "Unsupported consensus index version {} in {}, expected {}.".format(
+                    int(data["version"]), IndexFile, INDEX_VERSION
+                )
+            )
+        chromNames = data["chrom_names"].tolist()
+        peakBytes = data["peak_lines"].tobytes()
+        return cls(
+            samples=data["samples"].tolist(),
+            isNarrow=bool(data["is_narrow"]),
+            chroms=[chromNames[x] for x in data["chrom_idx"].tolist()],
+            starts=data["starts"],
+            ends=data["ends"],
+            numPeaks=data["num_peaks"],
+            intervalIds=data["interval_ids"],
+            inConsensus=data["in_consensus"],
+            peakLines=peakBytes.decode().split("\n") if peakBytes else [],
+            nextId=int(data["next_id"]),
+        )
+
+    def save(self, IndexFile):
+        makedir(os.path.dirname(IndexFile))
+        chromNames = sorted(set(self.chroms))
+        chromIndex = {x: idx for idx, x in enumerate(chromNames)}
+        ## WRITE THROUGH A FILE HANDLE SO NUMPY DOES NOT APPEND .npz TO THE FILE NAME
+        with open(IndexFile, "wb") as fout:
+            np.savez_compressed(
+                fout,
+                version=np.int64(INDEX_VERSION),
+                samples=np.array(self.samples, dtype=str),
+                is_narrow=np.bool_(self.isNarrow),
+                chrom_names=np.array(chromNames, dtype=str),
+                chrom_idx=np.array([chromIndex[x] for x in self.chroms], dtype=np.int32),
+                starts=self.starts,
+                ends=self.ends,
+                num_peaks=self.numPeaks,
+                interval_ids=self.intervalIds,
+                in_consensus=self.inConsensus,
+                peak_lines=np.frombuffer("\n".join(self.peakLines).encode(), dtype=np.uint8),
+                next_id=np.int64(self.nextId),
+            )
+
+    def interval_lines(self, idx):
+        return self.peakLines[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def iter_peaks(self, dropSamples=()):
+        """
+        Yield indexed peaks as (chrom, start, line, fields) records in the order they were merged, which is the
+        read_peak_file() sort order, skipping peaks called for any of the samples in dropSamples.
+        """
+        for line in self.peakLines:
+            lspl = line.strip().split("\t")
+            if dropSamples and sample_from_peak_name(lspl[3]) in dropSamples:
+                continue
+            yield (lspl[0], int(lspl[1]), line, lspl)
+
+    def overlapping(self, intervals):
+        """
+        Return the indices of the indexed intervals overlapping each of the coordinate-sorted, non-overlapping
+        (chrom, start, end, ...) intervals. Both sets are swept in a single pass.
+        """
+        starts, ends = self.starts.tolist(), self.ends.tolist()
+        idxList = []
+        first = 0
+        for interval in intervals:
+            chromID, start, end = interval[:3]
+            while first < len(self.chroms) and (self.chroms[first], ends[first]) <= (chromID, start):
+                first += 1
+            idxs = []
+            idx = first
+            while idx < len(self.chroms) and (self.chroms[idx], starts[idx]) < (chromID, end):
+                if self.chroms[idx] == chromID:
+                    idxs.append(idx)
+                idx += 1
+            idxList.append(idxs)
+        return idxList
+
+
+def index_records(records, intervals, peakLines):
+    """
+    Pass through merged intervals from merge_peak_records() in the format yielded by merge_peak_files(), appending
+    (chrom, start, end, numPeaks) for each interval to intervals and the contributing peak lines to peakLines.
+    """
+    for chromID, start, end, members in records:
+        intervals.append((chromID, start, end, len(members)))
+        peakLines.extend([x[2] for x in members])
+        yield chromID, start, end, [x[3] for x in members]
+
+
+def classify_intervals(merged, previous):
+    """
+    Compare merged intervals from merge_peak_records() against the overlapping intervals in the previous index.
+    Returns a list of (intervalId, change, previousIdxs) per merged interval and the next unused interval ID. IDs
+    are kept only when an interval maps one-to-one onto a previous interval with identical boundaries.
+    """
+    previousIdxs = previous.overlapping(merged)
+    numMapped = np.zeros(len(previous), dtype=np.int64)
+    for idxs in previousIdxs:
+        numMapped[idxs] += 1
+
+    nextId = previous.nextId
+    changes = []
+    for (chromID, start, end, members), idxs in zip(merged, previousIdxs):
+        intervalId = None
+        if not idxs:
+            change = "new"
+        elif len(idxs) > 1:
+            change = "merged"
+        elif numMapped[idxs[0]] > 1:
+            change = "split"
+        else:
+            idx = idxs[0]
+            prevStart, prevEnd = int(previous.starts[idx]), int(previous.ends[idx])
+            if (chromID, start, end) == (previous.chroms[idx], prevStart, prevEnd):
+                intervalId = int(previous.intervalIds[idx])
+                change = "unchanged" if [x[2] for x in members] == previous.interval_lines(idx) else "updated"
+            elif start <= prevStart and end >= prevEnd:
+                change = "extended"
+            else:
+                change = "shrunk"
+        if intervalId is None:
+            intervalId = nextId
+            nextId += 1
+        changes.append((intervalId, change, idxs))
+    return changes, nextId
+
+
+def write_diff_file(merged, changes, inConsensus, previous, OutFile):
+    """
+    Write changed intervals to OutFile[:-4] + '.diff.txt' in coordinate order followed by previous intervals that
+    no longer contain any peaks.
+    """
+    DiffFile = OutFile[:-4] + ".diff.txt"
+    fout = open(DiffFile, "w")
+    fout.write("interval_id\tchr\tstart\tend\tchange\tin_consensus\tprevious_interval_id\n")
+    for (chromID, start, end, members), (intervalId, change, idxs), keep in zip(merged, changes, inConsensus.tolist()):
+        ## AN UNCHANGED INTERVAL CAN STILL ENTER OR LEAVE THE CONSENSUS IF --min_replicates DIFFERS FROM THE LAST RUN
+        if change == "unchanged" and keep != bool(previous.inConsensus[idxs[0]]):
+            change = "updated"
+        if change == "unchanged":
+            continue
+        previousIds = ",".join(["Interval_" + str(previous.intervalIds[x]) for x in idxs]) or "NA"
+        fout.write(
+            "Interval_%s\t%s\t%s\t%s\t%s\t%s\t%s\n"
+            % (intervalId, chromID, start, end, change, str(keep).upper(), previousIds)
+        )
+    numMapped = np.zeros(len(previous), dtype=np.int64)
+    for intervalId, change, idxs in changes:
+        numMapped[idxs] += 1
+    for idx in np.flatnonzero(numMapped == 0).tolist():
+        fout.write(
+            "NA\t%s\t%s\t%s\tremoved\tFALSE\tInterval_%s\n"
+            % (previous.chroms[idx], previous.starts[idx], previous.ends[idx], previous.intervalIds[idx])
+        )
     fout.close()
 
 
+def macs2_peaks_update_expand(
+    PeakFiles,
+    SampleNameList,
+    OutFile,
+    PreviousIndexFile,
+    isNarrow=False,
+    minReplicates=1,
+    chunkSize=100000,
+    BedFile="",
+    SafFile="",
+    maxCombinations=0,
+    tmpDir=None,
+    stats=None,
+    IndexFile="",
+    threads=1,
+    MatrixFile="",
+    perf=None,
+):
+    """
+    Fold the peak files for the samples in SampleNameList into the consensus index in PreviousIndexFile and write
+    the boolean, intersect, BED, SAF and diff files for all indexed samples. The updated index is written to
+    IndexFile if provided.
+    """
+    previous = ConsensusIndex.load(PreviousIndexFile)
+    if previous.isNarrow != isNarrow:
+        raise ValueError(
+            "Consensus index {} was built from {} peaks!".format(
+                PreviousIndexFile, "narrow" if previous.isNarrow else "broad"
+            )
+        )
+
+    ## PEAKS ALREADY INDEXED FOR A SAMPLE BEING ADDED ARE REPLACED E.G. WHEN A REPLICATE IS RE-CALLED
+    replaced = set(SampleNameList).intersection(previous.samples)
+    sampleIndex = SampleIndex(sorted(set(previous.samples).union(SampleNameList)))
+    streams = [previous.iter_peaks(dropSamples=replaced)] + [iter_peak_file(x) for x in PeakFiles]
+    with perf_phase(perf, "parse"):
+        merged = list(merge_peak_records(heapq.merge(*streams)))
+    with perf_phase(perf, "group"):
+        changes, nextId = classify_intervals(merged, previous)
+
+    records = (
+        (chromID, start, end, [x[3] for x in members], intervalId)
+        for (chromID, start, end, members), (intervalId, change, idxs) in zip(merged, changes)
+    )
+    keepMasks = []
+    write_expanded_intervals(
+        iter_chunks(records, chunkSize),
+        sampleIndex,
+        OutFile,
+        isNarrow=isNarrow,
+        minReplicates=minReplicates,
+        BedFile=BedFile,
+        SafFile=SafFile,
+        maxCombinations=maxCombinations,
+        tmpDir=tmpDir,
+        stats=stats,
+        keepMasks=keepMasks,
+        threads=threads,
+        MatrixFile=MatrixFile,
+        perf=perf,
+    )
+    with perf_phase(perf, "summary"):
+        inConsensus = np.concatenate(keepMasks) if keepMasks else np.zeros(0, dtype=bool)
+        write_diff_file(merged, changes, inConsensus, previous, OutFile)
+
+        if IndexFile:
+            ConsensusIndex(
+                samples=sampleIndex.names[: sampleIndex.numOutput],
+                isNarrow=isNarrow,
+                chroms=[x[0] for x in merged],
+                starts=[x[1] for x in merged],
+                ends=[x[2] for x in merged],
+                numPeaks=[len(x[3]) for x in merged],
+                intervalIds=[x[0] for x in changes],
+                inConsensus=inConsensus,
+                peakLines=[x[2] for chromID, start, end, members in merged for x in members],
+                nextId=nextId,
+            ).save(IndexFile)
+
+
+############################################
+############################################
+## MANIFEST BATCH MODE
+############################################
+############################################
+
+## --manifest builds the consensus of many groups, e.g. one per antibody, in a single run so the interpreter start-up
+## and per-task overhead is paid once. Every group is run exactly as a separate --peak_files invocation with its own
+## arguments, result cache entry and perf file, so the outputs are identical to one run per group. Groups are
+## handed to a process pool largest first. Peak files shared between groups are parsed before the pool is created
+## and inherited by the workers.
+
+GROUP_PLACEHOLDER = "{group}"
+
+## OUTPUT PATH ARGUMENTS IN WHICH GROUP_PLACEHOLDER IS REPLACED BY THE NAME OF EACH GROUP
+GROUP_PATH_ARGS = ["OUTFILE", "BED_FILE", "SAF_FILE", "MATRIX_FILE", "INDEX_FILE", "PREVIOUS_INDEX", "PERF_FILE"]
+
+
+def read_manifest(ManifestFile):
+    """Return {group: [(sample, PeakFile), ...]} in file order from a tab-separated manifest of group, sample, peak file."""
+    manifest = collections.OrderedDict()
+    with open(ManifestFile, "r") as fin:
+        for lineNo, line in enumerate(fin, start=1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            lspl = [x.strip() for x in line.rstrip("\n").split("\t")]
+            if len(lspl) != 3 or not all(lspl):
+                print(
+                    "ERROR: Manifest line {} must have 3 tab-separated columns (group, sample, peak file): {}".format(
+                        lineNo, line.strip()
+                    )
+                )
+                sys.exit(1)
+            group, sample, PeakFile = lspl
+            if sample in [x[0] for x in manifest.get(group, [])]:
+                print("ERROR: Sample {} is listed more than once for group {} in manifest!".format(sample, group))
+                sys.exit(1)
+            manifest.setdefault(group, []).append((sample, PeakFile))
+    return manifest
+
+
+def share_peak_files(PeakFileLists):
+    """Parse the peak files that appear in more than one list into SHARED_PEAK_RECORDS. Returns the number parsed."""
+    counts = collections.Counter([x for PeakFiles in PeakFileLists for x in set(map(os.path.realpath, PeakFiles))])
+    numShared = 0
+    for PeakFile, count in counts.items():
+        if count > 1 and PeakFile not in SHARED_PEAK_RECORDS:
+            SHARED_PEAK_RECORDS[PeakFile] = list(read_peak_file(PeakFile))
+            numShared += 1
+    return numShared
+
+
+def group_args(args, group, members, threads=1):
+    """Return a copy of the --manifest run arguments that builds the consensus of group as a --peak_files run."""
+    groupArgs = argparse.Namespace(**vars(args))
+    groupArgs.MANIFEST = False
+    groupArgs.PEAK_FILES = True
+    groupArgs.MERGED_INTERVAL_FILE = ",".join([x[1] for x in members])
+    groupArgs.SAMPLE_NAME_LIST = ",".join([x[0] for x in members])
+    groupArgs.THREADS = threads
+    for dest in GROUP_PATH_ARGS:
+        setattr(groupArgs, dest, getattr(args, dest).replace(GROUP_PLACEHOLDER, group))
+    return groupArgs
+
+
+def macs2_manifest_expand(args):
+    """
+    Build the consensus of every group of the manifest in MERGED_INTERVAL_FILE listed in SAMPLE_NAME_LIST.
+    Returns the number of groups and of shared peak files.
+    """
+    manifest = read_manifest(args.MERGED_INTERVAL_FILE)
+    groups = args.SAMPLE_NAME_LIST.split(",")
+    missing = [x for x in groups if x not in manifest]
+    if missing:
+        print("ERROR: Groups not found in manifest {}: {}".format(args.MERGED_INTERVAL_FILE, ",".join(missing)))
+        sys.exit(1)
+    if len(set(groups)) != len(groups):
+        print("ERROR: Groups must be unique: {}".format(args.SAMPLE_NAME_LIST))
+        sys.exit(1)
+    if len(groups) > 1:
+        for dest in GROUP_PATH_ARGS:
+            if getattr(args, dest) and GROUP_PLACEHOLDER not in getattr(args, dest):
+                print(
+                    "ERROR: Output path '{}' must contain '{}' to keep the outputs of the groups apart!".format(
+                        getattr(args, dest), GROUP_PLACEHOLDER
+                    )
+                )
+                sys.exit(1)
+
+    numShared = share_peak_files([[x[1] for x in manifest[group]] for group in groups])
+
+    ## LARGEST GROUPS FIRST SO THE POOL IS NOT LEFT WAITING ON A LARGE GROUP STARTED LAST
+    groups.sort(key=lambda x: -sum([os.path.getsize(y[1]) for y in manifest[x]]))
+    threads = min(args.THREADS, len(groups))
+    if threads > 1:
+        pool = multiprocessing.Pool(processes=threads)
+        pool.map(expand_args, [group_args(args, x, manifest[x]) for x in groups], chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        for group in groups:
+            expand_args(group_args(args, group, manifest[group], threads=args.THREADS))
+    return len(groups), numShared
+
+
 ############################################
 ############################################
 ## RUN FUNCTION
 ############################################
 ############################################
 
-macs2_merged_expand(
-    MergedIntervalTxtFile=args.MERGED_INTERVAL_FILE,
-    SampleNameList=args.SAMPLE_NAME_LIST.split(","),
-    OutFile=args.OUTFILE,
-    isNarrow=args.IS_NARROW_PEAK,
-    minReplicates=args.MIN_REPLICATES,
-)
+
+def run_expand(args, stats, perf=None):
+    """Dispatch to the implementation selected by the command-line arguments, timing its phases with perf."""
+    if args.PREVIOUS_INDEX:
+        if np is None:
+            print("ERROR: --previous_index requires the NumPy batch engine but NumPy is not installed!")
+            sys.exit(1)
+        macs2_peaks_update_expand(
+            PeakFiles=args.MERGED_INTERVAL_FILE.split(","),
+            SampleNameList=args.SAMPLE_NAME_LIST.split(","),
+            OutFile=args.OUTFILE,
+            PreviousIndexFile=args.PREVIOUS_INDEX,
+            isNarrow=args.IS_NARROW_PEAK,
+            minReplicates=args.MIN_REPLICATES,
+            chunkSize=args.CHUNK_SIZE,
+            BedFile=args.BED_FILE,
+            SafFile=args.SAF_FILE,
+            maxCombinations=args.MAX_COMBINATIONS if args.STREAMING else 0,
+            tmpDir=args.TMP_DIR,
+            stats=stats,
+            IndexFile=args.INDEX_FILE,
+            threads=args.THREADS,
+            MatrixFile=args.MATRIX_FILE,
+            perf=perf,
+        )
+    elif args.PEAK_FILES:
+        if np is None:
+            print("ERROR: --peak_files requires the NumPy batch engine but NumPy is not installed!")
+            sys.exit(1)
+        macs2_peaks_merge_expand(
+            PeakFiles=args.MERGED_INTERVAL_FILE.split(","),
+            SampleNameList=args.SAMPLE_NAME_LIST.split(","),
+            OutFile=args.OUTFILE,
+            isNarrow=args.IS_NARROW_PEAK,
+            minReplicates=args.MIN_REPLICATES,
+            chunkSize=args.CHUNK_SIZE,
+            BedFile=args.BED_FILE,
+            SafFile=args.SAF_FILE,
+            maxCombinations=args.MAX_COMBINATIONS if args.STREAMING else 0,
+            tmpDir=args.TMP_DIR,
+            stats=stats,
+            IndexFile=args.INDEX_FILE,
+            threads=args.THREADS,
+            MatrixFile=args.MATRIX_FILE,
+            perf=perf,
+        )
+    elif args.LEGACY or np is None:
+        ## THE LINE-BY-LINE IMPLEMENTATION PARSES, GROUPS AND WRITES EACH INTERVAL IN TURN SO IS TIMED AS A WHOLE
+        with perf_phase(perf, "write"):
+            macs2_merged_expand(
+                MergedIntervalTxtFile=args.MERGED_INTERVAL_FILE,
+                SampleNameList=args.SAMPLE_NAME_LIST.split(","),
+                OutFile=args.OUTFILE,
+                isNarrow=args.IS_NARROW_PEAK,
+                minReplicates=args.MIN_REPLICATES,
+            )
+        with perf_phase(perf, "summary"):
+            write_bed_saf_files(args.OUTFILE, BedFile=args.BED_FILE, SafFile=args.SAF_FILE)
+            if args.MATRIX_FILE:
+                boolean_to_matrix(args.OUTFILE, args.MATRIX_FILE)
+    else:
+        macs2_merged_expand_numpy(
+            MergedIntervalTxtFile=args.MERGED_INTERVAL_FILE,
+            SampleNameList=args.SAMPLE_NAME_LIST.split(","),
+            OutFile=args.OUTFILE,
+            isNarrow=args.IS_NARROW_PEAK,
+            minReplicates=args.MIN_REPLICATES,
+            chunkSize=args.CHUNK_SIZE,
+            BedFile=args.BED_FILE,
+            SafFile=args.SAF_FILE,
+            maxCombinations=args.MAX_COMBINATIONS if args.STREAMING else 0,
+            tmpDir=args.TMP_DIR,
+            stats=stats,
+            threads=args.THREADS,
+            MatrixFile=args.MATRIX_FILE,
+            perf=perf,
+        )
+
+
+def output_files(args):
+    """Return {role: path} for every file written for the command-line arguments, as cached by --cache_dir."""
+    OutputFiles = {"boolean": args.OUTFILE, "intersect": args.OUTFILE[:-4] + ".intersect.txt"}
+    for role, OutFile in [
+        ("bed", args.BED_FILE),
+        ("saf", args.SAF_FILE),
+        ("index", args.INDEX_FILE),
+        ("matrix", args.MATRIX_FILE),
+    ]:
+        if OutFile:
+            OutputFiles[role] = OutFile
+    if args.PREVIOUS_INDEX:
+        OutputFiles["diff"] = args.OUTFILE[:-4] + ".diff.txt"
+    return OutputFiles
+
+
+def expand_args(args):
+    """Build the consensus for the command-line arguments of a single run, via the result cache if enabled."""
+    if not args.CHUNK_SIZE:
+        args.CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+        if args.STREAMING:
+            numSamples = len(args.SAMPLE_NAME_LIST.split(","))
+            args.CHUNK_SIZE = min(DEFAULT_CHUNK_SIZE, max(1000, STREAMING_CHUNK_CELLS // numSamples))
+    stats = {}
+    startTime = time.time()
+    perf = None
+    if args.PERF_FILE and PerfRecorder is not None:
+        perf = PerfRecorder(os.path.basename(__file__), profile=args.PROFILE, traceMemory=args.PROFILE)
+    restored = False
+    if args.CACHE_DIR and cached_run is not None:
+        InputFiles = args.MERGED_INTERVAL_FILE.split(",") if args.PEAK_FILES else [args.MERGED_INTERVAL_FILE]
+        if args.PREVIOUS_INDEX:
+            InputFiles.append(args.PREVIOUS_INDEX)
+        params = {
+            "sample_names": sorted(args.SAMPLE_NAME_LIST.split(",")),
+            "is_narrow_peak": args.IS_NARROW_PEAK,
+            "min_replicates": args.MIN_REPLICATES,
+            "peak_files": args.PEAK_FILES,
+            "outputs": sorted(output_files(args)),
+        }
+        ## THE MATRIX FILE IS WRITTEN BY consensus_matrix.py SO A CHANGE TO IT MUST NOT RESTORE STALE MATRICES
+        if args.MATRIX_FILE:
+            params["matrix_script"] = file_sha256(sys.modules[ConsensusMatrixWriter.__module__].__file__)
+        restored = cached_run(
+            args.CACHE_DIR,
+            os.path.abspath(__file__),
+            InputFiles,
+            params,
+            output_files(args),
+            lambda: run_expand(args, stats, perf),
+            maxSizeMb=args.CACHE_MAX_SIZE,
+        )
+    else:
+        run_expand(args, stats, perf)
+
+    if stats:
+        elapsed = max(time.time() - startTime, 1e-6)
+        print(
+            "Processed {} merged intervals into {} consensus intervals in {:.1f}s ({:.0f} rows/sec), peak memory {:.1f} MB".format(
+                stats.get("intervals", 0),
+                stats.get("rows", 0),
+                elapsed,
+                stats.get("intervals", 0) / elapsed,
+                peak_memory_mb(),
+            )
+        )
+    if perf is not None:
+        perf.update(dict(stats, cache_hit=restored, threads=args.THREADS))
+        perf.write(args.PERF_FILE)
+    return stats
+
+
+def main(args=None):
+    args = parse_args(args)
+    if (args.INDEX_FILE or args.PREVIOUS_INDEX) and not (args.PEAK_FILES or args.MANIFEST):
+        print("ERROR: --index_file and --previous_index require --peak_files!")
+        sys.exit(1)
+    if args.MANIFEST and np is None:
+        print("ERROR: --manifest requires the NumPy batch engine but NumPy is not installed!")
+        sys.exit(1)
+    if args.MATRIX_FILE and ConsensusMatrixWriter is None:
+        print("ERROR: --matrix_file requires NumPy and consensus_matrix.py next to this script!")
+        sys.exit(1)
+    if args.CACHE_DIR and cached_run is None:
+        print("WARNING: result_cache.py not found next to this script, --cache_dir is ignored.")
+    if args.PERF_FILE and PerfRecorder is None:
+        print("WARNING: perf_stats.py not found next to this script, --perf_file is ignored.")
+    if args.MANIFEST:
+        startTime = time.time()
+        numGroups, numShared = macs2_manifest_expand(args)
+        print(
+            "Built the consensus of {} groups in {:.1f}s with {} shared peak files, peak memory {:.1f} MB".format(
+                numGroups, time.time() - startTime, numShared, peak_memory_mb()
+            )
+        )
+    else:
+        expand_args(args)
+
+
+if __name__ == "__main__":
+    main()
 
 ############################################
 ############################################
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Streaming peak count, width and score distributions for MACS2 peak files
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import math
+import time
+import errno
+import argparse
+import resource
+import collections
+import multiprocessing
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Stream MACS2 narrowPeak/broadPeak files and summarise the peak count and the distributions of peak length, "
+        "fold-enrichment and -log10 q-value/p-value with fixed-bin histograms and quantile sketches, in memory that "
+        "does not grow with the number of peaks. Files are read in parallel, one worker per file."
+    )
+    Epilog = """Example usage: python peak_stats.py <PEAK_FILES> <SAMPLE_IDS> <OUTPREFIX> --threads 4"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("PEAK_FILES", help="Comma-separated list of MACS2 narrowPeak or broadPeak files.")
+    argParser.add_argument(
+        "SAMPLE_IDS", help="Comma-separated list of sample ids in the same order as PEAK_FILES. Must be unique."
+    )
+    argParser.add_argument(
+        "OUTPREFIX",
+        help="Prefix of the '<prefix>.summary.txt' and '<prefix>.histogram.txt' files for plot_macs2_qc.r and the "
+        "'<prefix>.peak_{count,length,fold,qvalue}.tsv' tables for MultiQC.",
+    )
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of peak files read in parallel (default: 1).",
+    )
+    argParser.add_argument(
+        "-ra",
+        "--relative_accuracy",
+        type=float,
+        dest="RELATIVE_ACCURACY",
+        default=0.001,
+        help="Relative accuracy of the quartiles in '<prefix>.summary.txt'. The minimum, mean and maximum are exact (default: 0.001).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## (measure, 0-based peak file column or None for end - start, scale, lower edge, upper edge, number of bins).
+## Measures are listed in the order of the plot_macs2_qc.r summary. Edges are on the scale of the histogram and
+## values outside them are counted in the first or last bin.
+MEASURES = [
+    ("fold", 6, "log2", 0.0, 10.0, 100),
+    ("-log10(qvalue)", 8, "linear", 0.0, 100.0, 100),
+    ("-log10(pvalue)", 7, "linear", 0.0, 100.0, 100),
+    ("length", None, "log10", 1.0, 6.0, 100),
+]
+
+## Measures written as MultiQC line graphs, see assets/multiqc/peak_{length,fold,qvalue}_header.txt
+MQC_MEASURES = [("length", "length"), ("fold", "fold"), ("qvalue", "-log10(qvalue)")]
+
+## Columns of the summary written by R's summary() followed by those added by plot_macs2_qc.r
+SUMMARY_COLUMNS = ["Min.", "1st Qu.", "Median", "Mean", "3rd Qu.", "Max.", "num_peaks", "measure", "sample"]
+
+## Values closer to zero than this are counted as zero by the quantile sketch
+MIN_SKETCH_VALUE = 1e-9
+
+## Number of peaks parsed before the sketches and histograms are updated in one go
+BATCH_SIZE = 16384
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def format_value(value):
+    """Format a statistic as R writes numbers, with up to 15 significant digits and NA for missing values."""
+    if value is None:
+        return "NA"
+    return "{:.15g}".format(value)
+
+
+class QuantileSketch:
+    """
+    Relative-error quantile sketch (DDSketch). Values are counted in logarithmically sized buckets so every quantile
+    is returned within relativeAccuracy of the true value, while memory is bounded by the range of the values
+    rather than their number. The minimum, maximum and mean are tracked exactly.
+    """
+
+    def __init__(self, relativeAccuracy=0.001):
+        self.relativeAccuracy = relativeAccuracy
+        self.gamma = (1.0 + relativeAccuracy) / (1.0 - relativeAccuracy)
+        self.logGamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def _value(self, key):
+        ## Midpoint of bucket (gamma^(key-1), gamma^key] with the lowest relative error to both edges
+        return 2.0 * self.gamma**key / (self.gamma + 1.0)
+
+    def add_values(self, values):
+        """Add a batch of values."""
+        if not values:
+            return
+        log = math.log
+        logGamma = self.logGamma
+        for store, keys in [
+            (self.positive, [log(x) / logGamma for x in values if x > MIN_SKETCH_VALUE]),
+            (self.negative, [log(-x) / logGamma for x in values if x < -MIN_SKETCH_VALUE]),
+        ]:
+            for key, count in collections.Counter(map(math.ceil, keys)).items():
+                store[key] = store.get(key, 0) + count
+        self.zeros += sum([1 for x in values if -MIN_SKETCH_VALUE <= x <= MIN_SKETCH_VALUE])
+        self.count += len(values)
+        self.total += math.fsum(values)
+        minimum = min(values)
+        maximum = max(values)
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def quantiles(self, probs):
+        """
+        Return the quantiles at probs, interpolated between order statistics as R's default quantile type 7.
+        The smallest and largest order statistics are the exact minimum and maximum.
+        """
+        if not self.count:
+            return [None for x in probs]
+        ## (last 0-based rank in bucket, value) in ascending order of value
+        buckets = []
+        rank = -1
+        for key in sorted(self.negative, reverse=True):
+            rank += self.negative[key]
+            buckets.append((rank, -self._value(key)))
+        if self.zeros:
+            rank += self.zeros
+            buckets.append((rank, 0.0))
+        for key in sorted(self.positive):
+            rank += self.positive[key]
+            buckets.append((rank, self._value(key)))
+
+        def value_at(rank):
+            if rank <= 0:
+                return self.minimum
+            if rank >= self.count - 1:
+                return self.maximum
+            lo, hi = 0, len(buckets) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if buckets[mid][0] < rank:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return min(max(buckets[lo][1], self.minimum), self.maximum)
+
+        quantileList = []
+        for prob in probs:
+            position = (self.count - 1) * prob
+            lower = int(math.floor(position))
+            value = value_at(lower)
+            if position > lower:
+                value += (position - lower) * (value_at(lower + 1) - value)
+            quantileList.append(value)
+        return quantileList
+
+
+class FixedHistogram:
+    """Counts of values in numBins equal-width bins between lower and upper on a linear, log2 or log10 scale."""
+
+    def __init__(self, scale, lower, upper, numBins):
+        self.scale = scale
+        self.lower = lower
+        self.upper = upper
+        self.numBins = numBins
+        self.binWidth = (upper - lower) / float(numBins)
+        self.counts = [0] * numBins
+
+    def transform(self, value):
+        if self.scale == "linear":
+            return value
+        if value <= 0:
+            return self.lower
+        return math.log2(value) if self.scale == "log2" else math.log10(value)
+
+    def untransform(self, value):
+        if self.scale == "linear":
+            return value
+        return 2.0**value if self.scale == "log2" else 10.0**value
+
+    def add_values(self, values):
+        """Add a batch of values. Values outside the edges are counted in the first or last bin."""
+        lower = self.lower
+        binWidth = self.binWidth
+        lastBin = self.numBins - 1
+        for idx, count in collections.Counter([int((self.transform(x) - lower) / binWidth) for x in values]).items():
+            self.counts[min(max(idx, 0), lastBin)] += count
+
+    def bins(self):
+        """Yield (start, end, centre, count) for every bin on the original scale of the values."""
+        for idx, count in enumerate(self.counts):
+            start = self.lower + idx * self.binWidth
+            yield (
+                self.untransform(start),
+                self.untransform(start + self.binWidth),
+                self.untransform(start + self.binWidth / 2.0),
+                count,
+            )
+
+
+class PeakStats:
+    """Peak count with a quantile sketch and a fixed-bin histogram of every measure in MEASURES."""
+
+    def __init__(self, relativeAccuracy=0.001):
+        self.numPeaks = 0
+        self.sketches = {}
+        self.histograms = {}
+        for measure, column, scale, lower, upper, numBins in MEASURES:
+            self.sketches[measure] = QuantileSketch(relativeAccuracy)
+            self.histograms[measure] = FixedHistogram(scale, lower, upper, numBins)
+
+    def add_batch(self, batch):
+        """Add a batch of split peak file lines."""
+        self.numPeaks += len(batch)
+        for measure, column, scale, lower, upper, numBins in MEASURES:
+            if column is None:
+                values = [int(x[2]) - int(x[1]) for x in batch]
+            else:
+                values = [float(x[column]) for x in batch]
+            self.sketches[measure].add_values(values)
+            self.histograms[measure].add_values(values)
+
+    def add_file(self, PeakFile):
+        """Stream the peaks in PeakFile, holding at most BATCH_SIZE lines in memory."""
+        batch = []
+        with open(PeakFile, "r") as fin:
+            for line in fin:
+                lspl = line.rstrip("\n").split("\t")
+                if len(lspl) < 9:
+                    continue
+                batch.append(lspl)
+                if len(batch) == BATCH_SIZE:
+                    self.add_batch(batch)
+                    batch = []
+        self.add_batch(batch)
+        return self
+
+    def summary_rows(self, sample):
+        """Yield a row of SUMMARY_COLUMNS for every measure as written by plot_macs2_qc.r."""
+        for measure, column, scale, lower, upper, numBins in MEASURES:
+            sketch = self.sketches[measure]
+            q1, median, q3 = sketch.quantiles([0.25, 0.5, 0.75])
+            values = [sketch.minimum, q1, median, sketch.mean(), q3, sketch.maximum]
+            yield [format_value(x) for x in values] + [str(self.numPeaks), measure, sample]
+
+
+def peak_file_stats(task):
+    """Pool worker: summarise one peak file."""
+    PeakFile, relativeAccuracy = task
+    return PeakStats(relativeAccuracy).add_file(PeakFile)
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def peak_stats(PeakFiles, SampleIds, OutPrefix, threads=1, relativeAccuracy=0.001):
+    """
+    Summarise every peak file in PeakFiles and write the summary and histogram files for plot_macs2_qc.r and the
+    peak count and distribution tables for MultiQC, one row per sample in the order of SampleIds.
+    Returns the total number of peaks.
+    """
+    tasks = [(x, relativeAccuracy) for x in PeakFiles]
+    if threads > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes=min(threads, len(tasks)))
+        statsList = pool.map(peak_file_stats, tasks)
+        pool.close()
+        pool.join()
+    else:
+        statsList = [peak_file_stats(x) for x in tasks]
+
+    makedir(os.path.dirname(OutPrefix))
+    with open(OutPrefix + ".summary.txt", "w") as fout:
+        fout.write("\t".join(SUMMARY_COLUMNS) + "\n")
+        for sample, stats in zip(SampleIds, statsList):
+            for row in stats.summary_rows(sample):
+                fout.write("\t".join(row) + "\n")
+
+    with open(OutPrefix + ".histogram.txt", "w") as fout:
+        fout.write("\t".join(["sample", "measure", "bin_start", "bin_end", "bin_centre", "count"]) + "\n")
+        for sample, stats in zip(SampleIds, statsList):
+            for measure, column, scale, lower, upper, numBins in MEASURES:
+                for start, end, centre, count in stats.histograms[measure].bins():
+                    fout.write(
+                        "\t".join([sample, measure] + [format_value(x) for x in [start, end, centre]] + [str(count)])
+                        + "\n"
+                    )
+
+    ## TWO-COLUMN FILE PARSED BY MULTIQC AS A BAR GRAPH OF SAMPLE AND PEAK COUNT
+    with open(OutPrefix + ".peak_count.tsv", "w") as fout:
+        for sample, stats in zip(SampleIds, statsList):
+            fout.write("{}\t{}\n".format(sample, stats.numPeaks))
+
+    ## LINE GRAPHS OF THE PERCENTAGE OF PEAKS IN EACH BIN, X VALUES ARE BIN CENTRES
+    for name, measure in MQC_MEASURES:
+        with open(OutPrefix + ".peak_{}.tsv".format(name), "w") as fout:
+            centres = [x[2] for x in statsList[0].histograms[measure].bins()] if statsList else []
+            fout.write("\t".join(["Sample"] + ["{:.4g}".format(x) for x in centres]) + "\n")
+            for sample, stats in zip(SampleIds, statsList):
+                counts = stats.histograms[measure].counts
+                fout.write(
+                    "\t".join(
+                        [sample]
+                        + ["{:.3f}".format(100.0 * x / stats.numPeaks if stats.numPeaks else 0) for x in counts]
+                    )
+                    + "\n"
+                )
+    return sum([x.numPeaks for x in statsList])
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    PeakFiles = args.PEAK_FILES.split(",")
+    SampleIds = args.SAMPLE_IDS.split(",")
+    if len(PeakFiles) != len(SampleIds):
+        print(
+            "ERROR: Number of sample ids ({}) must equal number of peak files ({})!".format(
+                len(SampleIds), len(PeakFiles)
+            )
+        )
+        sys.exit(1)
+    if len(set(SampleIds)) != len(SampleIds):
+        print("ERROR: Sample ids must be unique: {}".format(args.SAMPLE_IDS))
+        sys.exit(1)
+    if not 0 < args.RELATIVE_ACCURACY < 1:
+        print("ERROR: --relative_accuracy must be between 0 and 1!")
+        sys.exit(1)
+
+    startTime = time.time()
+    numPeaks = peak_stats(
+        PeakFiles, SampleIds, args.OUTPREFIX, threads=args.THREADS, relativeAccuracy=args.RELATIVE_ACCURACY
+    )
+    print(
+        "Summarised {} peaks in {} files in {:.1f}s, peak memory {:.1f} MB".format(
+            numPeaks, len(PeakFiles), time.time() - startTime, peak_memory_mb()
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Per-phase timing and memory instrumentation shared by the pipeline's Python helper scripts
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import json
+import time
+import errno
+import pstats
+import cProfile
+import argparse
+import resource
+import contextlib
+import tracemalloc
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Aggregate the *.perf.json files written by the helper scripts with --perf_file into MultiQC custom content "
+        "tables of the totals and of the time spent in each phase."
+    )
+    Epilog = """Example usage: python perf_stats.py <PERF_FILES> --outprefix perf_stats"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("PERF_FILES", nargs="+", help="Per-task *.perf.json files.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-o",
+        "--outprefix",
+        type=str,
+        dest="OUTPREFIX",
+        default="perf_stats",
+        help="Prefix of the '<prefix>_summary.tsv' and '<prefix>_phases.tsv' output files (default: 'perf_stats').",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## Setting these to a non-empty value other than '0' turns on cProfile and tracemalloc for every recorder, e.g.
+## via the Nextflow 'env' scope, without changing the command line of the tasks
+PROFILE_ENV = "PERF_PROFILE"
+TRACEMALLOC_ENV = "PERF_TRACEMALLOC"
+
+## Bump when the layout of the perf.json files changes
+PERF_VERSION = 1
+
+## Phases shared by the helpers, listed first in the aggregated tables. Time outside any phase is reported as 'other'
+PHASES = ["parse", "group", "write", "summary"]
+
+## Number of functions and allocation sites kept from the cProfile and tracemalloc reports
+TOP_ENTRIES = 20
+TRACEMALLOC_FRAMES = 1
+
+## tracemalloc.reset_peak() is new in Python 3.9. Without it the traced memory is only sampled at phase boundaries
+RESET_PEAK = hasattr(tracemalloc, "reset_peak")
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def env_enabled(name):
+    return os.environ.get(name, "") not in ["", "0"]
+
+
+class PerfRecorder:
+    """
+    Wall and CPU time, rows processed and peak memory of the named phases of a helper script.
+
+    Phases nest: time spent in an inner phase, including one entered by pulling items from timed_iter(), is only
+    counted for the inner phase, so the phase times add up to the time spent in any phase. This lets a streaming
+    pipeline of generators be split into its parse, group and write costs without buffering between them.
+    CPU time is that of the recording process only, so work done in a process pool shows as waiting time.
+    Peak RSS is recorded for the process as a whole. With traceMemory the peak of the memory traced by tracemalloc
+    is recorded per phase (before Python 3.9, the largest traced memory seen when the phase is paused or left) and
+    the largest allocation sites are reported, and with profile the whole run is profiled with cProfile. Both slow
+    the script down noticeably and can also be turned on with the PERF_TRACEMALLOC and PERF_PROFILE environment
+    variables.
+    """
+
+    def __init__(self, tool, label="", profile=False, traceMemory=False):
+        self.tool = tool
+        self.label = label
+        self.phases = {}
+        self.stack = []
+        self.extra = {}
+        self.profile = profile or env_enabled(PROFILE_ENV)
+        self.traceMemory = traceMemory or env_enabled(TRACEMALLOC_ENV)
+        self.profiler = None
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.startWall = time.perf_counter()
+        self.startCpu = time.process_time()
+
+    def _phase_stats(self, name):
+        if name not in self.phases:
+            self.phases[name] = {"calls": 0, "wall": 0.0, "cpu": 0.0, "rows": 0, "rss": 0.0, "traced": 0}
+        return self.phases[name]
+
+    def _flush(self):
+        """Add the time since the innermost phase was last entered or resumed to it."""
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if self.stack:
+            entry = self.stack[-1]
+            phase = self._phase_stats(entry[0])
+            phase["wall"] += wall - entry[1]
+            phase["cpu"] += cpu - entry[2]
+            if self.traceMemory:
+                phase["traced"] = max(phase["traced"], tracemalloc.get_traced_memory()[1 if RESET_PEAK else 0])
+        if self.traceMemory and RESET_PEAK:
+            tracemalloc.reset_peak()
+        return wall, cpu
+
+    @contextlib.contextmanager
+    def phase(self, name, rows=0):
+        """Time the body of a with statement as phase name, pausing the enclosing phase."""
+        wall, cpu = self._flush()
+        self.stack.append([name, wall, cpu])
+        try:
+            yield self
+        finally:
+            self._flush()
+            self.stack.pop()
+            phase = self._phase_stats(name)
+            phase["calls"] += 1
+            phase["rows"] += rows
+            phase["rss"] = max(phase["rss"], peak_memory_mb())
+            if self.stack:
+                self.stack[-1][1] = time.perf_counter()
+                self.stack[-1][2] = time.process_time()
+
+    def timed_iter(self, name, iterable, rows=None):
+        """
+        Yield the items of iterable, counting the time taken to produce each one as phase name. If provided,
+        rows(item) is added to the rows processed in the phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                if rows is not None:
+                    self.add_rows(name, rows(item))
+            yield item
+
+    def add_rows(self, name, rows):
+        self._phase_stats(name)["rows"] += rows
+
+    def update(self, stats):
+        """Record additional values, e.g. the stats dict of a script, in the perf.json file."""
+        self.extra.update(stats)
+
+    def report(self):
+        """Return the dict written to the perf.json file."""
+        wall = time.perf_counter() - self.startWall
+        cpu = time.process_time() - self.startCpu
+        phaseList = []
+        for name in sorted(self.phases, key=lambda x: (PHASES.index(x) if x in PHASES else len(PHASES), x)):
+            phase = self.phases[name]
+            phaseList.append(
+                {
+                    "name": name,
+                    "calls": phase["calls"],
+                    "wall_seconds": round(phase["wall"], 6),
+                    "cpu_seconds": round(phase["cpu"], 6),
+                    "rows": phase["rows"],
+                    "rows_per_second": round(phase["rows"] / phase["wall"], 1) if phase["wall"] > 0 else 0.0,
+                    "peak_rss_mb": round(phase["rss"], 1),
+                    "traced_peak_mb": round(phase["traced"] / 1024.0 / 1024.0, 1) if self.traceMemory else None,
+                }
+            )
+        phaseWall = sum([x["wall"] for x in self.phases.values()])
+        return {
+            "version": PERF_VERSION,
+            "tool": self.tool,
+            "label": self.label,
+            "pid": os.getpid(),
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(cpu, 6),
+            "other_seconds": round(max(wall - phaseWall, 0.0), 6),
+            "peak_rss_mb": round(peak_memory_mb(), 1),
+            "phases": phaseList,
+            "stats": self.extra,
+        }
+
+    def write(self, PerfFile):
+        """
+        Write the report as JSON to PerfFile. The cProfile statistics are dumped next to it with a '.prof'
+        extension and can be explored with e.g. 'python -m pstats' or snakeviz.
+        """
+        report = self.report()
+        PrefixFile = PerfFile[: -len(".json")] if PerfFile.endswith(".json") else PerfFile
+        if self.profiler is not None:
+            self.profiler.disable()
+            ProfileFile = PrefixFile + ".prof"
+            self.profiler.dump_stats(ProfileFile)
+            functionList = []
+            for (FileName, lineNo, func), (cc, nc, tt, ct, callers) in pstats.Stats(self.profiler).stats.items():
+                functionList.append(
+                    {
+                        "function": "{}:{}({})".format(os.path.basename(FileName), lineNo, func),
+                        "calls": nc,
+                        "total_seconds": round(tt, 6),
+                        "cumulative_seconds": round(ct, 6),
+                    }
+                )
+            functionList.sort(key=lambda x: -x["cumulative_seconds"])
+            report["profile"] = {"file": os.path.basename(ProfileFile), "top": functionList[:TOP_ENTRIES]}
+        if self.traceMemory:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, os.path.abspath(__file__)),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+                ]
+            )
+            report["tracemalloc"] = {
+                "current_mb": round(tracemalloc.get_traced_memory()[0] / 1024.0 / 1024.0, 1),
+                "top": [
+                    {"location": str(x.traceback), "size_mb": round(x.size / 1024.0 / 1024.0, 3), "count": x.count}
+                    for x in snapshot.statistics("lineno")[:TOP_ENTRIES]
+                ],
+            }
+        makedir(os.path.dirname(PerfFile))
+        with open(PerfFile, "w") as fout:
+            json.dump(report, fout, indent=2, default=str)
+            fout.write("\n")
+        return report
+
+
+def load_perf_file(PerfFile):
+    with open(PerfFile, "r") as fin:
+        report = json.load(fin)
+    if report.get("version") != PERF_VERSION:
+        print("ERROR: Unsupported perf file version in {}: {}".format(PerfFile, report.get("version")))
+        sys.exit(1)
+    return report
+
+
+def report_name(report, PerfFile):
+    """Row name of a report in the aggregated tables, e.g. 'SPT5 (macs2_merged_expand)'."""
+    label = report["label"] or os.path.basename(PerfFile)[: -len(".perf.json")]
+    return "{} ({})".format(label, os.path.splitext(report["tool"])[0])
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def perf_stats(PerfFiles, OutPrefix):
+    """
+    Write '<OutPrefix>_summary.tsv' with the totals of every task and '<OutPrefix>_phases.tsv' with the wall time
+    of every phase, one row per perf.json file. Phases missing from a task are written as 0.
+    """
+    reports = [(report_name(x, PerfFile), x) for PerfFile, x in [(y, load_perf_file(y)) for y in PerfFiles]]
+    reports.sort(key=lambda x: x[0])
+    phaseNames = set([y["name"] for name, x in reports for y in x["phases"]])
+    phaseOrder = [x for x in PHASES if x in phaseNames] + sorted(phaseNames.difference(PHASES)) + ["other"]
+
+    makedir(os.path.dirname(OutPrefix))
+    with open(OutPrefix + "_summary.tsv", "w") as fout:
+        fout.write(
+            "\t".join(["Sample", "tool", "wall_seconds", "cpu_seconds", "cpu_efficiency", "peak_rss_mb", "rows"]) + "\n"
+        )
+        for name, report in reports:
+            rows = max([x["rows"] for x in report["phases"]] + [0])
+            fout.write(
+                "\t".join(
+                    [
+                        name,
+                        report["tool"],
+                        "{:.3f}".format(report["wall_seconds"]),
+                        "{:.3f}".format(report["cpu_seconds"]),
+                        (
+                            "{:.3f}".format(report["cpu_seconds"] / report["wall_seconds"])
+                            if report["wall_seconds"]
+                            else "0"
+                        ),
+                        "{:.1f}".format(report["peak_rss_mb"]),
+                        str(rows),
+                    ]
+                )
+                + "\n"
+            )
+
+    with open(OutPrefix + "_phases.tsv", "w") as fout:
+        fout.write("\t".join(["Sample"] + phaseOrder) + "\n")
+        for name, report in reports:
+            seconds = dict([(x["name"], x["wall_seconds"]) for x in report["phases"]])
+            seconds["other"] = report["other_seconds"]
+            fout.write("\t".join([name] + ["{:.3f}".format(seconds.get(x, 0.0)) for x in phaseOrder]) + "\n")
+    return len(reports)
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    numReports = perf_stats(args.PERF_FILES, args.OUTPREFIX)
+    print("Aggregated {} perf files".format(numReports))
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
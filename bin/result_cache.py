@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Content-addressed result cache shared by the pipeline's Python helper scripts
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = "Summarise hit/miss statistics of a helper script result cache and optionally evict entries."
+    Epilog = """Example usage: python result_cache.py <CACHE_DIR> --evict --max_size 10240"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument("CACHE_DIR", help="Cache directory passed to the helper scripts with --cache_dir.")
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-ev",
+        "--evict",
+        dest="EVICT",
+        help="Evict least recently used entries until the cache is smaller than --max_size (default: False).",
+        action="store_true",
+    )
+    argParser.add_argument(
+        "-ms",
+        "--max_size",
+        type=int,
+        dest="MAX_SIZE",
+        default=10240,
+        help="Maximum cache size in MB (default: 10240).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## Bump to invalidate every existing entry when the key or store layout changes
+CACHE_VERSION = "1"
+
+## FICLONE ioctl request from linux/fs.h used to reflink a file on copy-on-write file systems (btrfs, XFS)
+FICLONE = 0x40049409
+
+HASH_BLOCK_SIZE = 1 << 20
+
+LOG_COLUMNS = ["time", "tool", "key", "status", "seconds", "bytes"]
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def reflink_file(src, dst):
+    """Clone src to dst sharing its data blocks. Raises OSError where reflinks are not supported."""
+    import fcntl
+
+    with open(src, "rb") as fin:
+        with open(dst, "wb") as fout:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            except OSError:
+                fout.close()
+                os.remove(dst)
+                raise
+
+
+def link_file(src, dst, hardlink=True):
+    """
+    Materialise src at dst without copying data if possible. Reflinks are tried first as they are copy-on-write,
+    then hardlinks if allowed, falling back to a plain copy across file systems. Returns the method used.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        reflink_file(src, dst)
+        return "reflink"
+    except (OSError, ImportError):
+        pass
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+############################################
+############################################
+## RESULT CACHE
+############################################
+############################################
+
+## Layout of CacheDir:
+##   objects/<key[:2]>/<key>/<role>   one directory per cached result holding one file per named output
+##   digests/<stat_key>               content digests of input files keyed by path, size, mtime and inode
+##   cache.log                        tab-delimited hit/miss/store/evict log, see LOG_COLUMNS
+## Entries are written to a temporary directory and renamed into place so concurrent tasks never see a partial
+## entry. The modification time of an entry directory is refreshed on every hit and is used for LRU eviction.
+## Outputs are copied (or reflinked) into the store and cached files are read-only, so a restored output that is
+## hardlinked to the store cannot be truncated by a later run writing to the same path.
+
+
+class ResultCache:
+    """
+    Content-addressed store of helper script outputs. Keys are derived from the script itself, the contents of
+    every input file and the parameters that affect the outputs, so a rerun with identical bytes is restored from
+    the cache even when upstream paths or timestamps have changed.
+    """
+
+    def __init__(self, CacheDir, maxSizeMb=10240, tool=""):
+        self.cacheDir = os.path.abspath(CacheDir)
+        self.objectDir = os.path.join(self.cacheDir, "objects")
+        self.digestDir = os.path.join(self.cacheDir, "digests")
+        self.logFile = os.path.join(self.cacheDir, "cache.log")
+        self.maxSize = maxSizeMb * 1024 * 1024
+        self.tool = tool
+        makedir(self.objectDir)
+        makedir(self.digestDir)
+
+    def file_digest(self, path):
+        """SHA-256 of a file's contents. Digests are memoised on disk by path, size, mtime and inode."""
+        stat = os.stat(path)
+        statKey = hashlib.sha1(
+            "\t".join([os.path.realpath(path), str(stat.st_size), str(stat.st_mtime_ns), str(stat.st_ino)]).encode()
+        ).hexdigest()
+        DigestFile = os.path.join(self.digestDir, statKey)
+        if os.path.exists(DigestFile):
+            with open(DigestFile, "r") as fin:
+                digest = fin.read().strip()
+            if len(digest) == 64:
+                return digest
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as fin:
+            for block in iter(lambda: fin.read(HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        fd, TmpFile = tempfile.mkstemp(dir=self.digestDir)
+        with os.fdopen(fd, "w") as fout:
+            fout.write(digest + "\n")
+        os.replace(TmpFile, DigestFile)
+        return digest
+
+    def key(self, ScriptFile, InputFiles, params):
+        """
+        Cache key for running ScriptFile on InputFiles with params, a dict of parameter values that affect the
+        outputs. Input file names are not part of the key, only their order and contents.
+        """
+        sha = hashlib.sha256()
+        sha.update(("result_cache:" + CACHE_VERSION + "\n").encode())
+        sha.update(("script:" + self.file_digest(ScriptFile) + "\n").encode())
+        for InputFile in InputFiles:
+            sha.update(("input:" + self.file_digest(InputFile) + "\n").encode())
+        for param in sorted(params):
+            sha.update(("param:{}={!r}\n".format(param, params[param])).encode())
+        return sha.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.objectDir, key[:2], key)
+
+    def log(self, status, key, seconds=0.0, size=0):
+        """Append a line to the cache log. Single short appends are atomic so concurrent tasks can share it."""
+        newFile = not os.path.exists(self.logFile)
+        with open(self.logFile, "a") as fout:
+            if newFile:
+                fout.write("\t".join(LOG_COLUMNS) + "\n")
+            fout.write(
+                "{}\t{}\t{}\t{}\t{:.3f}\t{}\n".format(
+                    time.strftime("%Y-%m-%dT%H:%M:%S"), self.tool, key, status, seconds, size
+                )
+            )
+
+    def fetch(self, key, OutputFiles):
+        """
+        Materialise the cached outputs for key at the paths in OutputFiles, a dict of {role: path}. Returns True on
+        a hit. A missing or incomplete entry, including one evicted while it is being read, is a miss.
+        """
+        startTime = time.time()
+        EntryDir = self._entry_dir(key)
+        size = 0
+        restored = []
+        try:
+            for role, OutFile in OutputFiles.items():
+                CachedFile = os.path.join(EntryDir, role)
+                size += os.path.getsize(CachedFile)
+                makedir(os.path.dirname(OutFile))
+                link_file(CachedFile, OutFile)
+                restored.append(OutFile)
+            os.utime(EntryDir, None)
+        except OSError:
+            for OutFile in restored:
+                os.remove(OutFile)
+            self.log("miss", key, time.time() - startTime)
+            return False
+        self.log("hit", key, time.time() - startTime, size)
+        return True
+
+    def store(self, key, OutputFiles):
+        """Add the outputs in OutputFiles, a dict of {role: path}, to the cache under key and evict if needed."""
+        startTime = time.time()
+        EntryDir = self._entry_dir(key)
+        if os.path.isdir(EntryDir):
+            return
+        makedir(os.path.dirname(EntryDir))
+        TmpDir = tempfile.mkdtemp(dir=os.path.dirname(EntryDir), prefix=".tmp_")
+        size = 0
+        try:
+            for role, OutFile in OutputFiles.items():
+                CachedFile = os.path.join(TmpDir, role)
+                link_file(OutFile, CachedFile, hardlink=False)
+                os.chmod(CachedFile, 0o444)
+                size += os.path.getsize(OutFile)
+            os.rename(TmpDir, EntryDir)
+        except OSError:
+            ## Another task stored the same key first or an output is missing
+            shutil.rmtree(TmpDir, ignore_errors=True)
+            return
+        self.log("store", key, time.time() - startTime, size)
+        self.evict()
+
+    def entries(self):
+        """Return [(lastUsed, size, EntryDir), ...] for every complete entry in the cache."""
+        entryList = []
+        for prefix in os.listdir(self.objectDir):
+            PrefixDir = os.path.join(self.objectDir, prefix)
+            if not os.path.isdir(PrefixDir):
+                continue
+            for name in os.listdir(PrefixDir):
+                if name.startswith(".tmp_"):
+                    continue
+                EntryDir = os.path.join(PrefixDir, name)
+                try:
+                    size = sum([os.path.getsize(os.path.join(EntryDir, x)) for x in os.listdir(EntryDir)])
+                    entryList.append((os.path.getmtime(EntryDir), size, EntryDir))
+                except OSError:
+                    continue
+        return entryList
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in maxSize. Returns the number removed."""
+        entryList = sorted(self.entries())
+        totalSize = sum([x[1] for x in entryList])
+        numEvicted = 0
+        for lastUsed, size, EntryDir in entryList:
+            if totalSize <= self.maxSize:
+                break
+            shutil.rmtree(EntryDir, ignore_errors=True)
+            totalSize -= size
+            numEvicted += 1
+            self.log("evict", os.path.basename(EntryDir), size=size)
+        return numEvicted
+
+
+def cached_run(CacheDir, ScriptFile, InputFiles, params, OutputFiles, func, maxSizeMb=10240):
+    """
+    Call func() to produce OutputFiles ({role: path}) unless an identical run is in the cache at CacheDir, in which
+    case the outputs are restored instead. Results are only stored when func() returns and every output exists.
+    Returns True if the outputs were restored from the cache. An empty CacheDir disables caching.
+    """
+    if not CacheDir:
+        func()
+        return False
+
+    cache = ResultCache(CacheDir, maxSizeMb=maxSizeMb, tool=os.path.basename(ScriptFile))
+    key = cache.key(ScriptFile, InputFiles, params)
+    if cache.fetch(key, OutputFiles):
+        print("Restored {} output file(s) from cache {} ({})".format(len(OutputFiles), cache.cacheDir, key[:12]))
+        return True
+    func()
+    if all([os.path.exists(x) for x in OutputFiles.values()]):
+        cache.store(key, OutputFiles)
+    return False
+
+
+def summarise_log(LogFile):
+    """Return {tool: {status: count}} from a cache log."""
+    summary = {}
+    if not os.path.exists(LogFile):
+        return summary
+    with open(LogFile, "r") as fin:
+        fin.readline()
+        for line in fin:
+            lspl = line.rstrip("\n").split("\t")
+            if len(lspl) != len(LOG_COLUMNS):
+                continue
+            counts = summary.setdefault(lspl[1], {})
+            counts[lspl[3]] = counts.get(lspl[3], 0) + 1
+    return summary
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def main(args=None):
+    args = parse_args(args)
+    if not os.path.isdir(args.CACHE_DIR):
+        print("ERROR: Cache directory does not exist: {}".format(args.CACHE_DIR))
+        sys.exit(1)
+
+    cache = ResultCache(args.CACHE_DIR, maxSizeMb=args.MAX_SIZE, tool="result_cache.py")
+    if args.EVICT:
+        print("Evicted {} cache entries".format(cache.evict()))
+
+    entryList = cache.entries()
+    print(
+        "{} cache entries using {:.1f} MB of {} MB".format(
+            len(entryList), sum([x[1] for x in entryList]) / 1024.0 / 1024.0, args.MAX_SIZE
+        )
+    )
+    print("\t".join(["tool", "hit", "miss", "hit_rate", "store", "evict"]))
+    for tool, counts in sorted(summarise_log(cache.logFile).items()):
+        lookups = counts.get("hit", 0) + counts.get("miss", 0)
+        print(
+            "\t".join(
+                [
+                    tool or "NA",
+                    str(counts.get("hit", 0)),
+                    str(counts.get("miss", 0)),
+                    "{:.3f}".format(float(counts.get("hit", 0)) / lookups) if lookups else "NA",
+                    str(counts.get("store", 0)),
+                    str(counts.get("evict", 0)),
+                ]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+#######################################################################
+#######################################################################
+## Strand cross-correlation QC metrics (NSC, RSC, fragment length)
+#######################################################################
+#######################################################################
+
+import os
+import sys
+import time
+import errno
+import argparse
+import itertools
+import resource
+import collections
+import multiprocessing
+
+import numpy as np
+import pysam
+
+############################################
+############################################
+## PARSE ARGUMENTS
+############################################
+############################################
+
+
+def parse_args(args=None):
+    Description = (
+        "Calculate the strand cross-correlation profile of a BAM file from the 5' ends of reads on each strand and "
+        "write the NSC, RSC and fragment length estimates in the 'run_spp.R' output format from phantompeakqualtools."
+    )
+    Epilog = """Example usage: python strand_cross_correlation.py <BAM_FILE> <OUTFILE> --sample_name SAMPLE_R1 --mqc_prefix SAMPLE_R1 --threads 4"""
+
+    argParser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+
+    ## REQUIRED PARAMETERS
+    argParser.add_argument(
+        "BAM_FILE", help="Coordinate-sorted BAM file. A .bai/.csi index enables parallel per-chromosome correlation."
+    )
+    argParser.add_argument(
+        "OUTFILE", help="Tab-delimited *.spp.out file with one line of metrics, as for 'run_spp.R -out'."
+    )
+
+    ## OPTIONAL PARAMETERS
+    argParser.add_argument(
+        "-sn",
+        "--sample_name",
+        type=str,
+        dest="SAMPLE_NAME",
+        default="",
+        help="Sample name written to the MultiQC NSC and RSC tables (default: BAM file name without extension).",
+    )
+    argParser.add_argument(
+        "-sr",
+        "--shift_range",
+        type=str,
+        dest="SHIFT_RANGE",
+        default="-500:5:1500",
+        help="Strand shifts as <min>:<step>:<max> in bp, as for 'run_spp.R -s'. Reads are binned at <step> bp (default: '-500:5:1500').",
+    )
+    argParser.add_argument(
+        "-er",
+        "--exclusion_range",
+        type=str,
+        dest="EXCLUSION_RANGE",
+        default="",
+        help="Strand shifts as <min>:<max> in bp that are not considered for the fragment length, as for 'run_spp.R -x' (default: 10:<read length + 10>).",
+    )
+    argParser.add_argument(
+        "-rl",
+        "--read_length",
+        type=int,
+        dest="READ_LENGTH",
+        default=0,
+        help="Read length used as the phantom peak position. 0 uses the most frequent read length in the BAM file (default: 0).",
+    )
+    argParser.add_argument(
+        "-mp",
+        "--mqc_prefix",
+        type=str,
+        dest="MQC_PREFIX",
+        default="",
+        help="Also write '<MQC_PREFIX>.spp_correlation_mqc.tsv', '<MQC_PREFIX>.spp_nsc_mqc.tsv' and '<MQC_PREFIX>.spp_rsc_mqc.tsv' for MultiQC (default: '').",
+    )
+    argParser.add_argument(
+        "-hd",
+        "--header_dir",
+        type=str,
+        dest="HEADER_DIR",
+        default="",
+        help="Directory holding 'spp_correlation_header.txt', 'spp_nsc_header.txt' and 'spp_rsc_header.txt', prepended to the MultiQC tables (default: '').",
+    )
+    argParser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        dest="THREADS",
+        default=1,
+        help="Number of chromosomes correlated in parallel (default: 1).",
+    )
+    return argParser.parse_args(args)
+
+
+############################################
+############################################
+## HELPER FUNCTIONS
+############################################
+############################################
+
+## Number of bins correlated per FFT so memory does not grow with chromosome length
+FFT_BLOCK_BINS = 1 << 18
+
+## MultiQC tables written with --mqc_prefix and the header file prepended to each
+MQC_TABLES = [
+    ("correlation", ".spp_correlation_mqc.tsv", "spp_correlation_header.txt"),
+    ("nsc", ".spp_nsc_mqc.tsv", "spp_nsc_header.txt"),
+    ("rsc", ".spp_rsc_mqc.tsv", "spp_rsc_header.txt"),
+]
+
+
+def makedir(path):
+    if not len(path) == 0:
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is reported in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def parse_range(Range, numFields, option):
+    """Parse a colon-separated list of integers such as '-500:5:1500', exiting with an error if it is malformed."""
+    try:
+        values = [int(x) for x in Range.split(":")]
+    except ValueError:
+        values = []
+    if len(values) != numFields:
+        print("ERROR: Invalid value '{}' for {}!".format(Range, option))
+        sys.exit(1)
+    return values
+
+
+def read_strand_ends(reads):
+    """
+    Collect the 5' end of every primary mapped read from an iterator of alignments.
+    Returns (plus strand ends, minus strand ends, Counter of read lengths).
+    """
+    plusEnds = []
+    minusEnds = []
+    readLengths = collections.Counter()
+    for read in reads:
+        ## Unmapped, secondary and supplementary alignments
+        if read.flag & 0x904:
+            continue
+        if read.is_reverse:
+            minusEnds.append(read.reference_end - 1)
+        else:
+            plusEnds.append(read.reference_start)
+        readLengths[read.infer_query_length(always=False)] += 1
+    return np.array(plusEnds, dtype=np.int64), np.array(minusEnds, dtype=np.int64), readLengths
+
+
+def binned_tags(ends, binSize):
+    """Return the sorted bin indices of ends and the sum of squared tag counts over all bins."""
+    bins = np.sort(ends // binSize)
+    counts = np.unique(bins, return_counts=True)[1]
+    return bins, float(np.dot(counts, counts))
+
+
+def block_counts(bins, start, end):
+    """Dense tag counts for bins [start, end) from sorted bin indices."""
+    left, right = np.searchsorted(bins, [start, end])
+    return np.bincount(bins[left:right] - start, minlength=end - start).astype(np.float64)
+
+
+def shifted_products(plusBins, minusBins, numBins, minLag, maxLag):
+    """
+    Return sum_i plus[i] * minus[i + lag] for every lag in [minLag, maxLag] (in bins), where plus and minus are the
+    tag counts per bin along a chromosome of numBins bins. The chromosome is split into blocks of FFT_BLOCK_BINS and
+    each block of the plus strand is correlated against the matching minus strand window with a real FFT, so only
+    blocks with plus strand tags are transformed and memory is bounded by the block size rather than the chromosome.
+    """
+    span = maxLag - minLag
+    fftLength = 1 << int(np.ceil(np.log2(FFT_BLOCK_BINS + span + 1)))
+    products = np.zeros(span + 1, dtype=np.float64)
+    blockStarts = np.unique(plusBins // FFT_BLOCK_BINS) * FFT_BLOCK_BINS
+    for blockStart in blockStarts:
+        blockEnd = min(blockStart + FFT_BLOCK_BINS, numBins)
+        plus = block_counts(plusBins, blockStart, blockEnd)
+        ## Window of the minus strand reached by every lag from this block, zero beyond the chromosome ends
+        minus = block_counts(minusBins, blockStart + minLag, blockEnd + maxLag)
+        if not minus.any():
+            continue
+        correlation = np.fft.irfft(np.conj(np.fft.rfft(plus, fftLength)) * np.fft.rfft(minus, fftLength), fftLength)
+        products += correlation[: span + 1]
+    return np.rint(products)
+
+
+def chromosome_correlation(plusEnds, minusEnds, chromLength, binSize, minLag, maxLag):
+    """
+    Pearson correlation between the binned plus strand tag counts and the minus strand tag counts shifted by each
+    lag in [minLag, maxLag] (in bins) along one chromosome. Returns None if either strand has no tags.
+    """
+    if not len(plusEnds) or not len(minusEnds):
+        return None
+    numBins = chromLength // binSize + 1
+    plusBins, plusSquares = binned_tags(plusEnds, binSize)
+    minusBins, minusSquares = binned_tags(minusEnds, binSize)
+    plusMean = len(plusBins) / float(numBins)
+    minusMean = len(minusBins) / float(numBins)
+    plusVar = plusSquares / numBins - plusMean * plusMean
+    minusVar = minusSquares / numBins - minusMean * minusMean
+    if plusVar <= 0 or minusVar <= 0:
+        return None
+    products = shifted_products(plusBins, minusBins, numBins, minLag, maxLag)
+    return (products / numBins - plusMean * minusMean) / np.sqrt(plusVar * minusVar)
+
+
+def correlate_chromosome(task):
+    """Pool worker: correlate one chromosome of an indexed BAM file. Returns (tags, correlation, read lengths)."""
+    BAMFile, chrom, chromLength, binSize, minLag, maxLag = task
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    plusEnds, minusEnds, readLengths = read_strand_ends(bam.fetch(chrom))
+    bam.close()
+    correlation = chromosome_correlation(plusEnds, minusEnds, chromLength, binSize, minLag, maxLag)
+    return len(plusEnds) + len(minusEnds), correlation, readLengths
+
+
+def local_maxima(values):
+    """Indices of interior points that are larger than the point before and no smaller than the point after."""
+    return np.where((values[1:-1] > values[:-2]) & (values[1:-1] >= values[2:]))[0] + 1
+
+
+def running_mean(values, window):
+    """Centred running mean with the window shrunk at the ends, as for 'caTools::runmean(endrule="mean")'."""
+    if window <= 1:
+        return values
+    kernel = np.ones(window)
+    return np.convolve(values, kernel, mode="same") / np.convolve(np.ones(len(values)), kernel, mode="same")
+
+
+def quality_tag(rsc):
+    """Thresholded RSC quality tag reported by 'run_spp.R': -2 (very low) to 2 (very high)."""
+    for threshold, tag in [(0.25, -2), (0.5, -1), (1.0, 0), (1.5, 1)]:
+        if rsc < threshold:
+            return tag
+    return 2
+
+
+def format_value(value):
+    return "%.7g" % value
+
+
+############################################
+############################################
+## MAIN FUNCTION
+############################################
+############################################
+
+
+def strand_cross_correlation(BAMFile, shiftRange=(-500, 5, 1500), threads=1):
+    """
+    Return (shifts, correlation, number of tags, read length counts) for BAMFile.
+
+    Each chromosome is correlated independently, in a process pool when the BAM file is indexed, and the
+    per-chromosome profiles are averaged weighted by their number of tags, as in 'spp::get.binding.characteristics'.
+    """
+    minShift, binSize, maxShift = shiftRange
+    minLag = int(np.floor(float(minShift) / binSize))
+    maxLag = int(np.ceil(float(maxShift) / binSize))
+    shifts = np.arange(minLag, maxLag + 1) * binSize
+
+    bam = pysam.AlignmentFile(BAMFile, "rb")
+    chromSizes = list(zip(bam.references, bam.lengths))
+    if bam.has_index():
+        bam.close()
+        tasks = [(BAMFile, chrom, length, binSize, minLag, maxLag) for chrom, length in chromSizes]
+        ## Largest chromosomes first so the pool is not left waiting on a big one at the end
+        tasks.sort(key=lambda x: -x[2])
+        if threads > 1:
+            pool = multiprocessing.Pool(processes=threads)
+            results = list(pool.imap_unordered(correlate_chromosome, tasks))
+            pool.close()
+            pool.join()
+        else:
+            results = [correlate_chromosome(x) for x in tasks]
+    else:
+        print("WARNING: No index found for {}, correlating in a single pass without parallelism.".format(BAMFile))
+        results = []
+        for tid, reads in itertools.groupby(bam.fetch(until_eof=True), key=lambda x: x.reference_id):
+            if tid < 0:
+                continue
+            plusEnds, minusEnds, readLengths = read_strand_ends(reads)
+            correlation = chromosome_correlation(plusEnds, minusEnds, chromSizes[tid][1], binSize, minLag, maxLag)
+            results.append((len(plusEnds) + len(minusEnds), correlation, readLengths))
+        bam.close()
+
+    numTags = 0
+    readLengths = collections.Counter()
+    weightedSum = np.zeros(len(shifts), dtype=np.float64)
+    weights = 0
+    for chromTags, correlation, chromReadLengths in results:
+        numTags += chromTags
+        readLengths.update(chromReadLengths)
+        if correlation is not None:
+            weightedSum += chromTags * correlation
+            weights += chromTags
+    if not weights:
+        print("ERROR: No chromosome of {} has reads on both strands!".format(BAMFile))
+        sys.exit(1)
+    return shifts, weightedSum / weights, numTags, readLengths
+
+
+def cross_correlation_metrics(shifts, correlation, readLength, exclusionRange=None):
+    """
+    Derive the 'run_spp.R' metrics from a cross-correlation profile. The fragment length estimates are the top three
+    local maxima at positive shifts outside exclusionRange, the phantom peak is the maximum near the read length and
+    NSC and RSC compare the top fragment length peak to the minimum and the phantom peak.
+    """
+    binSize = int(shifts[1] - shifts[0]) if len(shifts) > 1 else 1
+    if exclusionRange is None:
+        exclusionRange = (10, readLength + 10)
+    smoothed = running_mean(correlation, 2 * int(np.ceil(5.0 / binSize) // 2) + 1)
+
+    candidates = [
+        x for x in local_maxima(smoothed) if shifts[x] > 0 and not exclusionRange[0] <= shifts[x] <= exclusionRange[1]
+    ]
+    if not candidates:
+        candidates = [
+            x for x in range(len(shifts)) if shifts[x] > 0 and not exclusionRange[0] <= shifts[x] <= exclusionRange[1]
+        ]
+    if not candidates:
+        print("ERROR: No strand shift left to estimate the fragment length from, check --shift_range!")
+        sys.exit(1)
+    peaks = sorted(candidates, key=lambda x: -smoothed[x])[:3]
+
+    phantom = np.where((shifts >= readLength - round(2 * binSize)) & (shifts <= readLength + round(1.5 * binSize)))[0]
+    if len(phantom):
+        phantomIdx = phantom[np.argmax(correlation[phantom])]
+    else:
+        phantomIdx = int(np.argmin(np.abs(shifts - readLength)))
+    minIdx = int(np.argmin(correlation))
+
+    peakCorr = correlation[peaks[0]]
+    minCorr = correlation[minIdx]
+    phantomCorr = correlation[phantomIdx]
+    nsc = peakCorr / minCorr if minCorr else float("nan")
+    rsc = (peakCorr - minCorr) / (phantomCorr - minCorr) if phantomCorr != minCorr else float("nan")
+    return {
+        "fragment_lengths": [int(shifts[x]) for x in peaks],
+        "fragment_correlations": [correlation[x] for x in peaks],
+        "phantom_peak": int(shifts[phantomIdx]),
+        "phantom_correlation": phantomCorr,
+        "min_shift": int(shifts[minIdx]),
+        "min_correlation": minCorr,
+        "nsc": nsc,
+        "rsc": rsc,
+        "quality_tag": quality_tag(rsc),
+    }
+
+
+############################################
+############################################
+## RUN FUNCTION
+############################################
+############################################
+
+
+def write_spp_out(OutFile, BAMFile, numTags, metrics):
+    """Write the 11 tab-delimited 'run_spp.R -out' columns. NSC and RSC are columns 9 and 10."""
+    makedir(os.path.dirname(OutFile))
+    fout = open(OutFile, "w")
+    fields = [
+        os.path.basename(BAMFile),
+        str(numTags),
+        ",".join([str(x) for x in metrics["fragment_lengths"]]),
+        ",".join([format_value(x) for x in metrics["fragment_correlations"]]),
+        str(metrics["phantom_peak"]),
+        format_value(metrics["phantom_correlation"]),
+        str(metrics["min_shift"]),
+        format_value(metrics["min_correlation"]),
+        format_value(metrics["nsc"]),
+        format_value(metrics["rsc"]),
+        str(metrics["quality_tag"]),
+    ]
+    fout.write("\t".join(fields) + "\n")
+    fout.close()
+
+
+def write_mqc_tables(MQCPrefix, HeaderDir, sampleName, shifts, correlation, metrics):
+    """Write the MultiQC custom content tables previously exported from the run_spp.R RData file with R."""
+    makedir(os.path.dirname(MQCPrefix))
+    for table, suffix, HeaderFile in MQC_TABLES:
+        fout = open(MQCPrefix + suffix, "w")
+        if HeaderDir:
+            fin = open(os.path.join(HeaderDir, HeaderFile), "r")
+            fout.write(fin.read())
+            fin.close()
+        if table == "correlation":
+            for shift, value in zip(shifts, correlation):
+                fout.write("{},{:.15g}\n".format(int(shift), value))
+        else:
+            fout.write("{}\t{}\n".format(sampleName, format_value(metrics[table])))
+        fout.close()
+
+
+def main(args=None):
+    args = parse_args(args)
+    startTime = time.time()
+    shiftRange = parse_range(args.SHIFT_RANGE, 3, "--shift_range")
+    if shiftRange[1] <= 0 or shiftRange[0] >= shiftRange[2]:
+        print("ERROR: Invalid value '{}' for --shift_range!".format(args.SHIFT_RANGE))
+        sys.exit(1)
+    exclusionRange = parse_range(args.EXCLUSION_RANGE, 2, "--exclusion_range") if args.EXCLUSION_RANGE else None
+
+    shifts, correlation, numTags, readLengths = strand_cross_correlation(
+        args.BAM_FILE, shiftRange=shiftRange, threads=args.THREADS
+    )
+    readLength = args.READ_LENGTH if args.READ_LENGTH else readLengths.most_common(1)[0][0]
+    metrics = cross_correlation_metrics(shifts, correlation, readLength, exclusionRange=exclusionRange)
+
+    write_spp_out(args.OUTFILE, args.BAM_FILE, numTags, metrics)
+    if args.MQC_PREFIX:
+        sampleName = args.SAMPLE_NAME if args.SAMPLE_NAME else os.path.splitext(os.path.basename(args.BAM_FILE))[0]
+        write_mqc_tables(args.MQC_PREFIX, args.HEADER_DIR, sampleName, shifts, correlation, metrics)
+
+    print(
+        "Correlated {} tags, fragment length {}, NSC {}, RSC {} in {:.1f}s, peak memory {:.1f} MB".format(
+            numTags,
+            metrics["fragment_lengths"][0],
+            format_value(metrics["nsc"]),
+            format_value(metrics["rsc"]),
+            time.time() - startTime,
+            peak_memory_mb(),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
+
+############################################
+############################################
+############################################
+############################################
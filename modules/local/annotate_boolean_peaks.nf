@@ -2,10 +2,10 @@ process ANNOTATE_BOOLEAN_PEAKS {
     tag "$meta.id"
     label 'process_low'
 
-    conda (params.enable_conda ? "conda-forge::sed=4.7" : null)
+    conda (params.enable_conda ? "conda-forge::python=3.9.1" : null)
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
-        'https://depot.galaxyproject.org/singularity/ubuntu:20.04' :
-        'ubuntu:20.04' }"
+        'https://depot.galaxyproject.org/singularity/python:3.9--1' :
+        'quay.io/biocontainers/python:3.9--1' }"
 
     input:
     tuple val(meta), path(boolean_txt), path(homer_peaks)
@@ -14,15 +14,20 @@ process ANNOTATE_BOOLEAN_PEAKS {
     path '*.boolean.annotatePeaks.txt', emit: annotate_peaks_txt
     path "versions.yml"               , emit: versions
 
-    script:
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args   = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
     """
-    cut -f2- ${homer_peaks} | awk 'NR==1; NR > 1 {print \$0 | "sort -T '.' -k1,1 -k2,2n"}' | cut -f6- > tmp.txt
-    paste $boolean_txt tmp.txt > ${prefix}.boolean.annotatePeaks.txt
+    annotate_boolean_peaks.py \\
+        $boolean_txt \\
+        $homer_peaks \\
+        ${prefix}.boolean.annotatePeaks.txt \\
+        --key interval_id \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
-        sed: \$(echo \$(sed --version 2>&1) | sed 's/^.*GNU sed) //; s/ .*\$//')
+        python: \$(python --version | sed 's/Python //g')
     END_VERSIONS
     """
 }
@@ -22,88 +22,66 @@
  * - Removes duplicates (unless keep_dups = true)
  * - Removes blacklisted regions
  * - Ensures proper paired-end reads (when applicable)
+ *
+ * All filters are applied in a single BAM read/write pass by bin/bam_filter.py, which also
+ * reports the number of alignments removed by each filter as MultiQC custom content.
  */
 process BAM_FILTER {
     tag "$meta.id"
     label 'process_medium'
 
-    conda (params.enable_conda ? "bioconda::bedtools=2.30.0 bioconda::samtools=1.15.1" : null)
+    conda (params.enable_conda ? "bioconda::pysam=0.19.0 bioconda::samtools=1.15.1" : null)
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
-        'https://depot.galaxyproject.org/singularity/mulled-v2-8186960447c5cb2faa697666dc1e6d919ad23f3e:3127fcae6b6bdaf8181e21a26ae61231030a9fcb-0':
-        'quay.io/biocontainers/mulled-v2-8186960447c5cb2faa697666dc1e6d919ad23f3e:3127fcae6b6bdaf8181e21a26ae61231030a9fcb-0' }"
+        'https://depot.galaxyproject.org/singularity/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0':
+        'quay.io/biocontainers/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0' }"
 
     input:
     tuple val(meta), path(bam), path(bai)
     path bed
+    path mqc_header
 
     output:
-    tuple val(meta), path("*.filter2.bam"), emit: bam
-    path "versions.yml"           , emit: versions
-
-    script:
+    tuple val(meta), path("*.filter2.bam")     , emit: bam
+    tuple val(meta), path("*.filter_mqc.tsv")  , emit: mqc
+    path "versions.yml"                        , emit: versions
 
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args             = task.ext.args ?: ''
     def prefix           = task.ext.prefix ?: "${meta.id}"
     // ALWAYS exclude secondary (0x100) and supplementary (0x800) alignments
     // This ensures only primary alignments are processed, even when keep_multi_map=true
-    def base_filter      = '-F 0x0100 -F 0x0800'  // Exclude secondary + supplementary
-    def filter_params    = meta.single_end ? 
-        "${base_filter} -F 0x004" : 
-        "${base_filter} -F 0x004 -F 0x0008 -f 0x001 -f 0x002"  // proper pair selection
-    def dup_params       = params.keep_dups ? '' : '-F 0x0400'
-    def blacklist_params = params.blacklist ? "-L $bed" : ''
-    def max_frag = params.insert_size ? params.insert_size.toInteger() : 500
-
-    if(params.keep_multi_map == false ) {
-
-        """
-        # General filtering of the bam
-        samtools view \\
-            $filter_params \\
-            $dup_params \\
-            $blacklist_params \\
-            -b $bam > ${prefix}.filter1.bam
-        
-        # Remove multi-mappers (MAPQ < 1) and filter by fragment size
-        # -q 1: Keep only reads with MAPQ >= 1 (removes primary alignments with MAPQ=0)
-        # Note: Secondary alignments already removed by -F 0x100 in filter_params
-        # awk: Filter pairs with insert size <= max_frag (default: params.insert_size = 500bp)
-
-        samtools view -q 1 -h ${prefix}.filter1.bam | \\
-            awk -v var="$max_frag" '{if(substr(\$0,1,1)=="@" || ((\$9>=0?\$9:-\$9)<=var)) print \$0}' | \\
-            samtools view -b > ${prefix}.filter2.bam
-
-        cat <<-END_VERSIONS > versions.yml
-        "${task.process}":
-            samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
-        END_VERSIONS
-        """
-        
-    } else {
-
-        """
-        # General filtering of the bam
-        samtools view \\
-            $filter_params \\
-            $dup_params \\
-            $blacklist_params \\
-            -b $bam > ${prefix}.filter1.bam
-
-        # Filter pairs by insert size (keep_multi_map=true mode)
-        # Keep primary alignments with MAPQ=0 (multi-mappers)
-        # Note: Secondary alignments already removed by -F 0x100 in filter_params
-        # awk: Filter pairs with insert size <= max_frag (default: params.insert_size = 500bp)
-        
-        samtools view -h ${prefix}.filter1.bam | \\
-            awk -v var="$max_frag" '{if(substr(\$0,1,1)=="@" || ((\$9>=0?\$9:-\$9)<=var)) print \$0}' | \\
-            samtools view -b > ${prefix}.filter2.bam
-
-        cat <<-END_VERSIONS > versions.yml
-        "${task.process}":
-            samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
-        END_VERSIONS
-        """
-
-    }
+    // Single-end: also exclude unmapped (0x004)
+    // Paired-end: also exclude unmapped (0x004) and mate unmapped (0x008), require paired + proper pair (0x001 + 0x002)
+    def filter_params    = meta.single_end ?
+        "--exclude_flags 0x0904" :
+        "--exclude_flags 0x090C --require_flags 0x0003"
+    def dup_params       = params.keep_dups ? '' : '--remove_duplicates'
+    def blacklist_params = params.blacklist ? "--regions $bed" : ''
+    // -q 1: Keep only reads with MAPQ >= 1 (removes primary alignments with MAPQ=0) unless keep_multi_map=true
+    def mapq_params      = params.keep_multi_map ? '' : '--min_mapq 1'
+    // Filter pairs with |TLEN| <= max_frag (default: params.insert_size = 500bp); TLEN is 0 for single-end reads
+    def max_frag         = params.insert_size ? params.insert_size.toInteger() : 500
+    """
+    # Flags, duplicates, blacklist, MAPQ and fragment size are applied in a single BAM read/write pass
+    bam_filter.py \\
+        $bam \\
+        ${prefix}.filter2.bam \\
+        $filter_params \\
+        $dup_params \\
+        $blacklist_params \\
+        $mapq_params \\
+        --max_fragment $max_frag \\
+        --threads $task.cpus \\
+        --stats_file ${prefix}.filter_stats.tsv \\
+        --sample_name $meta.id \\
+        $args
 
+    cat $mqc_header ${prefix}.filter_stats.tsv > ${prefix}.filter_mqc.tsv
 
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
+    END_VERSIONS
+    """
 }
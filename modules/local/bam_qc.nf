@@ -0,0 +1,46 @@
+/*
+ * Single-pass BAM QC metrics (flag counts, per-chromosome counts, MAPQ, insert size, fingerprint)
+ */
+process BAM_QC {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda (params.enable_conda ? 'bioconda::deeptools=3.5.1' : null)
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/deeptools:3.5.1--py_0' :
+        'quay.io/biocontainers/deeptools:3.5.1--py_0' }"
+
+    input:
+    tuple val(meta), path(bam), path(bai)
+    path mqc_headers
+
+    output:
+    tuple val(meta), path("*.bam_qc_*_mqc.tsv"), emit: mqc
+    path "versions.yml"                        , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args   = task.ext.args   ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    bam_qc.py \\
+        $bam \\
+        ${prefix} \\
+        --sample_name ${meta.id} \\
+        --threads $task.cpus \\
+        $args
+
+    for table in stats chroms mapq insert_size fingerprint; do
+        cat bam_qc_\${table}_header.txt ${prefix}.bam_qc_\${table}.tsv > ${prefix}.bam_qc_\${table}_mqc.tsv
+    done
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
+        numpy: \$(python -c "import numpy; print(numpy.__version__)")
+    END_VERSIONS
+    """
+}
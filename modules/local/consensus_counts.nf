@@ -0,0 +1,46 @@
+/*
+ * Count fragments per consensus interval for all samples of an antibody in one job
+ */
+process CONSENSUS_COUNTS {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda (params.enable_conda ? 'bioconda::deeptools=3.5.1' : null)
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/deeptools:3.5.1--py_0' :
+        'quay.io/biocontainers/deeptools:3.5.1--py_0' }"
+
+    input:
+    tuple val(meta), path(bams), path(bais), path(matrix)
+
+    output:
+    tuple val(meta), path("*featureCounts.txt")        , emit: counts
+    tuple val(meta), path("*featureCounts.txt.summary"), emit: summary
+    tuple val(meta), path("*featureCounts.npz")        , emit: npz
+    path "versions.yml"                                , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args       = task.ext.args   ?: ''
+    def prefix     = task.ext.prefix ?: "${meta.id}"
+    def paired_end = meta.single_end ? '' : '--paired_end'
+    """
+    consensus_counts.py \\
+        $matrix \\
+        ${bams.join(',')} \\
+        ${prefix}.featureCounts.txt \\
+        --npz_file ${prefix}.featureCounts.npz \\
+        --threads $task.cpus \\
+        $paired_end \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
+        numpy: \$(python -c "import numpy; print(numpy.__version__)")
+    END_VERSIONS
+    """
+}
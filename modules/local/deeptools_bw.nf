@@ -8,41 +8,38 @@ process DEEPTOOLS_BIGWIG {
         'quay.io/biocontainers/deeptools:3.5.1--py_0' }"
 
     input:
-    tuple val(meta), path(bam), path(bai)
+    tuple val(meta), path(bam), path(bai), val(scaling)
 
     output:
-    tuple val(meta), path("*.extend.bw"), emit: bigwig
-    tuple val(meta), path("*.extend.center.bw"), emit: center_bigwig
-    path "versions.yml"                , emit: versions
-
-    script:
+    tuple val(meta), path("*.extend.bw")          , emit: bigwig
+    tuple val(meta), path("*.extend.center.bw")   , emit: center_bigwig
+    tuple val(meta), path("*/*.extend.bw")        , optional:true, emit: norm_bigwig
+    tuple val(meta), path("*/*.extend.center.bw") , optional:true, emit: norm_center_bigwig
+    path "versions.yml"                           , emit: versions
+
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args   = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
-    def extend = (meta.single_end && params.fragment_size > 0) ? "--extendReads ${params.fragment_size}" : '--extendReads'
+    def extend = (meta.single_end && params.fragment_size > 0) ? "--extend_length ${params.fragment_size}" : ''
+    // scaling: [ [ norm_method, scaling_factor ], ... ] written to <norm_method>/<meta.id>.extend{.center}.bw
+    def scale  = scaling ? "--scale_factors " + scaling.collect { "${it[0]}/${meta.id}:${it[1]}" }.join(',') : ''
     """
-
-    bamCoverage \\
-        --bam $bam \\
-        --binSize 1 \\
-        --numberOfProcessors $task.cpus \\
-        --normalizeUsing CPM \\
+    # Extended and read-centred coverage are built from a single pass over the BAM file;
+    # the CPM track and every scaled track are written from the same per-chromosome coverage
+    bam_coverage.py \\
+        $bam \\
+        ${prefix} \\
         $extend \\
-        --maxFragmentLength 10000 \\
-        -o ${prefix}.extend.bw
-
-    bamCoverage \\
-        --bam $bam \\
-        --binSize 1 \\
-        --numberOfProcessors $task.cpus \\
-        --normalizeUsing CPM \\
-        $extend \\
-        --maxFragmentLength 10000 \\
-        --centerReads \\
-        -o ${prefix}.extend.center.bw
-
+        --max_fragment_length 10000 \\
+        $scale \\
+        --threads $task.cpus \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
-        deeptools: \$(computeMatrix --version | sed -e "s/computeMatrix //g")
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
+        pybigwig: \$(python -c "import pyBigWig; print(pyBigWig.__version__)")
     END_VERSIONS
     """
 }
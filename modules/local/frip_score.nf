@@ -2,30 +2,36 @@ process FRIP_SCORE {
     tag "$meta.id"
     label 'process_medium'
 
-    conda (params.enable_conda ? "bioconda::bedtools=2.30.0 bioconda::samtools=1.15.1" : null)
+    conda (params.enable_conda ? "bioconda::pysam=0.19.0 bioconda::samtools=1.15.1" : null)
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
-        'https://depot.galaxyproject.org/singularity/mulled-v2-8186960447c5cb2faa697666dc1e6d919ad23f3e:3127fcae6b6bdaf8181e21a26ae61231030a9fcb-0':
-        'quay.io/biocontainers/mulled-v2-8186960447c5cb2faa697666dc1e6d919ad23f3e:3127fcae6b6bdaf8181e21a26ae61231030a9fcb-0' }"
+        'https://depot.galaxyproject.org/singularity/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0':
+        'quay.io/biocontainers/mulled-v2-57736af1eb98c01010848572c9fec9fff6ffaafd:402e865b8f6af2f3e58c6fc8d57127ff0144b2c7-0' }"
 
     input:
-    tuple val(meta), path(bam), path(peak)
+    tuple val(meta), path(bam), path(bai), path(peak)
 
     output:
     tuple val(meta), path("*.txt"), emit: txt
     path "versions.yml"           , emit: versions
 
-    script:
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
     def args   = task.ext.args   ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
+    def cache  = params.helper_cache_dir ? "--cache_dir ${params.helper_cache_dir}" : ''
     """
-    READS_IN_PEAKS=\$(intersectBed -a $bam -b $peak $args | awk -F '\t' '{sum += \$NF} END {print sum}')
-    samtools flagstat $bam > ${bam}.flagstat
-    grep 'mapped (' ${bam}.flagstat | grep -v "primary" | awk -v a="\$READS_IN_PEAKS" -v OFS='\t' '{print "${prefix}", a/\$1}' > ${prefix}.FRiP.txt
+    frip_score.py \\
+        $bam \\
+        $peak \\
+        ${prefix}.FRiP.txt \\
+        --peak_names ${prefix} \\
+        --threads $task.cpus \\
+        $cache \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
-        bedtools: \$(bedtools --version | sed -e "s/bedtools v//g")
-        samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
     END_VERSIONS
     """
 }
@@ -4,10 +4,10 @@
 process GENOME_BLACKLIST_REGIONS {
     tag "$sizes"
 
-    conda (params.enable_conda ? "bioconda::bedtools=2.30.0" : null)
+    conda (params.enable_conda ? 'bioconda::deeptools=3.5.1' : null)
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
-        'https://depot.galaxyproject.org/singularity/bedtools:2.30.0--hc088bd4_0':
-        'quay.io/biocontainers/bedtools:2.30.0--hc088bd4_0' }"
+        'https://depot.galaxyproject.org/singularity/deeptools:3.5.1--py_0' :
+        'quay.io/biocontainers/deeptools:3.5.1--py_0' }"
 
     input:
     path sizes
@@ -18,25 +18,21 @@ process GENOME_BLACKLIST_REGIONS {
     path '*.bed'       , emit: bed
     path "versions.yml", emit: versions
 
-    script:
-    def file_out = "${sizes.simpleName}.include_regions.bed"
-    if (blacklist && !keep_blacklist) {
-        """
-        sortBed -i $blacklist -g $sizes | complementBed -i stdin -g $sizes > $file_out
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def prefix    = "${sizes.simpleName}.include_regions"
+    def exclude   = (blacklist && !keep_blacklist) ? "--blacklist $blacklist" : ''
+    def cache     = params.helper_cache_dir ? "--cache_dir ${params.helper_cache_dir}" : ''
+    """
+    genome_regions.py \\
+        $sizes \\
+        ${prefix}.bed \\
+        $exclude \\
+        $cache
 
-        cat <<-END_VERSIONS > versions.yml
-        "${task.process}":
-            bedtools: \$(bedtools --version | sed -e "s/bedtools v//g")
-        END_VERSIONS
-        """
-    } else {
-        """
-        awk '{print \$1, '0' , \$2}' OFS='\t' $sizes > $file_out
-
-        cat <<-END_VERSIONS > versions.yml
-        "${task.process}":
-            bedtools: \$(bedtools --version | sed -e "s/bedtools v//g")
-        END_VERSIONS
-        """
-    }
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        numpy: \$(python -c "import numpy; print(numpy.__version__)")
+    END_VERSIONS
+    """
 }
@@ -2,10 +2,10 @@ process GTF2BED {
     tag "$gtf"
     label 'process_low'
 
-    conda (params.enable_conda ? "conda-forge::perl=5.26.2" : null)
+    conda (params.enable_conda ? "conda-forge::python=3.9.1" : null)
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
-        'https://depot.galaxyproject.org/singularity/perl:5.26.2':
-        'quay.io/biocontainers/perl:5.26.2' }"
+        'https://depot.galaxyproject.org/singularity/python:3.9--1' :
+        'quay.io/biocontainers/python:3.9--1' }"
 
     input:
     path gtf
@@ -15,14 +15,19 @@ process GTF2BED {
     path "versions.yml", emit: versions
 
     script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args  = task.ext.args ?: ''
+    def cache = params.helper_cache_dir ? "--cache_dir ${params.helper_cache_dir}" : ''
     """
-    gtf2bed \\
+    gtf2bed.py \\
         $gtf \\
-        > ${gtf.baseName}.bed
+        ${gtf.baseName}.bed \\
+        --threads $task.cpus \\
+        $cache \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
-        perl: \$(echo \$(perl --version 2>&1) | sed 's/.*v\\(.*\\)) built.*/\\1/')
+        python: \$(python --version | sed 's/Python //g')
     END_VERSIONS
     """
 }
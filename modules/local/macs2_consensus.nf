@@ -1,8 +1,9 @@
 /*
- * Consensus peaks across samples, create boolean filtering file, SAF file for featureCounts
+ * Consensus peaks across samples, create boolean filtering file and consensus matrix for counting
  */
 process MACS2_CONSENSUS {
     tag "$meta.id"
+    label 'process_medium'
     label 'process_long'
 
     conda (params.enable_conda ? "conda-forge::biopython conda-forge::r-optparse=1.7.1 conda-forge::r-upsetr=1.4.0 bioconda::bedtools=2.30.0" : null)
@@ -15,37 +16,41 @@ process MACS2_CONSENSUS {
 
     output:
     tuple val(meta), path("*.bed")          , emit: bed
-    tuple val(meta), path("*.saf")          , emit: saf
     tuple val(meta), path("*.pdf")          , emit: pdf
     tuple val(meta), path("*.antibody.txt") , emit: txt
     tuple val(meta), path("*.boolean.txt")  , emit: boolean_txt
     tuple val(meta), path("*.intersect.txt"), emit: intersect_txt
+    tuple val(meta), path("*.index.npz")    , emit: index
+    tuple val(meta), path("*.boolean.npz")  , emit: boolean_npz
+    tuple val(meta), path("*.perf.json")    , optional:true, emit: perf
     path "versions.yml"                     , emit: versions
 
     when:
     task.ext.when == null || task.ext.when
 
     script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args         = task.ext.args      ?: ''
     def prefix       = task.ext.prefix    ?: "${meta.id}"
     def peak_type    = params.narrow_peak ? 'narrowPeak' : 'broadPeak'
-    def mergecols    = params.narrow_peak ? (2..10).join(',') : (2..9).join(',')
-    def collapsecols = params.narrow_peak ? (['collapse']*9).join(',') : (['collapse']*8).join(',')
     def expandparam  = params.narrow_peak ? '--is_narrow_peak' : ''
+    def cache        = params.helper_cache_dir ? "--cache_dir ${params.helper_cache_dir}" : ''
+    def perf         = params.helper_perf_stats ? "--perf_file ${prefix}.perf.json" : ''
     """
-    sort -T '.' -k1,1 -k2,2n ${peaks.collect{it.toString()}.sort().join(' ')} \\
-        | mergeBed -c $mergecols -o $collapsecols > ${prefix}.txt
-  
     macs2_merged_expand.py \\
-        ${prefix}.txt \\
+        ${peaks.collect{it.toString()}.sort().join(',')} \\
         ${peaks.collect{it.toString()}.sort().join(',').replaceAll("_peaks.${peak_type}","").replaceAll("_chr[^,]*","")} \\
         ${prefix}.boolean.txt \\
+        --peak_files \\
+        --bed_file ${prefix}.bed \\
+        --index_file ${prefix}.index.npz \\
+        --matrix_file ${prefix}.boolean.npz \\
+        --streaming \\
+        --threads $task.cpus \\
         --min_replicates $params.min_reps_consensus \\
-        $expandparam
-
-    awk -v FS='\t' -v OFS='\t' 'FNR > 1 { print \$1, \$2, \$3, \$4, "0", "+" }' ${prefix}.boolean.txt > ${prefix}.bed
-
-    echo -e "GeneID\tChr\tStart\tEnd\tStrand" > ${prefix}.saf
-    awk -v FS='\t' -v OFS='\t' 'FNR > 1 { print \$4, \$1, \$2, \$3,  "+" }' ${prefix}.boolean.txt >> ${prefix}.saf
+        $expandparam \\
+        $cache \\
+        $perf \\
+        $args
 
     plot_peak_intersect.r -i ${prefix}.boolean.intersect.txt -o ${prefix}.boolean.intersect.plot.pdf
 
@@ -0,0 +1,66 @@
+/*
+ * Consensus peaks of every antibody in a single task, see MACS2_CONSENSUS
+ */
+process MACS2_CONSENSUS_BATCH {
+    label 'process_medium'
+
+    conda (params.enable_conda ? "conda-forge::biopython conda-forge::r-optparse=1.7.1 conda-forge::r-upsetr=1.4.0 bioconda::bedtools=2.30.0" : null)
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/mulled-v2-2f48cc59b03027e31ead6d383fe1b8057785dd24:5d182f583f4696f4c4d9f3be93052811b383341f-0':
+        'quay.io/biocontainers/mulled-v2-2f48cc59b03027e31ead6d383fe1b8057785dd24:5d182f583f4696f4c4d9f3be93052811b383341f-0' }"
+
+    input:
+    val ids
+    path manifest
+    path peaks
+
+    output:
+    path "*.bed"                          , emit: bed
+    path "*.pdf"                          , emit: pdf
+    path "*.antibody.txt"                 , emit: txt
+    path "*.boolean.txt"                  , emit: boolean_txt
+    path "*.intersect.txt"                , emit: intersect_txt
+    path "*.index.npz"                    , emit: index
+    path "*.boolean.npz"                  , emit: boolean_npz
+    path "*.perf.json"    , optional:true , emit: perf
+    path "versions.yml"                   , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args         = task.ext.args      ?: ''
+    def expandparam  = params.narrow_peak ? '--is_narrow_peak' : ''
+    def cache        = params.helper_cache_dir ? "--cache_dir ${params.helper_cache_dir}" : ''
+    def perf         = params.helper_perf_stats ? "--perf_file '{group}.consensus_peaks.perf.json'" : ''
+    // Output names match those of MACS2_CONSENSUS with its '<antibody>.consensus_peaks' prefix
+    """
+    macs2_merged_expand.py \\
+        $manifest \\
+        ${ids.sort().join(',')} \\
+        '{group}.consensus_peaks.boolean.txt' \\
+        --manifest \\
+        --bed_file '{group}.consensus_peaks.bed' \\
+        --index_file '{group}.consensus_peaks.index.npz' \\
+        --matrix_file '{group}.consensus_peaks.boolean.npz' \\
+        --streaming \\
+        --threads $task.cpus \\
+        --min_replicates $params.min_reps_consensus \\
+        $expandparam \\
+        $cache \\
+        $perf \\
+        $args
+
+    for id in ${ids.sort().join(' ')}; do
+        plot_peak_intersect.r -i \${id}.consensus_peaks.boolean.intersect.txt -o \${id}.consensus_peaks.boolean.intersect.plot.pdf
+        echo "\${id}.consensus_peaks.bed\t\${id}/\${id}.consensus_peaks.bed" > \${id}.consensus_peaks.antibody.txt
+    done
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        r-base: \$(echo \$(R --version 2>&1) | sed 's/^.*R version //; s/ .*\$//')
+    END_VERSIONS
+    """
+
+}
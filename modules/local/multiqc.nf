@@ -30,7 +30,9 @@ process MULTIQC {
     path ('alignment/mergedLibrary/filtered/*')
     path ('alignment/mergedLibrary/filtered/*')
     path ('alignment/mergedLibrary/filtered/*')
+    path ('alignment/mergedLibrary/filtered/*')
     path ('alignment/mergedLibrary/filtered/picard_metrics/*')
+    path ('alignment/mergedLibrary/filtered/bam_qc/*')
 
     path ('deeptools/*')
     path ('deeptools/*')
@@ -49,6 +51,8 @@ process MULTIQC {
     path ('deseq2/*')
     path ('deseq2/*')
 
+    path ('pipeline_info/perf_stats/*')
+
     output:
     path "*multiqc_report.html", emit: report
     path "*_data"              , emit: data
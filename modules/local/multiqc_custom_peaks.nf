@@ -6,18 +6,15 @@ process MULTIQC_CUSTOM_PEAKS {
         'ubuntu:20.04' }"
 
     input:
-    tuple val(meta), path(peak), path(frip)
-    path peak_count_header
+    tuple val(meta), path(frip)
     path frip_score_header
 
     output:
-    tuple val(meta), path("*.peak_count_mqc.tsv"), emit: count
-    tuple val(meta), path("*.FRiP_mqc.tsv")      , emit: frip
+    tuple val(meta), path("*.FRiP_mqc.tsv"), emit: frip
 
     script:
     def prefix = task.ext.prefix ?: "${meta.id}"
     """
-    cat $peak | wc -l | awk -v OFS='\t' '{ print "${prefix}", \$1 }' | cat $peak_count_header - > ${prefix}.peak_count_mqc.tsv
     cat $frip_score_header $frip > ${prefix}.FRiP_mqc.tsv
 
     cat <<-END_VERSIONS > versions.yml
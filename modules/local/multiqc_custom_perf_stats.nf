@@ -0,0 +1,40 @@
+/*
+ * Aggregate the per-task timing and memory reports of the Python helper scripts for MultiQC
+ */
+process MULTIQC_CUSTOM_PERF_STATS {
+    label 'process_low'
+
+    conda (params.enable_conda ? "conda-forge::python=3.9.1" : null)
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/python:3.9--1' :
+        'quay.io/biocontainers/python:3.9--1' }"
+
+    input:
+    path perf_files
+    path mqc_headers
+
+    output:
+    path "*_mqc.tsv"   , emit: mqc
+    path "versions.yml", emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args = task.ext.args ?: ''
+    """
+    perf_stats.py \\
+        $perf_files \\
+        --outprefix perf_stats \\
+        $args
+
+    for table in summary phases; do
+        cat perf_stats_\${table}_header.txt perf_stats_\${table}.tsv > perf_stats_\${table}_mqc.tsv
+    done
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,47 @@
+/*
+ * Stream the MACS2 peak files of an antibody into peak counts, summary statistics and fixed-bin histograms
+ */
+process PEAK_STATS {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda (params.enable_conda ? "conda-forge::python=3.9.1" : null)
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/python:3.9--1' :
+        'quay.io/biocontainers/python:3.9--1' }"
+
+    input:
+    tuple val(meta), path(peaks)
+    path mqc_headers
+
+    output:
+    tuple val(meta), path("*.summary.txt")  , emit: summary
+    tuple val(meta), path("*.histogram.txt"), emit: histogram
+    tuple val(meta), path("*_mqc.tsv")      , emit: mqc
+    path "versions.yml"                     , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args      = task.ext.args ?: ''
+    def prefix    = task.ext.prefix ?: "${meta.id}"
+    def peak_type = params.narrow_peak ? 'narrowPeak' : 'broadPeak'
+    """
+    peak_stats.py \\
+        ${peaks.join(',')} \\
+        ${peaks.join(',').replaceAll("_peaks.${peak_type}","")} \\
+        $prefix \\
+        --threads $task.cpus \\
+        $args
+
+    for table in count length fold qvalue; do
+        cat peak_\${table}_header.txt ${prefix}.peak_\${table}.tsv > ${prefix}.peak_\${table}_mqc.tsv
+    done
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
@@ -7,7 +7,8 @@ process PLOT_MACS2_QC {
         'quay.io/biocontainers/mulled-v2-ad9dd5f398966bf899ae05f8e7c54d0fb10cdfa7:05678da05b8e5a7a5130e90a9f9a6c585b965afa-0' }"
 
     input:
-    path peaks
+    path summaries
+    path histograms
 
     output:
     path '*.txt'       , emit: txt
@@ -15,12 +16,11 @@ process PLOT_MACS2_QC {
     path "versions.yml", emit: versions
 
     script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
-    def args      = task.ext.args ?: ''
-    def peak_type = params.narrow_peak ? 'narrowPeak' : 'broadPeak'
+    def args = task.ext.args ?: ''
     """
     plot_macs2_qc.r \\
-        -i ${peaks.join(',')} \\
-        -s ${peaks.join(',').replaceAll("_peaks.${peak_type}","")} \\
+        -i ${summaries.join(',')} \\
+        -g ${histograms.join(',')} \\
         $args
 
     cat <<-END_VERSIONS > versions.yml
@@ -1,5 +1,6 @@
 process SAMPLESHEET_CHECK {
     tag "$samplesheet"
+    label 'process_low'
 
     conda (params.enable_conda ? "conda-forge::python=3.9.1" : null)
     container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
@@ -11,16 +12,30 @@ process SAMPLESHEET_CHECK {
 
     output:
     path '*.csv'       , emit: csv
+    path '*.tsv'       , optional:true, emit: timings
+    path '*.perf.json' , optional:true, emit: perf
     path "versions.yml", emit: versions
 
     when:
     task.ext.when == null || task.ext.when
 
     script: // This script is bundled with the pipeline, in /bin/
+    def cache = params.helper_cache_dir ? "--cache_dir ${params.helper_cache_dir}" : ''
+    def perf     = params.helper_perf_stats ? '--perf_file samplesheet.perf.json' : ''
+    def validate = ''
+    if (params.validate_fastq) {
+        validate = "--validate_fastq --threads $task.cpus --timings_file fastq_validation.tsv"
+        if (params.helper_cache_dir) {
+            validate += " --validation_cache ${params.helper_cache_dir}/fastq_validation.json"
+        }
+    }
     """
     check_samplesheet.py \\
         $samplesheet \\
-        samplesheet.valid.csv
+        samplesheet.valid.csv \\
+        $cache \\
+        $perf \\
+        $validate
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
@@ -0,0 +1,49 @@
+/*
+ * Strand cross-correlation QC metrics and MultiQC tables in the phantompeakqualtools format
+ */
+process STRAND_CROSS_CORRELATION {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda (params.enable_conda ? 'bioconda::deeptools=3.5.1' : null)
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/deeptools:3.5.1--py_0' :
+        'quay.io/biocontainers/deeptools:3.5.1--py_0' }"
+
+    input:
+    tuple val(meta), path(bam), path(bai)
+    path nsc_header
+    path rsc_header
+    path correlation_header
+
+    output:
+    tuple val(meta), path("*.spp.out")                , emit: spp
+    tuple val(meta), path("*.spp_nsc_mqc.tsv")        , emit: nsc
+    tuple val(meta), path("*.spp_rsc_mqc.tsv")        , emit: rsc
+    tuple val(meta), path("*.spp_correlation_mqc.tsv"), emit: correlation
+    path "versions.yml"                               , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script: // This script is bundled with the pipeline, in nf-core/chipseq/bin/
+    def args   = task.ext.args   ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    strand_cross_correlation.py \\
+        $bam \\
+        ${prefix}.spp.out \\
+        --sample_name ${meta.id} \\
+        --mqc_prefix ${prefix} \\
+        --header_dir . \\
+        --threads $task.cpus \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        pysam: \$(python -c "import pysam; print(pysam.__version__)")
+        numpy: \$(python -c "import numpy; print(numpy.__version__)")
+    END_VERSIONS
+    """
+}
@@ -9,6 +9,7 @@ workflow BAM_FILTER {
     take:
     ch_bam_bai   // channel: [ val(meta), [ bam ] ]
     ch_bed       // channel: [ bed ]
+    mqc_header   // file: bam_filter_header.txt
 
     main:
 
@@ -20,7 +21,7 @@ workflow BAM_FILTER {
     // unmapped reads, and filters by fragment size
     //
     
-    BAM_FILTER_PROCESS( ch_bam_bai, ch_bed )
+    BAM_FILTER_PROCESS( ch_bam_bai, ch_bed, mqc_header )
     ch_versions = ch_versions.mix(BAM_FILTER_PROCESS.out.versions.first())
 
     // Use filtered BAM for downstream processing
@@ -34,6 +35,7 @@ workflow BAM_FILTER {
     stats    = BAM_SORT_SAMTOOLS.out.stats    // channel: [ val(meta), [ stats ] ]
     flagstat = BAM_SORT_SAMTOOLS.out.flagstat // channel: [ val(meta), [ flagstat ] ]
     idxstats = BAM_SORT_SAMTOOLS.out.idxstats // channel: [ val(meta), [ idxstats ] ]
+    mqc      = BAM_FILTER_PROCESS.out.mqc     // channel: [ val(meta), [ mqc ] ]
 
     versions = ch_versions                    // channel: [ versions.yml ]
 }
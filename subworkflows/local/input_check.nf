@@ -17,6 +17,7 @@ workflow INPUT_CHECK {
 
     emit: 
     reads                                     // channel: [ val(meta), [ reads ] ]
+    perf     = SAMPLESHEET_CHECK.out.perf     // channel: [ samplesheet.perf.json ]
     versions = SAMPLESHEET_CHECK.out.versions // channel: [ versions.yml ]
 }
 
@@ -0,0 +1,85 @@
+import os
+import sys
+
+import pytest
+
+pysam = pytest.importorskip("pysam")
+
+## The helper scripts in bin/ are not a package, so import them as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "bin"))
+
+
+def write_bam(path, chroms, reads, index=True):
+    """
+    Write a coordinate-sorted BAM file of reads given as dicts with name, flag, chrom and pos, and optionally cigar,
+    mapq, mate_chrom, mate_pos and tlen. Unmapped reads without a chrom are written last.
+    """
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": x, "LN": y} for x, y in chroms]}
+    chromIdx = dict([(x[0], i) for i, x in enumerate(chroms)])
+    records = []
+    for read in reads:
+        segment = pysam.AlignedSegment()
+        segment.query_name = read["name"]
+        segment.flag = read["flag"]
+        cigar = read.get("cigar", "50M")
+        segment.reference_id = chromIdx.get(read.get("chrom"), -1)
+        segment.reference_start = read.get("pos", -1)
+        segment.mapping_quality = read.get("mapq", 30)
+        segment.next_reference_id = chromIdx.get(read.get("mate_chrom"), -1)
+        segment.next_reference_start = read.get("mate_pos", -1)
+        segment.template_length = read.get("tlen", 0)
+        if segment.reference_id >= 0:
+            segment.cigarstring = cigar
+        length = read.get("length", 50)
+        segment.query_sequence = "A" * length
+        segment.query_qualities = pysam.qualitystring_to_array("I" * length)
+        records.append(segment)
+    records.sort(key=lambda x: (x.reference_id < 0, x.reference_id, x.reference_start))
+    with pysam.AlignmentFile(str(path), "wb", header=header) as fout:
+        for segment in records:
+            fout.write(segment)
+    if index:
+        pysam.index(str(path))
+    return str(path)
+
+
+def read_pair(name, chrom, pos, matePos, length=50, tlen=None, mateChrom=None, mapq=30, flags=0):
+    """Forward read at pos and reverse mate at matePos as two read dicts, properly paired when on one chromosome."""
+    mateChrom = mateChrom or chrom
+    if tlen is None:
+        tlen = matePos + length - pos if mateChrom == chrom else 0
+    proper = 0x2 if mateChrom == chrom else 0
+    return [
+        dict(
+            name=name,
+            flag=0x1 | proper | 0x20 | 0x40 | flags,
+            chrom=chrom,
+            pos=pos,
+            cigar="{}M".format(length),
+            length=length,
+            mapq=mapq,
+            mate_chrom=mateChrom,
+            mate_pos=matePos,
+            tlen=tlen,
+        ),
+        dict(
+            name=name,
+            flag=0x1 | proper | 0x10 | 0x80 | flags,
+            chrom=mateChrom,
+            pos=matePos,
+            cigar="{}M".format(length),
+            length=length,
+            mapq=mapq,
+            mate_chrom=chrom,
+            mate_pos=pos,
+            tlen=-tlen,
+        ),
+    ]
+
+
+@pytest.fixture
+def make_bam(tmp_path):
+    def make(reads, chroms=(("chr1", 10000), ("chr2", 5000)), name="sample.bam", index=True):
+        return write_bam(tmp_path / name, chroms, reads, index=index)
+
+    return make
@@ -0,0 +1,126 @@
+import math
+
+import pytest
+
+from conftest import read_pair
+
+pyBigWig = pytest.importorskip("pyBigWig")
+
+import bam_coverage  # noqa: E402
+
+CHROMS = (("chr1", 2000), ("chr2", 1000))
+
+## Proper pairs, a pair with its mate on another chromosome and one pair on chr2
+PE_READS = (
+    read_pair("p1", "chr1", 100, 250)
+    + read_pair("p2", "chr1", 120, 300)
+    + read_pair("p3", "chr1", 400, 500)
+    + read_pair("p4", "chr1", 1500, 1700)
+    + read_pair("x1", "chr1", 800, 300, mateChrom="chr2")
+    + read_pair("p5", "chr2", 10, 150)
+)
+
+## Single-end reads on both strands, including reads extended past either end of a chromosome
+SE_READS = [
+    dict(name="s1", flag=0, chrom="chr1", pos=100),
+    dict(name="s2", flag=16, chrom="chr1", pos=400),
+    dict(name="s3", flag=0, chrom="chr1", pos=1950),
+    dict(name="s4", flag=16, chrom="chr2", pos=20),
+    dict(name="s5", flag=0, chrom="chr2", pos=500, mapq=0),
+]
+
+## Non-zero runs of the bigWig files written by deepTools 3.5.1 'bamCoverage --binSize 1 --normalizeUsing CPM
+## --maxFragmentLength 10000 --extendReads [150] [--centerReads]' for the BAM files above
+BAMCOVERAGE_CPM = {
+    ("pe", "extend"): [
+        ("chr1", 100, 120, 166667.0),
+        ("chr1", 120, 300, 333333.0),
+        ("chr1", 300, 350, 166667.0),
+        ("chr1", 400, 550, 166667.0),
+        ("chr1", 800, 1000, 83333.296875),
+        ("chr1", 1500, 1750, 166667.0),
+        ("chr2", 10, 150, 166667.0),
+        ("chr2", 150, 200, 250000.0),
+        ("chr2", 200, 350, 83333.296875),
+    ],
+    ("pe", "extend.center"): [
+        ("chr1", 175, 210, 166667.0),
+        ("chr1", 210, 225, 333333.0),
+        ("chr1", 225, 260, 166667.0),
+        ("chr1", 450, 500, 166667.0),
+        ("chr1", 875, 925, 83333.296875),
+        ("chr1", 1600, 1650, 166667.0),
+        ("chr2", 80, 130, 166667.0),
+        ("chr2", 225, 275, 83333.296875),
+    ],
+    ("se", "extend"): [
+        ("chr1", 100, 250, 200000.0),
+        ("chr1", 300, 450, 200000.0),
+        ("chr1", 1950, 2000, 200000.0),
+        ("chr2", 0, 70, 200000.0),
+        ("chr2", 500, 650, 200000.0),
+    ],
+    ("se", "extend.center"): [
+        ("chr1", 150, 200, 200000.0),
+        ("chr1", 350, 400, 200000.0),
+        ("chr2", 0, 20, 200000.0),
+        ("chr2", 550, 600, 200000.0),
+    ],
+}
+
+## 'bamCoverage --binSize 1 --scaleFactor 0.5 --maxFragmentLength 10000 --extendReads' for the paired-end BAM file
+BAMCOVERAGE_SCALED = [
+    ("chr1", 100, 120, 1.0),
+    ("chr1", 120, 300, 2.0),
+    ("chr1", 300, 350, 1.0),
+    ("chr1", 400, 550, 1.0),
+    ("chr1", 800, 1000, 0.5),
+    ("chr1", 1500, 1750, 1.0),
+    ("chr2", 10, 150, 1.0),
+    ("chr2", 150, 200, 1.5),
+    ("chr2", 200, 350, 0.5),
+]
+
+
+def nonzero_runs(BigWigFile):
+    """[(chrom, start, end, value), ...] of the non-zero values of a bigWig file, merging adjacent equal runs."""
+    bw = pyBigWig.open(BigWigFile)
+    runs = []
+    for chrom in bw.chroms():
+        for start, end, value in bw.intervals(chrom) or []:
+            if not value or math.isnan(value):
+                continue
+            if runs and runs[-1][0] == chrom and runs[-1][2] == start and runs[-1][3] == value:
+                runs[-1] = (chrom, runs[-1][1], end, value)
+            else:
+                runs.append((chrom, start, end, value))
+    bw.close()
+    return runs
+
+
+@pytest.mark.parametrize("library,extend", [("pe", "0"), ("se", "150")])
+@pytest.mark.parametrize("threads", ["1", "2"])
+def test_cpm_tracks_match_bamcoverage(tmp_path, make_bam, library, extend, threads):
+    BAMFile = make_bam(PE_READS if library == "pe" else SE_READS, chroms=CHROMS)
+    prefix = str(tmp_path / library)
+    bam_coverage.main(
+        [BAMFile, prefix, "--extend_length", extend, "--max_fragment_length", "10000", "--threads", threads]
+    )
+    for track in ["extend", "extend.center"]:
+        assert nonzero_runs("{}.{}.bw".format(prefix, track)) == BAMCOVERAGE_CPM[(library, track)]
+
+
+def test_scaled_tracks_match_bamcoverage(tmp_path, make_bam):
+    BAMFile = make_bam(PE_READS, chroms=CHROMS)
+    bam_coverage.main(
+        [
+            BAMFile,
+            str(tmp_path / "pe"),
+            "--max_fragment_length",
+            "10000",
+            "--scale_factors",
+            "{}:0.5".format(tmp_path / "norm" / "pe"),
+        ]
+    )
+    assert nonzero_runs(str(tmp_path / "norm" / "pe.extend.bw")) == BAMCOVERAGE_SCALED
+    assert nonzero_runs(str(tmp_path / "pe.extend.bw")) == BAMCOVERAGE_CPM[("pe", "extend")]
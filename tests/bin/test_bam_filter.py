@@ -0,0 +1,51 @@
+import pysam
+
+import bam_filter
+from conftest import read_pair
+
+## Alignments failing each filter in turn, counted against the first filter they fail
+READS = (
+    read_pair("kept", "chr1", 100, 250)
+    + read_pair("duplicate", "chr1", 400, 550, flags=0x400)
+    + read_pair("long_fragment", "chr1", 1000, 2000)
+    + [
+        dict(name="secondary", flag=0x100 | 0x3, chrom="chr1", pos=120),
+        dict(name="not_proper", flag=0x1 | 0x40, chrom="chr1", pos=130),
+        dict(name="unmapped", flag=0x1 | 0x4 | 0x8 | 0x40),
+        dict(name="low_mapq", flag=0x3 | 0x40, chrom="chr1", pos=140, mapq=0),
+        dict(name="blacklisted", flag=0x3 | 0x40, chrom="chr1", pos=5000),
+        dict(name="overlaps_region_end", flag=0x3 | 0x40, chrom="chr1", pos=2980),
+        dict(name="no_regions_on_chr2", flag=0x3 | 0x40, chrom="chr2", pos=100),
+    ]
+)
+REGIONS = "chr1\t0\t1500\nchr1\t1400\t3000\n"
+
+
+def test_filters_match_samtools_view(tmp_path, make_bam):
+    BAMFile = make_bam(READS)
+    args = ["--exclude_flags", "0x090C", "--require_flags", "0x0003", "--remove_duplicates", "--min_mapq", "1"]
+    RegionFile = tmp_path / "include_regions.bed"
+    RegionFile.write_text(REGIONS)
+    OutFile = str(tmp_path / "sample.filtered.bam")
+    StatsFile = str(tmp_path / "sample.filter_mqc.tsv")
+    bam_filter.main(
+        [BAMFile, OutFile, "--regions", str(RegionFile), "--max_fragment", "500", "--stats_file", StatsFile]
+        + ["--sample_name", "A"]
+        + args
+    )
+    bam = pysam.AlignmentFile(OutFile, "rb")
+    assert [x.query_name for x in bam.fetch(until_eof=True)] == ["kept", "kept", "overlaps_region_end"]
+    assert bam.header.to_dict()["PG"][-1]["ID"] == "bam_filter.py"
+    bam.close()
+
+    stats = [x.split("\t") for x in open(StatsFile).read().splitlines()]
+    assert stats == [
+        ["Sample"] + bam_filter.FILTER_COLUMNS,
+        ["A", "3", "3", "2", "1", "2", "2"],
+    ]
+
+
+def test_without_filters_every_alignment_is_kept(tmp_path, make_bam):
+    OutFile = str(tmp_path / "sample.filtered.bam")
+    counts = bam_filter.bam_filter(make_bam(READS), OutFile)
+    assert counts == dict([(x, len(READS) if x == "passed" else 0) for x in bam_filter.FILTER_COLUMNS])
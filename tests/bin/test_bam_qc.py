@@ -0,0 +1,95 @@
+import pytest
+
+import bam_qc
+from conftest import read_pair
+
+## Proper pairs, one with an insert above --max_insert_size, a pair with mates on different chromosomes, a read
+## whose mate is unmapped, and secondary, supplementary, QC-failed and duplicate single-end alignments
+READS = (
+    read_pair("proper", "chr1", 100, 250)
+    + read_pair("long_insert", "chr2", 1000, 2450)
+    + read_pair("mate_on_chr2", "chr1", 800, 300, mateChrom="chr2")
+    + [
+        dict(name="singleton", flag=0x1 | 0x8 | 0x40, chrom="chr1", pos=1500, mate_chrom="chr1", mate_pos=1500),
+        dict(name="singleton", flag=0x1 | 0x4 | 0x80, chrom="chr1", pos=1500, mate_chrom="chr1", mate_pos=1500),
+        dict(name="secondary", flag=0x100, chrom="chr1", pos=3000, mapq=0),
+        dict(name="supplementary", flag=0x800, chrom="chr2", pos=100, cigar="30M20S"),
+        dict(name="qc_failed", flag=0x200, chrom="chr2", pos=400),
+        dict(name="duplicate", flag=0x400, chrom="chr2", pos=600, mapq=5),
+    ]
+)
+
+## QC-passed counts reported by 'samtools flagstat' for the reads above
+FLAGSTAT = {
+    "total": 11,
+    "primary": 9,
+    "secondary": 1,
+    "supplementary": 1,
+    "mapped": 10,
+    "primary_mapped": 8,
+    "paired": 8,
+    "read1": 4,
+    "read2": 4,
+    "properly_paired": 4,
+    "both_mapped": 6,
+    "singletons": 1,
+    "mate_diff_chr": 2,
+    "mate_diff_chr_mapq5": 2,
+}
+
+
+def read_table(prefix, table):
+    lines = open("{}.bam_qc_{}.tsv".format(prefix, table)).read().splitlines()
+    return dict(zip(lines[0].split("\t"), lines[1].split("\t")))
+
+
+@pytest.mark.parametrize("index,threads", [(True, 1), (True, 2), (False, 1)])
+def test_flag_counts_match_flagstat(make_bam, index, threads):
+    BAMFile = make_bam(READS, index=index)
+    chroms, accumulator = bam_qc.bam_qc(BAMFile, threads=threads)
+    assert chroms == ["chr1", "chr2"]
+    assert dict(zip(bam_qc.FLAG_COUNTS, accumulator.flags[0].tolist())) == FLAGSTAT
+    assert accumulator.flags[1].tolist()[:3] == [1, 1, 0]
+
+
+def test_qc_tables(tmp_path, make_bam):
+    prefix = str(tmp_path / "qc" / "sample")
+    bam_qc.main([make_bam(READS), prefix, "--sample_name", "A", "--max_insert_size", "1000"])
+    stats = read_table(prefix, "stats")
+    assert stats == {
+        "Sample": "A",
+        "Total": "11",
+        "Mapped": "10",
+        "Primary mapped": "8",
+        "Secondary": "1",
+        "Supplementary": "1",
+        "Properly paired": "4",
+        "Singletons": "1",
+        "Mate on different chromosome": "2",
+        "QC failed": "1",
+        "Median MAPQ": "30",
+        "Median insert size": "200",
+        "Inserts above histogram": "1",
+        "Reads in top 1% bins": stats["Reads in top 1% bins"],
+    }
+    ## Mapped alignments per chromosome as for 'samtools idxstats', which includes QC-failed reads
+    assert read_table(prefix, "chroms") == {"Sample": "A", "chr1": "5", "chr2": "6"}
+    assert read_table(prefix, "insert_size") == {"Sample": "A", "200": "1"}
+    ## MAPQ of primary mapped alignments, QC-failed or not
+    mapq = read_table(prefix, "mapq")
+    assert (mapq["5"], mapq["30"]) == ("1", "8")
+
+
+def test_fingerprint_curve():
+    ## Ten bins: six empty, three with one read and one with seven reads
+    ranks, curve = bam_qc.fingerprint_curve([6, 3, 0, 0, 0, 0, 0, 1], numPoints=10)
+    assert ranks.tolist() == pytest.approx([x / 10.0 for x in range(11)])
+    assert curve.tolist() == pytest.approx([0, 0, 0, 0, 0, 0, 0, 0.1, 0.2, 0.3, 1.0])
+
+
+def test_empty_bam(tmp_path, make_bam):
+    prefix = str(tmp_path / "empty")
+    bam_qc.main([make_bam([]), prefix])
+    stats = read_table(prefix, "stats")
+    assert stats["Sample"] == "sample"
+    assert (stats["Total"], stats["Median MAPQ"], stats["Median insert size"]) == ("0", "0", "0")
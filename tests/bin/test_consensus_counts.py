@@ -0,0 +1,98 @@
+import pytest
+
+import consensus_counts
+from conftest import read_pair
+
+## Consensus intervals as written to the SAF file by macs2_merged_expand.py, with the BED start used as the 1-based
+## SAF start. Interval_4 and Interval_5 are close enough for one read to overlap both
+CONSENSUS = [
+    ("chr1", 100, 200, "Interval_1"),
+    ("chr1", 1000, 1100, "Interval_2"),
+    ("chr2", 500, 600, "Interval_3"),
+    ("chr2", 700, 720, "Interval_4"),
+    ("chr2", 730, 800, "Interval_5"),
+]
+
+## 50 bp single-end reads counted as with 'featureCounts -F SAF -O -M --fracOverlap 0.1', so at least 5 aligned
+## bases must fall in the SAF interval [start, end] i.e. 0-based [start - 1, end)
+SE_READS = [
+    dict(name="in_interval_1", flag=0, chrom="chr1", pos=60),
+    dict(name="no_features", flag=0, chrom="chr1", pos=45),
+    dict(name="five_bases_with_saf_start", flag=16, chrom="chr1", pos=54),
+    dict(name="four_bases", flag=0, chrom="chr1", pos=53),
+    dict(name="in_interval_2", flag=0, chrom="chr1", pos=1050),
+    dict(name="in_interval_3", flag=16, chrom="chr2", pos=520),
+    dict(name="in_intervals_4_and_5", flag=0, chrom="chr2", pos=700),
+    dict(name="unmapped", flag=4),
+]
+SE_COUNTS = {"Interval_1": 2, "Interval_2": 1, "Interval_3": 1, "Interval_4": 1, "Interval_5": 1}
+SE_SUMMARY = {"Assigned": 5, "Unassigned_Unmapped": 1, "Unassigned_NoFeatures": 1, "Unassigned_Overlapping_Length": 1}
+
+## Fragments counted as with 'featureCounts -p': mates are counted once as one fragment, a read whose mate is
+## unmapped is counted on its own, and only the first read of a pair with mates on different chromosomes overlaps
+## an interval. The unmapped pair has no coordinates and is one unmapped fragment
+PE_READS = (
+    read_pair("both_mates_in_interval_1", "chr1", 60, 120)
+    + read_pair("one_mate_in_interval_2", "chr1", 1000, 1200)
+    + read_pair("mate_on_chr2", "chr1", 1050, 300, mateChrom="chr2")
+    + [
+        dict(name="mate_unmapped", flag=0x1 | 0x8 | 0x40, chrom="chr2", pos=520),
+        dict(name="unmapped_pair", flag=0x1 | 0x4 | 0x8 | 0x40),
+        dict(name="unmapped_pair", flag=0x1 | 0x4 | 0x8 | 0x80),
+    ]
+)
+PE_COUNTS = {"Interval_1": 1, "Interval_2": 2, "Interval_3": 1, "Interval_4": 0, "Interval_5": 0}
+PE_SUMMARY = {"Assigned": 4, "Unassigned_Unmapped": 1, "Unassigned_NoFeatures": 0, "Unassigned_Overlapping_Length": 0}
+
+
+def run_counts(tmp_path, BamFiles, *args):
+    ConsensusFile = tmp_path / "consensus.bed"
+    ConsensusFile.write_text("".join(["{}\t{}\t{}\t{}\n".format(*x) for x in CONSENSUS]))
+    OutFile = str(tmp_path / "consensus.featureCounts.txt")
+    consensus_counts.main([str(ConsensusFile), ",".join(BamFiles), OutFile] + list(args))
+    lines = [x.split("\t") for x in open(OutFile).read().splitlines()]
+    summary = [x.split("\t") for x in open(OutFile + ".summary").read().splitlines()[1:]]
+    summary = dict([(x[0], [int(y) for y in x[1:]]) for x in summary])
+    return lines, summary
+
+
+def test_featurecounts_layout(tmp_path, make_bam):
+    lines, summary = run_counts(tmp_path, [make_bam(SE_READS)])
+    assert lines[0][0].startswith("# Program:consensus_counts.py")
+    assert lines[1][:6] == ["Geneid", "Chr", "Start", "End", "Strand", "Length"]
+    assert [x[:6] for x in lines[2:]] == [
+        ["Interval_1", "chr1", "100", "200", "+", "101"],
+        ["Interval_2", "chr1", "1000", "1100", "+", "101"],
+        ["Interval_3", "chr2", "500", "600", "+", "101"],
+        ["Interval_4", "chr2", "700", "720", "+", "21"],
+        ["Interval_5", "chr2", "730", "800", "+", "71"],
+    ]
+    assert list(summary) == consensus_counts.SUMMARY_STATUS
+
+
+@pytest.mark.parametrize("threads", ["1", "2"])
+def test_single_and_paired_end_counts(tmp_path, make_bam, threads):
+    BamFiles = [make_bam(SE_READS, name="se.bam"), make_bam(PE_READS, name="pe.bam")]
+    for pairedEnd, BamFile, expected, expectedSummary in [
+        (False, BamFiles[0], SE_COUNTS, SE_SUMMARY),
+        (True, BamFiles[1], PE_COUNTS, PE_SUMMARY),
+    ]:
+        args = ["--threads", threads] + (["--paired_end"] if pairedEnd else [])
+        lines, summary = run_counts(tmp_path, [BamFile], *args)
+        assert dict([(x[0], int(x[6])) for x in lines[2:]]) == expected
+        for status in consensus_counts.SUMMARY_STATUS:
+            assert summary[status] == [expectedSummary.get(status, 0)], status
+
+
+def test_counts_of_several_bam_files_with_and_without_index(tmp_path, make_bam):
+    BamFiles = [make_bam(SE_READS, name="indexed.bam"), make_bam(SE_READS, name="streamed.bam", index=False)]
+    lines, summary = run_counts(tmp_path, BamFiles, "--threads", "2")
+    assert lines[1][6:] == BamFiles
+    assert [x[6:] for x in lines[2:]] == [[str(SE_COUNTS[x[0]])] * 2 for x in lines[2:]]
+    assert summary["Assigned"] == [SE_SUMMARY["Assigned"]] * 2
+
+
+def test_without_saf_start_offset(tmp_path, make_bam):
+    lines, summary = run_counts(tmp_path, [make_bam(SE_READS)], "--start_offset", "0")
+    assert lines[2][:7] == ["Interval_1", "chr1", "101", "200", "+", "100", "1"]
+    assert summary["Unassigned_Overlapping_Length"] == [2]
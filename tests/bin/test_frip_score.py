@@ -0,0 +1,73 @@
+import pytest
+
+import frip_score
+
+## Reads against a peak at chr1:1000-1100 and two overlapping peaks on chr2. With 'intersectBed -f 0.2 -c' a 50 bp
+## read needs 10 bp inside a peak, and a read inside two peaks is counted twice; 'samtools flagstat' reports the
+## five mapped reads
+READS = [
+    dict(name="full", flag=0, chrom="chr1", pos=1000),
+    dict(name="min_overlap", flag=16, chrom="chr1", pos=1090),
+    dict(name="below_overlap", flag=0, chrom="chr1", pos=1091),
+    dict(name="outside", flag=0, chrom="chr1", pos=2000),
+    dict(name="two_peaks", flag=0, chrom="chr2", pos=100),
+    dict(name="unmapped", flag=4),
+]
+PEAKS = "chr1\t1000\t1100\tpeak_1\nchr2\t100\t120\tpeak_2\nchr2\t110\t200\tpeak_3\n"
+
+
+def run_frip(tmp_path, BAMFile, peaks, *args):
+    PeakFiles = []
+    for idx, text in enumerate(peaks):
+        PeakFile = tmp_path / "peaks_{}.bed".format(idx)
+        PeakFile.write_text(text)
+        PeakFiles.append(str(PeakFile))
+    OutFile = tmp_path / "frip.txt"
+    frip_score.main([BAMFile, ",".join(PeakFiles), str(OutFile)] + list(args))
+    return [x.split("\t") for x in OutFile.read_text().splitlines()]
+
+
+def test_frip_matches_intersectbed_and_flagstat(tmp_path, make_bam):
+    BAMFile = make_bam(READS)
+    assert run_frip(tmp_path, BAMFile, [PEAKS], "--peak_names", "A") == [["A", "0.8"]]
+
+
+@pytest.mark.parametrize("args", [[], ["--threads", "2"]])
+def test_frip_is_the_same_with_and_without_index(tmp_path, make_bam, args):
+    indexed = run_frip(tmp_path, make_bam(READS, name="indexed.bam"), [PEAKS], *args)
+    streamed = run_frip(tmp_path, make_bam(READS, name="streamed.bam", index=False), [PEAKS], *args)
+    assert indexed == streamed == [["peaks_0.bed", "0.8"]]
+
+
+def test_frip_of_each_peak_file(tmp_path, make_bam):
+    BAMFile = make_bam(READS)
+    frip = run_frip(tmp_path, BAMFile, [PEAKS, "chr1\t1000\t1100\n"], "--peak_names", "A,B")
+    assert frip == [["A", "0.8"], ["B", "0.4"]]
+
+
+def test_frip_of_empty_peak_file_is_zero(tmp_path, make_bam):
+    BAMFile = make_bam(READS)
+    assert run_frip(tmp_path, BAMFile, [""], "--peak_names", "A") == [["A", "0"]]
+
+
+def test_frip_of_bam_without_mapped_reads_is_zero(tmp_path, make_bam):
+    BAMFile = make_bam([dict(name="unmapped", flag=4)])
+    assert run_frip(tmp_path, BAMFile, [PEAKS], "--peak_names", "A") == [["A", "0"]]
+
+
+def test_frip_peak_names_must_match_peak_files(tmp_path, make_bam):
+    with pytest.raises(SystemExit):
+        run_frip(tmp_path, make_bam(READS), [PEAKS], "--peak_names", "A,B")
+
+
+def test_frip_cache_is_keyed_on_bam_identity(tmp_path, make_bam, capsys):
+    CacheDir = str(tmp_path / "cache")
+    BAMFile = make_bam(READS)
+    assert run_frip(tmp_path, BAMFile, [PEAKS], "--cache_dir", CacheDir) == [["peaks_0.bed", "0.8"]]
+    assert run_frip(tmp_path, BAMFile, [PEAKS], "--cache_dir", CacheDir) == [["peaks_0.bed", "0.8"]]
+    assert "Restored" in capsys.readouterr().out
+
+    ## Same path and index layout but different reads
+    BAMFile = make_bam(READS[:1] + READS[3:])
+    assert run_frip(tmp_path, BAMFile, [PEAKS], "--cache_dir", CacheDir) == [["peaks_0.bed", "1"]]
+    assert "Restored" not in capsys.readouterr().out
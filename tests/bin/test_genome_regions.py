@@ -0,0 +1,40 @@
+import genome_regions
+
+SIZES = "chr1\t1000\nchr2\t500\nchr3\t300\nchrM\t16\n"
+
+## Unsorted blacklist with overlapping and book-ended regions, a region past the end of chr1 and a whole chromosome
+BLACKLIST = "chr1\t900\t1200\nchr2\t0\t500\nchr1\t150\t300\nchr1\t100\t200\nchr1\t300\t310\n"
+
+## 'sortBed -i BLACKLIST -g SIZES | complementBed -i stdin -g SIZES'
+COMPLEMENT_BED = "chr1\t0\t100\nchr1\t310\t900\nchr3\t0\t300\nchrM\t0\t16\n"
+
+
+def run_regions(tmp_path, *args):
+    SizesFile = tmp_path / "genome.fa.sizes"
+    SizesFile.write_text(SIZES)
+    OutFile = tmp_path / "out" / "genome.include_regions.bed"
+    genome_regions.main([str(SizesFile), str(OutFile)] + list(args))
+    return OutFile.read_text()
+
+
+def test_blacklist_complement_matches_complementbed(tmp_path):
+    BlacklistFile = tmp_path / "blacklist.bed"
+    BlacklistFile.write_text(BLACKLIST)
+    assert run_regions(tmp_path, "--blacklist", str(BlacklistFile)) == COMPLEMENT_BED
+
+
+def test_whole_chromosomes_without_blacklist(tmp_path):
+    assert run_regions(tmp_path) == "chr1\t0\t1000\nchr2\t0\t500\nchr3\t0\t300\nchrM\t0\t16\n"
+
+
+def test_cached_regions_are_restored(tmp_path, capsys):
+    BlacklistFile = tmp_path / "blacklist.bed"
+    BlacklistFile.write_text(BLACKLIST)
+    args = ["--blacklist", str(BlacklistFile), "--cache_dir", str(tmp_path / "cache")]
+    assert run_regions(tmp_path, *args) == COMPLEMENT_BED
+    assert "Restored" not in capsys.readouterr().out
+    assert run_regions(tmp_path, *args) == COMPLEMENT_BED
+    assert "Restored" in capsys.readouterr().out
+
+    BlacklistFile.write_text("chr3\t10\t20\n")
+    assert run_regions(tmp_path, *args) == "chr1\t0\t1000\nchr2\t0\t500\nchr3\t0\t10\nchr3\t20\t300\nchrM\t0\t16\n"
@@ -0,0 +1,95 @@
+import gzip
+
+import pytest
+
+import gtf2bed
+
+## Two coding transcripts on either strand, with unsorted exons and start and stop codons, a non-coding transcript,
+## a miRNA and lines without a transcript_id
+GTF = (
+    "#!genome-build test\n"
+    'chr1\ttest\tgene\t100\t900\t.\t+\t.\tgene_id "g1"; gene_name "GENE1";\n'
+    'chr1\ttest\texon\t100\t200\t.\t+\t.\tgene_id "g1"; transcript_id "tx1"; gene_name "GENE1";\n'
+    'chr1\ttest\texon\t400\t900\t.\t+\t.\tgene_id "g1"; transcript_id "tx1"; gene_name "GENE1";\n'
+    'chr1\ttest\tstart_codon\t150\t152\t.\t+\t0\tgene_id "g1"; transcript_id "tx1"; gene_name "GENE1";\n'
+    'chr1\ttest\tstop_codon\t600\t602\t.\t+\t0\tgene_id "g1"; transcript_id "tx1"; gene_name "GENE1";\n'
+    'chr1\ttest\texon\t3000\t3100\t.\t-\t.\tgene_id "g2"; transcript_id "tx2";\n'
+    'chr1\ttest\texon\t2000\t2100\t.\t-\t.\tgene_id "g2"; transcript_id "tx2";\n'
+    'chr1\ttest\texon\t2500\t2600\t.\t-\t.\tgene_id "g2"; transcript_id "tx2";\n'
+    'chr1\ttest\tstart_codon\t3050\t3052\t.\t-\t0\tgene_id "g2"; transcript_id "tx2";\n'
+    'chr1\ttest\tstop_codon\t2050\t2052\t.\t-\t0\tgene_id "g2"; transcript_id "tx2";\n'
+    'chr2\ttest\texon\t10\t500\t.\t+\t.\tgene_id "g3"; transcript_id "tx3"; gene_name "GENE3";\n'
+    'chr10\ttest\tmiRNA\t50\t70\t.\t-\t.\tgene_id "g4"; transcript_id "mir4"; gene_name "MIR4";\n'
+)
+
+## GFF3 exons named '<transcript>:<exon number>', a transcript without codons on the minus strand and an exon without
+## a Name, which the Perl script skipped
+GFF3 = (
+    "##gff-version 3\n"
+    "##sequence-region chr1 1 5000\n"
+    "chr1\ttest\tgene\t100\t900\t.\t+\t.\tID=g1;Name=GENE1\n"
+    "chr1\ttest\tmRNA\t100\t900\t.\t+\t.\tID=tx1;Parent=g1;Name=tx1\n"
+    "chr1\ttest\texon\t400\t900\t.\t+\t.\tID=e2;Name=tx1:2;Parent=tx1\n"
+    "chr1\ttest\texon\t100\t200\t.\t+\t.\tID=e1;Name=tx1:1;Parent=tx1\n"
+    "chr2\ttest\texon\t1000\t1200\t.\t-\t.\tID=e3;Name=tx2;Parent=tx2\n"
+    "chr1\ttest\texon\t50\t60\t.\t+\t.\tID=e4;Parent=tx9\n"
+)
+
+## Output of the gtf2bed Perl script previously bundled with the pipeline, without and with -x. The GFF3 file has no
+## gene_name or gene_id attributes, so -x appends an empty column
+PERL_GTF2BED = {
+    ("gtf", False): (
+        "chr1\t99\t900\ttx1\t0\t+\t149\t602\t0\t2\t101,501,\t0,300,\n"
+        "chr1\t1999\t3100\ttx2\t0\t-\t2049\t3052\t0\t3\t101,101,101,\t0,500,1000,\n"
+        "chr10\t49\t70\tmir4\t0\t-\t49\t70\t0\t1\t21,\t0,\n"
+        "chr2\t9\t500\ttx3\t0\t+\t9\t500\t0\t1\t491,\t0,\n"
+    ),
+    ("gtf", True): (
+        "chr1\t99\t900\ttx1\t0\t+\t149\t602\t0\t2\t101,501,\t0,300,\tGENE1\n"
+        "chr1\t1999\t3100\ttx2\t0\t-\t2049\t3052\t0\t3\t101,101,101,\t0,500,1000,\tg2\n"
+        "chr10\t49\t70\tmir4\t0\t-\t49\t70\t0\t1\t21,\t0,\tMIR4\n"
+        "chr2\t9\t500\ttx3\t0\t+\t9\t500\t0\t1\t491,\t0,\tGENE3\n"
+    ),
+    ("gff3", False): (
+        "chr1\t99\t900\ttx1\t0\t+\t99\t900\t0\t2\t101,501,\t0,300,\n"
+        "chr2\t999\t1200\ttx2\t0\t-\t999\t1200\t0\t1\t201,\t0,\n"
+    ),
+    ("gff3", True): (
+        "chr1\t99\t900\ttx1\t0\t+\t99\t900\t0\t2\t101,501,\t0,300,\t\n"
+        "chr2\t999\t1200\ttx2\t0\t-\t999\t1200\t0\t1\t201,\t0,\t\n"
+    ),
+}
+
+
+def write_annotation(tmp_path, annotation, compress=False):
+    text = GTF if annotation == "gtf" else GFF3
+    if compress:
+        AnnotationFile = tmp_path / "genes.{}.gz".format(annotation)
+        with gzip.open(str(AnnotationFile), "wt") as fout:
+            fout.write(text)
+    else:
+        AnnotationFile = tmp_path / "genes.{}".format(annotation)
+        AnnotationFile.write_text(text)
+    return str(AnnotationFile)
+
+
+@pytest.mark.parametrize("annotation", ["gtf", "gff3"])
+@pytest.mark.parametrize("extended", [False, True])
+def test_output_matches_perl_gtf2bed(tmp_path, annotation, extended):
+    OutFile = tmp_path / "genes.bed"
+    gtf2bed.main([write_annotation(tmp_path, annotation), str(OutFile)] + (["-x"] if extended else []))
+    assert OutFile.read_text() == PERL_GTF2BED[(annotation, extended)]
+
+
+def test_gzipped_annotation(tmp_path):
+    OutFile = tmp_path / "genes.bed"
+    gtf2bed.main([write_annotation(tmp_path, "gtf", compress=True), str(OutFile), "-x"])
+    assert OutFile.read_text() == PERL_GTF2BED[("gtf", True)]
+
+
+@pytest.mark.parametrize("annotation", ["gtf", "gff3"])
+def test_output_does_not_depend_on_blocks_or_threads(tmp_path, annotation):
+    ## Blocks of about 100 bytes split the exons of a transcript, and the gff-version line, across workers
+    OutFile = tmp_path / "genes.bed"
+    gtf2bed.gtf2bed(write_annotation(tmp_path, annotation), str(OutFile), extended=True, threads=2, blockSize=100)
+    assert OutFile.read_text() == PERL_GTF2BED[(annotation, True)]
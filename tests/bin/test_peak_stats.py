@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+import peak_stats
+
+
+def peak_lines(numPeaks, seed=1, broad=False):
+    """MACS2 narrowPeak lines, or broadPeak lines without the summit column, with random values."""
+    rng = np.random.RandomState(seed)
+    lines = []
+    for idx in range(numPeaks):
+        start = int(rng.randint(0, 100000))
+        fields = [
+            "chr1",
+            str(start),
+            str(start + int(rng.randint(100, 5000))),
+            "peak_{}".format(idx + 1),
+            str(int(rng.randint(10, 1000))),
+            ".",
+            "%.5f" % rng.uniform(1, 50),
+            "%.5f" % rng.uniform(2, 80),
+            "%.5f" % rng.uniform(1, 75),
+        ]
+        lines.append("\t".join(fields + ([] if broad else [str(int(rng.randint(0, 100)))])) + "\n")
+    return lines
+
+
+def read_rows(FileName):
+    return [x.split("\t") for x in open(FileName).read().splitlines()]
+
+
+def run_peak_stats(tmp_path, peakFiles, *args):
+    PeakFiles = []
+    for idx, lines in enumerate(peakFiles):
+        PeakFile = tmp_path / "sample_{}_peaks.narrowPeak".format(idx)
+        PeakFile.write_text("".join(lines))
+        PeakFiles.append(str(PeakFile))
+    SampleIds = ["S{}".format(x) for x in range(len(peakFiles))]
+    prefix = str(tmp_path / "qc" / "peaks")
+    peak_stats.main([",".join(PeakFiles), ",".join(SampleIds), prefix] + list(args))
+    return prefix
+
+
+@pytest.mark.parametrize("broad", [False, True])
+def test_summary_matches_r_summary(tmp_path, broad):
+    lines = peak_lines(500, broad=broad)
+    prefix = run_peak_stats(tmp_path, [lines])
+    rows = read_rows(prefix + ".summary.txt")
+    assert rows[0] == peak_stats.SUMMARY_COLUMNS
+
+    fields = [x.rstrip("\n").split("\t") for x in lines]
+    expected = {
+        "fold": np.array([float(x[6]) for x in fields]),
+        "-log10(qvalue)": np.array([float(x[8]) for x in fields]),
+        "-log10(pvalue)": np.array([float(x[7]) for x in fields]),
+        "length": np.array([int(x[2]) - int(x[1]) for x in fields], dtype=float),
+    }
+    assert [x[7] for x in rows[1:]] == [x[0] for x in peak_stats.MEASURES]
+    for row in rows[1:]:
+        values = expected[row[7]]
+        ## R's summary() uses quantile type 7, which is NumPy's default linear interpolation
+        quartiles = np.percentile(values, [25, 50, 75])
+        assert float(row[0]) == values.min()
+        assert float(row[5]) == values.max()
+        assert float(row[3]) == pytest.approx(values.mean(), rel=1e-12)
+        assert [float(x) for x in (row[1], row[2], row[4])] == pytest.approx(quartiles.tolist(), rel=2e-3)
+        assert row[6:] == ["500", row[7], "S0"]
+
+
+def test_empty_peak_file(tmp_path):
+    prefix = run_peak_stats(tmp_path, [peak_lines(20), []])
+    rows = read_rows(prefix + ".summary.txt")
+    assert [x[:7] for x in rows[1:] if x[8] == "S1"] == [["NA"] * 6 + ["0"]] * len(peak_stats.MEASURES)
+    assert read_rows(prefix + ".peak_count.tsv") == [["S0", "20"], ["S1", "0"]]
+    for name, measure in peak_stats.MQC_MEASURES:
+        rows = read_rows("{}.peak_{}.tsv".format(prefix, name))
+        assert [x[0] for x in rows] == ["Sample", "S0", "S1"]
+        assert set(rows[2][1:]) == {"0.000"}
+        assert sum([float(x) for x in rows[1][1:]]) == pytest.approx(100.0, abs=0.1)
+    histogram = read_rows(prefix + ".histogram.txt")
+    assert sum([int(x[5]) for x in histogram[1:] if x[0] == "S1"]) == 0
+    assert sum([int(x[5]) for x in histogram[1:] if x[0] == "S0"]) == 20 * len(peak_stats.MEASURES)
+
+
+def test_output_does_not_depend_on_threads(tmp_path):
+    outputs = []
+    for threads in ["1", "3"]:
+        prefix = run_peak_stats(tmp_path, [peak_lines(200, seed=x) for x in range(3)], "--threads", threads)
+        outputs.append([open(prefix + x).read() for x in [".summary.txt", ".histogram.txt", ".peak_length.tsv"]])
+    assert outputs[0] == outputs[1]
+
+
+def test_sample_ids_must_be_unique(tmp_path):
+    PeakFile = tmp_path / "peaks.narrowPeak"
+    PeakFile.write_text("".join(peak_lines(5)))
+    with pytest.raises(SystemExit):
+        peak_stats.main([",".join([str(PeakFile)] * 2), "S0,S0", str(tmp_path / "peaks")])
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+import strand_cross_correlation
+
+CHROMS = (("chr1", 20000), ("chr2", 8000))
+FRAGMENT_LENGTH = 200
+
+
+def fragment_reads(seed=1, numFragments=300):
+    """50 bp reads from both ends of fragments of FRAGMENT_LENGTH bp at random positions on both chromosomes."""
+    rng = np.random.RandomState(seed)
+    reads = []
+    for idx in range(numFragments):
+        chrom, length = CHROMS[idx % 2]
+        start = int(rng.randint(0, length - FRAGMENT_LENGTH))
+        if idx % 3:
+            reads.append(dict(name="f{}".format(idx), flag=0, chrom=chrom, pos=start))
+        if idx % 5:
+            reads.append(dict(name="r{}".format(idx), flag=16, chrom=chrom, pos=start + FRAGMENT_LENGTH - 50))
+    return reads
+
+
+def pearson_by_lag(plusEnds, minusEnds, chromLength, binSize, minLag, maxLag):
+    """Direct Pearson correlation of the binned strands at every lag, with zero counts beyond the chromosome."""
+    numBins = chromLength // binSize + 1
+    plus = np.bincount(plusEnds // binSize, minlength=numBins).astype(float)
+    minus = np.bincount(minusEnds // binSize, minlength=numBins).astype(float)
+    padded = np.concatenate([np.zeros(max(-minLag, 0)), minus, np.zeros(max(maxLag, 0))])
+    correlation = []
+    for lag in range(minLag, maxLag + 1):
+        shifted = padded[lag + max(-minLag, 0) : lag + max(-minLag, 0) + numBins]
+        correlation.append(
+            (np.dot(plus, shifted) / numBins - plus.mean() * minus.mean()) / np.sqrt(plus.var() * minus.var())
+        )
+    return np.array(correlation)
+
+
+@pytest.mark.parametrize("blockBins", [7, 1 << 18])
+def test_fft_correlation_matches_direct_pearson(monkeypatch, blockBins):
+    monkeypatch.setattr(strand_cross_correlation, "FFT_BLOCK_BINS", blockBins)
+    rng = np.random.RandomState(2)
+    plusEnds = rng.randint(0, 5000, 400)
+    minusEnds = np.clip(plusEnds + 150 + rng.randint(-20, 20, 400), 0, 4999)
+    expected = pearson_by_lag(plusEnds, minusEnds, 5000, 5, -100, 300)
+    correlation = strand_cross_correlation.chromosome_correlation(plusEnds, minusEnds, 5000, 5, -100, 300)
+    np.testing.assert_allclose(correlation, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_correlation_needs_tags_on_both_strands():
+    assert (
+        strand_cross_correlation.chromosome_correlation(np.array([10]), np.array([], dtype=int), 100, 5, 0, 10) is None
+    )
+
+
+@pytest.mark.parametrize("rsc,tag", [(0.1, -2), (0.25, -1), (0.5, 0), (1.0, 1), (1.49, 1), (1.5, 2)])
+def test_quality_tag_thresholds_of_run_spp(rsc, tag):
+    assert strand_cross_correlation.quality_tag(rsc) == tag
+
+
+def test_spp_out_finds_fragment_length(tmp_path, make_bam):
+    BAMFile = make_bam(fragment_reads(), chroms=CHROMS)
+    OutFile = tmp_path / "sample.spp.out"
+    strand_cross_correlation.main(
+        [BAMFile, str(OutFile), "--mqc_prefix", str(tmp_path / "mqc" / "sample"), "--sample_name", "sample"]
+    )
+    fields = OutFile.read_text().rstrip("\n").split("\t")
+    assert len(fields) == 11
+    assert fields[0] == "sample.bam"
+    assert int(fields[1]) == len(fragment_reads())
+    assert abs(int(fields[2].split(",")[0]) - FRAGMENT_LENGTH) <= 5
+    assert 40 <= int(fields[4]) <= 57
+    ## NSC and RSC as defined by run_spp.R from the top fragment length, phantom peak and minimum correlations
+    peakCorr, phantomCorr, minCorr = float(fields[3].split(",")[0]), float(fields[5]), float(fields[7])
+    assert float(fields[8]) == pytest.approx(peakCorr / minCorr, rel=1e-5)
+    assert float(fields[9]) == pytest.approx((peakCorr - minCorr) / (phantomCorr - minCorr), rel=1e-5)
+    assert int(fields[10]) == strand_cross_correlation.quality_tag(float(fields[9]))
+
+    correlation = (tmp_path / "mqc" / "sample.spp_correlation_mqc.tsv").read_text().splitlines()
+    assert [int(x.split(",")[0]) for x in correlation] == list(range(-500, 1505, 5))
+    assert (tmp_path / "mqc" / "sample.spp_nsc_mqc.tsv").read_text() == "sample\t{}\n".format(fields[8])
+    assert (tmp_path / "mqc" / "sample.spp_rsc_mqc.tsv").read_text() == "sample\t{}\n".format(fields[9])
+
+
+@pytest.mark.parametrize("index,threads", [(True, "2"), (False, "1")])
+def test_spp_out_is_the_same_with_and_without_index(tmp_path, make_bam, index, threads):
+    outputs = []
+    for name, hasIndex, numThreads in [("single.bam", True, "1"), ("other.bam", index, threads)]:
+        BAMFile = make_bam(fragment_reads(), chroms=CHROMS, name=name, index=hasIndex)
+        OutFile = tmp_path / (name + ".spp.out")
+        strand_cross_correlation.main([BAMFile, str(OutFile), "--threads", numThreads])
+        outputs.append(OutFile.read_text().split("\t", 1)[1])
+    assert outputs[0] == outputs[1]
+
+
+def test_bam_without_reads_on_both_strands_is_an_error(tmp_path, make_bam):
+    BAMFile = make_bam([dict(name="r{}".format(x), flag=0, chrom="chr1", pos=100 * x) for x in range(10)])
+    with pytest.raises(SystemExit):
+        strand_cross_correlation.main([BAMFile, str(tmp_path / "sample.spp.out")])
@@ -42,11 +42,14 @@ ch_multiqc_config        = file("$projectDir/assets/multiqc_config.yml", checkIf
 ch_multiqc_custom_config = params.multiqc_config ? Channel.fromPath(params.multiqc_config) : Channel.empty()
 
 // Header files for MultiQC
+ch_bam_filter_header        = file("$projectDir/assets/multiqc/bam_filter_header.txt", checkIfExists: true)
 ch_spp_nsc_header           = file("$projectDir/assets/multiqc/spp_nsc_header.txt", checkIfExists: true)
 ch_spp_rsc_header           = file("$projectDir/assets/multiqc/spp_rsc_header.txt", checkIfExists: true)
 ch_spp_correlation_header   = file("$projectDir/assets/multiqc/spp_correlation_header.txt", checkIfExists: true)
-ch_peak_count_header        = file("$projectDir/assets/multiqc/peak_count_header.txt", checkIfExists: true)
+ch_peak_stats_headers       = file("$projectDir/assets/multiqc/peak_{count,length,fold,qvalue}_header.txt", checkIfExists: true)
 ch_frip_score_header        = file("$projectDir/assets/multiqc/frip_score_header.txt", checkIfExists: true)
+ch_bam_qc_headers           = file("$projectDir/assets/multiqc/bam_qc_*_header.txt", checkIfExists: true)
+ch_perf_stats_headers       = file("$projectDir/assets/multiqc/perf_stats_*_header.txt", checkIfExists: true)
 ch_peak_annotation_header   = file("$projectDir/assets/multiqc/peak_annotation_header.txt", checkIfExists: true)
 ch_deseq2_pca_header        = file("$projectDir/assets/multiqc/deseq2_pca_header.txt", checkIfExists: true)
 ch_deseq2_clustering_header = file("$projectDir/assets/multiqc/deseq2_clustering_header.txt", checkIfExists: true)
@@ -62,18 +65,23 @@ ch_with_inputs = params.with_inputs ? params.with_inputs.toBoolean() : false
 
 
 include { FRIP_SCORE                          } from '../modules/local/frip_score'
+include { PEAK_STATS                          } from '../modules/local/peak_stats'
 include { PLOT_MACS2_QC                       } from '../modules/local/plot_macs2_qc'
 include { PLOT_HOMER_ANNOTATEPEAKS            } from '../modules/local/plot_homer_annotatepeaks'
 include { MACS2_CONSENSUS                     } from '../modules/local/macs2_consensus'
+include { MACS2_CONSENSUS_BATCH               } from '../modules/local/macs2_consensus_batch'
 include { ANNOTATE_BOOLEAN_PEAKS              } from '../modules/local/annotate_boolean_peaks'
+include { CONSENSUS_COUNTS                    } from '../modules/local/consensus_counts'
 // include { COUNT_NORM                          } from '../modules/local/count_normalization'  // Module not found
 include { NORMALIZE_DESEQ2_QC_INVARIANT_GENES } from '../modules/local/normalize_deseq2_qc_invariant_genes'
 include { NORMALIZE_DESEQ2_QC_ALL_GENES       } from '../modules/local/normalize_deseq2_qc_all_genes'
 include { DESEQ2_SECTION_HEADER               } from '../modules/local/deseq2_section_header'
 include { DESEQ2_TRANSFORM                    } from '../modules/local/deseq2_transform'
 include { MULTIQC                             } from '../modules/local/multiqc'
-include { MULTIQC_CUSTOM_PHANTOMPEAKQUALTOOLS } from '../modules/local/multiqc_custom_phantompeakqualtools'
+include { STRAND_CROSS_CORRELATION            } from '../modules/local/strand_cross_correlation'
+include { BAM_QC                              } from '../modules/local/bam_qc'
 include { MULTIQC_CUSTOM_PEAKS                } from '../modules/local/multiqc_custom_peaks'
+include { MULTIQC_CUSTOM_PERF_STATS           } from '../modules/local/multiqc_custom_perf_stats'
 
 //
 // SUBWORKFLOW: Consisting of a mix of local and nf-core/modules
@@ -94,11 +102,7 @@ include { BAM_FILTER as BAM_FILTER_SUBWF } from '../subworkflows/local/bam_filte
 
 include { PICARD_MERGESAMFILES          } from '../modules/nf-core/modules/picard/mergesamfiles/main'
 include { PICARD_COLLECTMULTIPLEMETRICS } from '../modules/nf-core/modules/picard/collectmultiplemetrics/main'
-include { PHANTOMPEAKQUALTOOLS          } from '../modules/nf-core/modules/phantompeakqualtools/main'
 include { DEEPTOOLS_BIGWIG              } from '../modules/local/deeptools_bw'
-include { DEEPTOOLS_BIGWIG_NORM         } from '../modules/local/deeptools_bw_norm'
-include { DEEPTOOLS_BIGWIG_NORM as DEEPTOOLS_BIGWIG_NORM_INVARIANT } from '../modules/local/deeptools_bw_norm'
-include { DEEPTOOLS_BIGWIG_NORM as DEEPTOOLS_BIGWIG_NORM_ALL_GENES } from '../modules/local/deeptools_bw_norm'
 include { DEEPTOOLS_COMPUTEMATRIX       } from '../modules/nf-core/modules/deeptools/computematrix/main'
 include { DEEPTOOLS_PLOTPROFILE         } from '../modules/nf-core/modules/deeptools/plotprofile/main'
 include { DEEPTOOLS_PLOTHEATMAP         } from '../modules/nf-core/modules/deeptools/plotheatmap/main'
@@ -106,7 +110,6 @@ include { DEEPTOOLS_PLOTFINGERPRINT     } from '../modules/nf-core/modules/deept
 include { KHMER_UNIQUEKMERS             } from '../modules/nf-core/modules/khmer/uniquekmers/main'
 include { MACS2_CALLPEAK as MACS2_CALLPEAK_SINGLE          } from '../modules/nf-core/modules/macs2/callpeak/main'
 include { MACS2_CALLPEAK as MACS2_CALLPEAK_MERGED          } from '../modules/nf-core/modules/macs2/callpeak/main'
-include { SUBREAD_FEATURECOUNTS         } from '../modules/nf-core/modules/subread/featurecounts/main'
 include { CUSTOM_DUMPSOFTWAREVERSIONS   } from '../modules/nf-core/modules/custom/dumpsoftwareversions/main'
 
 include { HOMER_ANNOTATEPEAKS as HOMER_ANNOTATEPEAKS_MACS2     } from '../modules/nf-core/modules/homer/annotatepeaks/main'
@@ -171,6 +174,9 @@ workflow CHIPSEQ {
     )
     ch_versions = ch_versions.mix(INPUT_CHECK.out.versions)
 
+    // Per-task timings of the Python helper scripts, written with --helper_perf_stats
+    ch_perf_stats = INPUT_CHECK.out.perf
+
     // Set the reads channel from INPUT_CHECK output
     INPUT_CHECK.out.reads
         .set { ch_reads }
@@ -286,7 +292,8 @@ workflow CHIPSEQ {
     
     BAM_FILTER_SUBWF (
         MARK_DUPLICATES_PICARD.out.bam.join(MARK_DUPLICATES_PICARD.out.bai, by: [0]),
-        PREPARE_GENOME.out.filtered_bed.first()
+        PREPARE_GENOME.out.filtered_bed.first(),
+        ch_bam_filter_header
     )
     ch_versions = ch_versions.mix(BAM_FILTER_SUBWF.out.versions.first().ifEmpty(null))
 
@@ -305,22 +312,15 @@ workflow CHIPSEQ {
     }
 
     //
-    // MODULE: Phantompeaktools strand cross-correlation and QC metrics
-    //
-    PHANTOMPEAKQUALTOOLS (
-        BAM_FILTER_SUBWF.out.bam
-    )
-    ch_versions = ch_versions.mix(PHANTOMPEAKQUALTOOLS.out.versions.first())
-
-    //
-    // MODULE: MultiQC custom content for Phantompeaktools
+    // MODULE: Strand cross-correlation QC metrics and MultiQC custom content
     //
-    MULTIQC_CUSTOM_PHANTOMPEAKQUALTOOLS (
-        PHANTOMPEAKQUALTOOLS.out.spp.join(PHANTOMPEAKQUALTOOLS.out.rdata, by: [0]),
+    STRAND_CROSS_CORRELATION (
+        BAM_FILTER_SUBWF.out.bam.join(BAM_FILTER_SUBWF.out.bai, by: [0]),
         ch_spp_nsc_header,
         ch_spp_rsc_header,
         ch_spp_correlation_header
     )
+    ch_versions = ch_versions.mix(STRAND_CROSS_CORRELATION.out.versions.first())
 
 
     //
@@ -345,6 +345,19 @@ workflow CHIPSEQ {
         ch_deeptoolsplotfingerprint_multiqc = DEEPTOOLS_PLOTFINGERPRINT.out.matrix
         ch_versions = ch_versions.mix(DEEPTOOLS_PLOTFINGERPRINT.out.versions.first())
     }
+
+    //
+    // MODULE: Flag counts, per-chromosome counts, MAPQ, insert size and fingerprint in one pass over each BAM
+    //
+    ch_bam_qc_multiqc = Channel.empty()
+    if (!params.skip_bam_qc) {
+        BAM_QC (
+            ch_genome_bam_bai,
+            ch_bam_qc_headers
+        )
+        ch_bam_qc_multiqc = BAM_QC.out.mqc
+        ch_versions = ch_versions.mix(BAM_QC.out.versions.first())
+    }
     
     if(!ch_with_inputs){
 
@@ -552,43 +565,43 @@ workflow CHIPSEQ {
         ch_macs_gsize
     )
 
-    // Create channels: [ meta, ip_bam, peaks ]
-    ch_ip_control_bam
+    // Create channels: [ meta, ip_bam, ip_bai, peaks ]
+    ch_genome_bam_bai
         .join(ch_macs2_peaks, by: [0])
-        .map { 
-            it -> 
-                [ it[0], it[1], it[3] ] 
-        }
-        .set { ch_ip_bam_peaks }
-
+        .set { ch_ip_bam_bai_peaks }
 
     //
     // MODULE: Calculate FRiP score
     //
     FRIP_SCORE (
-        ch_ip_bam_peaks
+        ch_ip_bam_bai_peaks
     )
     ch_versions = ch_versions.mix(FRIP_SCORE.out.versions.first())
 
-    // Create channels: [ meta, peaks, frip ]
-    ch_ip_bam_peaks
-        .join(FRIP_SCORE.out.txt, by: [0])
-        .map { 
-            it -> 
-                [ it[0], it[2], it[3] ] 
-        }
-        .set { ch_ip_peaks_frip }
-
     //
     // MODULE: FRiP score custom content for MultiQC
     //
     MULTIQC_CUSTOM_PEAKS (
-        ch_ip_peaks_frip,
-        ch_peak_count_header,
+        FRIP_SCORE.out.txt,
         ch_frip_score_header
     )
-    ch_custompeaks_frip_multiqc  = MULTIQC_CUSTOM_PEAKS.out.frip
-    ch_custompeaks_count_multiqc = MULTIQC_CUSTOM_PEAKS.out.count
+    ch_custompeaks_frip_multiqc = MULTIQC_CUSTOM_PEAKS.out.frip
+
+    //
+    // MODULE: Stream the peaks of each antibody into counts, summaries and histograms for MultiQC and PLOT_MACS2_QC
+    //
+    ch_macs2_peaks
+        .map { meta, peak -> [ meta.antibody, peak ] }
+        .groupTuple()
+        .map { antibody, peaks -> [ [ id: antibody ], peaks ] }
+        .set { ch_peak_stats_input }
+
+    PEAK_STATS (
+        ch_peak_stats_input,
+        ch_peak_stats_headers
+    )
+    ch_custompeaks_count_multiqc = PEAK_STATS.out.mqc
+    ch_versions = ch_versions.mix(PEAK_STATS.out.versions.first())
 
     if (!params.skip_peak_annotation) {
         //
@@ -606,7 +619,8 @@ workflow CHIPSEQ {
             // MODULE: MACS2 QC plots with R
             //
             PLOT_MACS2_QC (
-                ch_macs2_peaks.collect{it[1]}
+                PEAK_STATS.out.summary.collect{it[1]},
+                PEAK_STATS.out.histogram.collect{it[1]}
             )
             ch_versions = ch_versions.mix(PLOT_MACS2_QC.out.versions)
 
@@ -631,6 +645,8 @@ workflow CHIPSEQ {
 
     ch_macs2_consensus_bed_lib   = Channel.empty()
     ch_macs2_consensus_txt_lib   = Channel.empty()
+    ch_macs2_consensus_boolean   = Channel.empty()
+    ch_macs2_consensus_npz       = Channel.empty()
     ch_deseq2_pca_multiqc        = Channel.empty()
     ch_deseq2_clustering_multiqc = Channel.empty()
 
@@ -671,19 +687,63 @@ workflow CHIPSEQ {
     //  A final summit has to be computed running MACS2 on all BAMs by antibody - create a channel with sample vs inputs or samples alone and run MACS2
     //
 
-    MACS2_CONSENSUS ( 
+    if (params.consensus_batch) {
+        //
+        // All antibodies in one task from a manifest of [ antibody, sample, peaks ], applying the ext.when of MACS2_CONSENSUS
+        //
+        def peak_type = params.narrow_peak ? 'narrowPeak' : 'broadPeak'
         ch_antibody_peaks
-    )
-    ch_macs2_consensus_bed_lib = MACS2_CONSENSUS.out.bed
-    ch_macs2_consensus_txt_lib = MACS2_CONSENSUS.out.txt
-    ch_versions = ch_versions.mix(MACS2_CONSENSUS.out.versions)
+            .filter { meta, peaks -> meta.multiple_groups || meta.replicates_exist }
+            .set { ch_antibody_peaks_batch }
+
+        ch_antibody_peaks_batch
+            .flatMap {
+                meta, peaks ->
+                    peaks.collect { "${meta.id}\t${it.name.replaceAll("_peaks.${peak_type}","").replaceAll("_chr.*","")}\t${it.name}\n" }
+            }
+            .collectFile(name: 'consensus_manifest.tsv', sort: true)
+            .set { ch_consensus_manifest }
+
+        MACS2_CONSENSUS_BATCH (
+            ch_antibody_peaks_batch.map { it[0].id }.collect(),
+            ch_consensus_manifest,
+            ch_antibody_peaks_batch.flatMap { it[1] }.unique().collect()
+        )
+
+        // Create channels: [ meta, file ] from the outputs named '<antibody>.consensus_peaks.*'
+        ch_antibody_meta = ch_antibody_peaks_batch.map { meta, peaks -> [ meta.id, meta ] }
+        def by_antibody  = {
+            ch ->
+                ch
+                    .flatten()
+                    .map { [ it.name.replaceAll(/\.consensus_peaks\..*$/, ''), it ] }
+                    .join(ch_antibody_meta)
+                    .map { id, file, meta -> [ meta, file ] }
+        }
+        ch_macs2_consensus_bed_lib  = by_antibody(MACS2_CONSENSUS_BATCH.out.bed)
+        ch_macs2_consensus_txt_lib  = by_antibody(MACS2_CONSENSUS_BATCH.out.txt)
+        ch_macs2_consensus_boolean  = by_antibody(MACS2_CONSENSUS_BATCH.out.boolean_txt)
+        ch_macs2_consensus_npz      = by_antibody(MACS2_CONSENSUS_BATCH.out.boolean_npz)
+        ch_versions   = ch_versions.mix(MACS2_CONSENSUS_BATCH.out.versions)
+        ch_perf_stats = ch_perf_stats.mix(MACS2_CONSENSUS_BATCH.out.perf.flatten())
+    } else {
+        MACS2_CONSENSUS ( 
+            ch_antibody_peaks
+        )
+        ch_macs2_consensus_bed_lib  = MACS2_CONSENSUS.out.bed
+        ch_macs2_consensus_txt_lib  = MACS2_CONSENSUS.out.txt
+        ch_macs2_consensus_boolean  = MACS2_CONSENSUS.out.boolean_txt
+        ch_macs2_consensus_npz      = MACS2_CONSENSUS.out.boolean_npz
+        ch_versions   = ch_versions.mix(MACS2_CONSENSUS.out.versions)
+        ch_perf_stats = ch_perf_stats.mix(MACS2_CONSENSUS.out.perf.map { it[1] })
+    }
 
     if (!params.skip_peak_annotation) {
         //
         // MODULE: Annotate consensus peaks
         //
         HOMER_ANNOTATEPEAKS_CONSENSUS (
-            MACS2_CONSENSUS.out.bed,
+            ch_macs2_consensus_bed_lib,
             PREPARE_GENOME.out.fasta,
             PREPARE_GENOME.out.gtf
         )
@@ -692,44 +752,43 @@ workflow CHIPSEQ {
         // MODULE: Add boolean fields to annotated consensus peaks to aid filtering
         //
         ANNOTATE_BOOLEAN_PEAKS (
-            MACS2_CONSENSUS.out.boolean_txt.join(HOMER_ANNOTATEPEAKS_CONSENSUS.out.txt, by: [0]),
+            ch_macs2_consensus_boolean.join(HOMER_ANNOTATEPEAKS_CONSENSUS.out.txt, by: [0]),
         )
         ch_versions = ch_versions.mix(ANNOTATE_BOOLEAN_PEAKS.out.versions)
     }
 
-    // Create channels: [ antibody, [ ip_bams ] ]
-    ch_ip_control_bam
+    // Create channels: [ antibody, [ single_end ], [ ip_bams ], [ ip_bais ] ]
+    ch_genome_bam_bai
+        .filter { meta, bam, bai -> !meta.is_input }
         .map { 
-            meta, ip_bam, control_bam ->
-                [ meta.antibody, ip_bam ]
+            meta, bam, bai ->
+                [ meta.antibody, meta.single_end, bam, bai ]
         }
         .groupTuple()
         .set { ch_antibody_bams }
     
 
-    // Create channels: [ meta, [ ip_bams ], saf ]
-    MACS2_CONSENSUS
-        .out
-        .saf
+    // Create channels: [ meta, [ ip_bams ], [ ip_bais ], consensus matrix ]
+    ch_macs2_consensus_npz
         .map { 
-            meta, saf -> 
-                [ meta.id, meta, saf ] 
+            meta, npz -> 
+                [ meta.id, meta, npz ] 
         }
         .join(ch_antibody_bams)
         .map {
-            antibody, meta, saf, bams ->
-                [ meta, bams.flatten().sort(), saf ]
+            antibody, meta, npz, single_end, bams, bais ->
+                [ meta + [ single_end: single_end[0] ], bams.flatten().sort { it.name }, bais.flatten(), npz ]
         }
-        .set { ch_saf_bams }
+        .set { ch_consensus_bams }
 
     //
-    // MODULE: Quantify peaks across samples with featureCounts
+    // MODULE: Quantify consensus peaks across samples in featureCounts format
     //
-    SUBREAD_FEATURECOUNTS (
-        ch_saf_bams
+    CONSENSUS_COUNTS (
+        ch_consensus_bams
     )
-    ch_subreadfeaturecounts_multiqc = SUBREAD_FEATURECOUNTS.out.summary
-    ch_versions = ch_versions.mix(SUBREAD_FEATURECOUNTS.out.versions.first())
+    ch_subreadfeaturecounts_multiqc = CONSENSUS_COUNTS.out.summary
+    ch_versions = ch_versions.mix(CONSENSUS_COUNTS.out.versions.first())
 
     //
     // Normalize samples with Gualdrini et al. 2016 Method compute scaling factor and generate a channel - [meta , bam, scaling]
@@ -766,7 +825,7 @@ workflow CHIPSEQ {
     //
     if (normalization_methods.contains('invariant_genes')) {
         NORMALIZE_DESEQ2_QC_INVARIANT_GENES (
-            SUBREAD_FEATURECOUNTS.out.counts.map { meta, counts -> counts },
+            CONSENSUS_COUNTS.out.counts.map { meta, counts -> counts },
             "featureCounts",
             ch_consensus_annotation
         )
@@ -805,7 +864,7 @@ workflow CHIPSEQ {
     //
     if (normalization_methods.contains('all_genes')) {
         NORMALIZE_DESEQ2_QC_ALL_GENES (
-            SUBREAD_FEATURECOUNTS.out.counts.map { meta, counts -> counts },
+            CONSENSUS_COUNTS.out.counts.map { meta, counts -> counts },
             "featureCounts",
             ch_consensus_annotation
         )
@@ -880,97 +939,77 @@ workflow CHIPSEQ {
     // Given a tab separated matrix with the first column : Sample_id, Scaling_factor convert the matrix to a channel with [Sample_id, Scaling_factor] pairs
     // Consider that the first line is the header - in principle Sample_id must match the meta.id from BAM_FILTER_SUBWF.out.bam    
 
-    // Split size factors by normalization method
-    ch_size_factors_invariant = ch_size_factors
-        .filter { id, scaling, method -> method == 'invariant_genes' }
+    // Group size factors by sample: [ id, [ [ norm_method, scaling ], ... ] ]
+    ch_size_factors
         .map { id, scaling, method -> 
-            log.info "📊 SCALING FACTOR (invariant): id='${id}', scaling=${scaling}"
-            [id, scaling] 
+            log.info "📊 SCALING FACTOR (${method}): id='${id}', scaling=${scaling}"
+            [ id, [ method, scaling ] ] 
         }
-    
-    ch_size_factors_all_genes_only = ch_size_factors
-        .filter { id, scaling, method -> method == 'all_genes' }
-        .map { id, scaling, method -> 
-            log.info "📊 SCALING FACTOR (all_genes): id='${id}', scaling=${scaling}"
-            [id, scaling] 
-        }
-    
-    // Create combined channel for invariant genes
-    // Filter out Input samples - they should not be normalized
-    // Prepare BAM channel for deeptools - filter out Input samples
-    ch_bam_for_deeptools = ch_genome_bam_bai
-        .filter { meta, bam, bai -> !meta.is_input }
+        .groupTuple(by: 0)
+        .set { ch_size_factors_by_id }
 
-    // CHANNEL OPERATION: Combine BAM files with scaling factors for invariant genes
-    // Use .combine() to create cartesian product, then filter by matching sample IDs
-    // Strategy from rnaseq: use .map with null + .filter for cleaner separation
-    ch_bam_bai_scale_invariant = ch_bam_for_deeptools
-        .combine(ch_size_factors_invariant)
-        .map { meta, bam, bai, sample_id, scaling -> 
-            if (meta.id == sample_id) {
-                def new_meta = meta.clone()
-                new_meta.norm_method = 'invariant_genes'
-                log.info "✅ MATCHED sample for invariant normalization: ${meta.id} (scaling=${scaling})"
-                [new_meta, bam, bai, scaling]
-            } else {
-                null
+    // CHANNEL OPERATION: Attach the scaling factors of each sample to its BAM file: [ meta, bam, bai, [ [ norm_method, scaling ], ... ] ]
+    // Input samples are not normalized and only get the depth (CPM) tracks, so they are branched off before the join
+    // and do not wait for DESeq2. Unmatched IP samples of the remainder join are released once DESeq2 has finished.
+    if ( !params.skip_deeptools_norm ) {
+        ch_genome_bam_bai
+            .branch { meta, bam, bai ->
+                input: meta.is_input
+                ip: true
             }
-        }
-        .filter { it != null }
-    
-    // CHANNEL OPERATION: Combine BAM files with scaling factors for all genes
-    // Use same strategy as invariant genes for consistency
-    ch_bam_bai_scale_all_genes = ch_bam_for_deeptools
-        .combine(ch_size_factors_all_genes_only)
-        .map { meta, bam, bai, sample_id, scaling -> 
-            if (meta.id == sample_id) {
-                def new_meta = meta.clone()
-                new_meta.norm_method = 'all_genes'
-                log.info "✅ MATCHED sample for all_genes normalization: ${meta.id} (scaling=${scaling})"
-                [new_meta, bam, bai, scaling]
-            } else {
-                null
+            .set { ch_genome_bam_bai_branched }
+
+        ch_bam_bai_scaling = ch_genome_bam_bai_branched
+            .ip
+            .map { meta, bam, bai -> [ meta.id, meta, bam, bai ] }
+            .join(ch_size_factors_by_id, by: [0], remainder: true)
+            .filter { id, meta, bam, bai, scaling -> meta != null }
+            .map { id, meta, bam, bai, scaling -> 
+                def sample_scaling = scaling ?: []
+                if (sample_scaling) {
+                    log.info "✅ MATCHED sample for normalization: ${meta.id} (${sample_scaling.collect{ it.join('=') }.join(', ')})"
+                }
+                [ meta, bam, bai, sample_scaling ]
             }
-        }
-        .filter { it != null }
+            .mix(
+                ch_genome_bam_bai_branched
+                    .input
+                    .map { meta, bam, bai -> [ meta, bam, bai, [] ] }
+            )
+    } else {
+        ch_bam_bai_scaling = ch_genome_bam_bai
+            .map { meta, bam, bai -> [ meta, bam, bai, [] ] }
+    }
 
     ch_deeptoolsplotprofile_multiqc = Channel.empty()
     //
-    // Scale to depth of sequencing using Deeptools:
+    // MODULE: Depth (CPM) and DESeq2 normalized BigWig coverage tracks from a single pass over each BAM file
     // 
     DEEPTOOLS_BIGWIG (
-        ch_genome_bam_bai
+        ch_bam_bai_scaling
     )
     ch_versions = ch_versions.mix(DEEPTOOLS_BIGWIG.out.versions.first())
     ch_big_wig = DEEPTOOLS_BIGWIG.out.bigwig
 
     if ( !params.skip_deeptools_norm ) {
-        //
-        // MODULE: DESeq2 normalized BigWig coverage tracks - invariant genes
-        //
-        if (normalization_methods.contains('invariant_genes')) {
-            DEEPTOOLS_BIGWIG_NORM_INVARIANT (
-                ch_bam_bai_scale_invariant
-            )
-            ch_versions = ch_versions.mix(DEEPTOOLS_BIGWIG_NORM_INVARIANT.out.versions.first())
-            ch_big_wig = ch_big_wig.mix(DEEPTOOLS_BIGWIG_NORM_INVARIANT.out.bigwig)
-        }
-        
-        //
-        // MODULE: DESeq2 normalized BigWig coverage tracks - all genes
-        //
-        if (normalization_methods.contains('all_genes')) {
-            DEEPTOOLS_BIGWIG_NORM_ALL_GENES (
-                ch_bam_bai_scale_all_genes
-            )
-            ch_versions = ch_versions.mix(DEEPTOOLS_BIGWIG_NORM_ALL_GENES.out.versions.first())
-            ch_big_wig = ch_big_wig.mix(DEEPTOOLS_BIGWIG_NORM_ALL_GENES.out.bigwig)
-        }
-    } 
+        // Split normalized tracks into one entry per method: [ meta + norm_method, bigwig ]
+        DEEPTOOLS_BIGWIG
+            .out
+            .norm_bigwig
+            .flatMap { meta, bigwigs ->
+                (bigwigs instanceof List ? bigwigs : [ bigwigs ]).collect { bigwig ->
+                    def new_meta = meta.clone()
+                    new_meta.norm_method = bigwig.parent.name
+                    [ new_meta, bigwig ]
+                }
+            }
+            .set { ch_norm_big_wig }
+        ch_big_wig = ch_big_wig.mix(ch_norm_big_wig)
+    }
     
     if (!params.skip_plot_profile ) {
 
-        // Add an if so that if DEEPTOOLS_BIGWIG_NORM.out.bigwig is empty it will use DEEPTOOLS_BIGWIG.out.bigwig
+        // ch_big_wig holds the depth (CPM) tracks plus any DESeq2 normalized tracks
         // MODULE: deepTools matrix generation for plotting
         //
             
@@ -999,6 +1038,19 @@ workflow CHIPSEQ {
         ch_versions = ch_versions.mix(DEEPTOOLS_PLOTHEATMAP.out.versions.first())
     } 
 
+    //
+    // MODULE: Aggregate helper script timings for MultiQC
+    //
+    ch_perf_stats_multiqc = Channel.empty()
+    if (params.helper_perf_stats) {
+        MULTIQC_CUSTOM_PERF_STATS (
+            ch_perf_stats.collect(),
+            ch_perf_stats_headers
+        )
+        ch_perf_stats_multiqc = MULTIQC_CUSTOM_PERF_STATS.out.mqc
+        ch_versions = ch_versions.mix(MULTIQC_CUSTOM_PERF_STATS.out.versions)
+    }
+
     //
     // MODULE: Pipeline reporting
     //
@@ -1037,15 +1089,17 @@ workflow CHIPSEQ {
             BAM_FILTER_SUBWF.out.stats.collect{it[1]}.ifEmpty([]),
             BAM_FILTER_SUBWF.out.flagstat.collect{it[1]}.ifEmpty([]),
             BAM_FILTER_SUBWF.out.idxstats.collect{it[1]}.ifEmpty([]),
+            BAM_FILTER_SUBWF.out.mqc.collect{it[1]}.ifEmpty([]),
             ch_picardcollectmultiplemetrics_multiqc.collect{it[1]}.ifEmpty([]),
+            ch_bam_qc_multiqc.collect{it[1]}.ifEmpty([]),
     
             ch_deeptoolsplotprofile_multiqc.collect{it[1]}.ifEmpty([]),
             ch_deeptoolsplotfingerprint_multiqc.collect{it[1]}.ifEmpty([]),
     
-            PHANTOMPEAKQUALTOOLS.out.spp.collect{it[1]}.ifEmpty([]),
-            MULTIQC_CUSTOM_PHANTOMPEAKQUALTOOLS.out.nsc.collect{it[1]}.ifEmpty([]),
-            MULTIQC_CUSTOM_PHANTOMPEAKQUALTOOLS.out.rsc.collect{it[1]}.ifEmpty([]),
-            MULTIQC_CUSTOM_PHANTOMPEAKQUALTOOLS.out.correlation.collect{it[1]}.ifEmpty([]),
+            STRAND_CROSS_CORRELATION.out.spp.collect{it[1]}.ifEmpty([]),
+            STRAND_CROSS_CORRELATION.out.nsc.collect{it[1]}.ifEmpty([]),
+            STRAND_CROSS_CORRELATION.out.rsc.collect{it[1]}.ifEmpty([]),
+            STRAND_CROSS_CORRELATION.out.correlation.collect{it[1]}.ifEmpty([]),
 
             ch_custompeaks_frip_multiqc.collect{it[1]}.ifEmpty([]),
             ch_custompeaks_count_multiqc.collect{it[1]}.ifEmpty([]),
@@ -1054,7 +1108,9 @@ workflow CHIPSEQ {
 
             ch_deseq2_pca_multiqc.collect().ifEmpty([]),
             ch_deseq2_clustering_multiqc.collect().ifEmpty([]),
-            DESEQ2_SECTION_HEADER.out.section_header.collect().ifEmpty([])
+            DESEQ2_SECTION_HEADER.out.section_header.collect().ifEmpty([]),
+
+            ch_perf_stats_multiqc.collect().ifEmpty([])
         )
         multiqc_report = MULTIQC.out.report.toList()
     }